@@ -156,10 +156,11 @@ knative_service_audio_transcriber = k8s.apiextensions.CustomResource(
             "metadata": {
                 "annotations": {
                     "autoscaling.knative.dev/minScale": "1",
-                    "autoscaling.knative.dev/maxScale": "1"
+                    "autoscaling.knative.dev/maxScale": "4"
                 }
             },
             "spec": {
+                "containerConcurrency": 1,
                 "containers": [
                     {
                         "image": "stephyng/micro-audio-transcriber-test:latest",
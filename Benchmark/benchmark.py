@@ -0,0 +1,590 @@
+import os
+import re
+import sys
+import json
+import glob
+import time
+import types
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import importlib.util
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MONOLITH = os.path.join(ROOT, "Monolithic", "Service", "app.py")
+SAMPLES = sorted(glob.glob(os.path.join(ROOT, "MP3-files", "*.mp3")))
+SCENARIOS = ["split", "transcribe", "merge", "monolith", "microservices"]
+MODEL_SCENARIOS = {"transcribe", "monolith", "microservices"}
+BACKENDS = ["torch", "int8", "faster-whisper"]
+BUCKET = "audio"
+
+def load_service(path, name):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    # Every service registers the same metric names; keep them usable for the
+    # stage report but out of the shared default registry.
+    from prometheus_client import REGISTRY
+    for metric in ("STAGE_SECONDS", "AUDIO_SECONDS", "REALTIME_FACTOR", "WORKER_QUEUED", "WORKER_IN_FLIGHT", "WORKER_CAPACITY"):
+        if hasattr(module, metric):
+            REGISTRY.unregister(getattr(module, metric))
+    return module
+
+def stage_report(module):
+    stages = {}
+    for metric in module.STAGE_SECONDS.collect():
+        for sample in metric.samples:
+            if sample.name.endswith(("_sum", "_count")):
+                entry = stages.setdefault(sample.labels["stage"], {"count": 0, "seconds": 0.0})
+                entry["count" if sample.name.endswith("_count") else "seconds"] += sample.value
+    return stages
+
+def audio_duration(path):
+    from pydub.utils import mediainfo
+    return float(mediainfo(path).get("duration", 0))
+
+def summarize(latencies, audio_seconds):
+    latencies = np.asarray(latencies, dtype=np.float64)
+    p50 = float(np.percentile(latencies, 50))
+    return {
+        "runs": len(latencies),
+        "latency_seconds": {
+            "mean": float(latencies.mean()),
+            "min": float(latencies.min()),
+            "max": float(latencies.max()),
+            "p50": p50,
+            "p90": float(np.percentile(latencies, 90)),
+            "p99": float(np.percentile(latencies, 99))
+        },
+        "audio_seconds": audio_seconds,
+        "throughput_audio_seconds_per_second": audio_seconds / p50 if p50 else None,
+        "realtime_factor": p50 / audio_seconds if audio_seconds else None
+    }
+
+def transcript_words(text):
+    words = (re.sub(r"[^\w']", "", word.lower()) for word in text.split())
+    return [word for word in words if word]
+
+def srt_text(path):
+    with open(path, encoding="utf-8") as f:
+        blocks = re.split(r"\n\s*\n", f.read().strip())
+    return " ".join(" ".join(block.splitlines()[2:]) for block in blocks)
+
+def word_error_rate(reference, hypothesis):
+    ref = transcript_words(reference)
+    hyp = np.array(transcript_words(hypothesis), dtype=object)
+    if not ref:
+        return 0.0 if len(hyp) == 0 else 1.0
+
+    # One edit-distance row per reference word; insertions along the row
+    # are a running minimum, so each row is a few vector operations.
+    offsets = np.arange(len(hyp) + 1)
+    row = offsets.copy()
+    for i, word in enumerate(ref, start=1):
+        candidates = np.empty_like(row)
+        candidates[0] = i
+        candidates[1:] = np.minimum(row[1:] + 1, row[:-1] + (hyp != word))
+        row = np.minimum.accumulate(candidates - offsets) + offsets
+    return float(row[-1]) / len(ref)
+
+def reference_text(input_file):
+    path = f"{os.path.splitext(input_file)[0]}.txt"
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+def peak_rss():
+    # ru_maxrss is reported in KiB on Linux and in bytes on macOS.
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        "peak_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    }
+
+
+class FakeObject:
+    def __init__(self, object_name, size=0, etag="", metadata=None):
+        self.object_name = object_name
+        self.size = size
+        self.etag = etag
+        self.metadata = metadata or {}
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+class FakeMinio:
+    def __init__(self, root):
+        self.root = root
+        self.metadata = {}
+        self.lock = threading.Lock()
+        self.requests = {}
+
+    def _count(self, operation):
+        with self.lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+
+    def _path(self, bucket, name):
+        return os.path.join(self.root, bucket, name)
+
+    def _missing(self, bucket, name):
+        from minio.error import S3Error
+        return S3Error(code="NoSuchKey", message="Object does not exist", resource=f"/{bucket}/{name}", request_id="", host_id="", response=None)
+
+    def _write(self, bucket, name, data, metadata=None):
+        path = self._path(bucket, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.part", "wb") as f:
+            f.write(data)
+        os.replace(f"{path}.part", path)
+        with self.lock:
+            self.metadata[(bucket, name)] = {f"x-amz-meta-{k.lower()}": v for k, v in (metadata or {}).items()}
+
+    def fput_object(self, bucket, name, file_path, content_type=None, metadata=None, **kwargs):
+        self._count("put")
+        with open(file_path, "rb") as f:
+            self._write(bucket, name, f.read(), metadata)
+
+    def put_object(self, bucket, name, data, length, content_type=None, metadata=None, **kwargs):
+        self._count("put")
+        self._write(bucket, name, data.read(length) if length >= 0 else data.read(), metadata)
+
+    def fget_object(self, bucket, name, file_path, **kwargs):
+        self._count("get")
+        if not os.path.isfile(self._path(bucket, name)):
+            raise self._missing(bucket, name)
+        if os.path.dirname(file_path):
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(self._path(bucket, name), "rb") as src, open(file_path, "wb") as dst:
+            dst.write(src.read())
+
+    def get_object(self, bucket, name, **kwargs):
+        self._count("get")
+        if not os.path.isfile(self._path(bucket, name)):
+            raise self._missing(bucket, name)
+        with open(self._path(bucket, name), "rb") as f:
+            return FakeResponse(f.read())
+
+    def stat_object(self, bucket, name, **kwargs):
+        self._count("head")
+        path = self._path(bucket, name)
+        if not os.path.isfile(path):
+            raise self._missing(bucket, name)
+        with open(path, "rb") as f:
+            etag = hashlib.md5(f.read()).hexdigest()
+        with self.lock:
+            metadata = dict(self.metadata.get((bucket, name), {}))
+        return FakeObject(name, os.path.getsize(path), etag, metadata)
+
+    def list_objects(self, bucket, prefix="", recursive=False, **kwargs):
+        self._count("list")
+        base = os.path.join(self.root, bucket)
+        for dirpath, _, filenames in os.walk(base):
+            for filename in sorted(filenames):
+                name = os.path.relpath(os.path.join(dirpath, filename), base).replace(os.sep, "/")
+                if name.startswith(prefix) and not name.endswith(".part"):
+                    yield FakeObject(name, os.path.getsize(os.path.join(dirpath, filename)))
+
+    def remove_object(self, bucket, name, **kwargs):
+        self._count("delete")
+        try:
+            os.remove(self._path(bucket, name))
+        except FileNotFoundError:
+            pass
+
+    def remove_objects(self, bucket, delete_object_list, **kwargs):
+        for obj in delete_object_list:
+            self.remove_object(bucket, getattr(obj, "name", None) or obj._name)
+        return iter(())
+
+    def clear(self, bucket, prefix):
+        for obj in list(self.list_objects(bucket, prefix=prefix, recursive=True)):
+            self.remove_object(bucket, obj.object_name)
+
+    def upload(self, bucket, name, file_path):
+        self.fput_object(bucket, name, file_path)
+        return self.stat_object(bucket, name).etag
+
+
+class BrokerResponse:
+    status_code = 202
+
+    def raise_for_status(self):
+        pass
+
+class FakeBroker:
+    def __init__(self, routes, concurrency=1):
+        self.routes = routes
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.futures = []
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def post(self, url, headers=None, **kwargs):
+        event_type = headers["ce-type"]
+        data = kwargs.get("json")
+        size = len(json.dumps(data).encode("utf-8"))
+        with self.lock:
+            stats = self.events.setdefault(event_type, {"count": 0, "bytes": 0, "max_bytes": 0, "latencies": []})
+            stats["count"] += 1
+            stats["bytes"] += size
+            stats["max_bytes"] = max(stats["max_bytes"], size)
+            if event_type in self.routes:
+                self.futures.append(self.executor.submit(self.deliver, event_type, headers, data))
+        return BrokerResponse()
+
+    def deliver(self, event_type, headers, data):
+        started = time.perf_counter()
+        body, status = self.routes[event_type](data, headers.get("ce-traceparent"))
+        with self.lock:
+            self.events[event_type]["latencies"].append(time.perf_counter() - started)
+        if status >= 400:
+            raise RuntimeError(f"{event_type} handler failed: {body}")
+
+    def drain(self):
+        done = 0
+        while True:
+            with self.lock:
+                futures = self.futures[done:]
+            if not futures:
+                return
+            for future in futures:
+                future.result()
+            done += len(futures)
+
+    def report(self):
+        report = {}
+        for event_type, stats in self.events.items():
+            latencies = stats["latencies"]
+            report[event_type] = {
+                "count": stats["count"],
+                "bytes": stats["bytes"],
+                "max_bytes": stats["max_bytes"],
+                "handler_p50_seconds": float(np.percentile(latencies, 50)) if latencies else None,
+                "handler_p90_seconds": float(np.percentile(latencies, 90)) if latencies else None
+            }
+        return report
+
+def requests_shim(broker):
+    import requests
+    return types.SimpleNamespace(post=broker.post, exceptions=requests.exceptions)
+
+
+def bench_split(args, work_dir):
+    app = load_service(MONOLITH, "monolith_app")
+    latencies = []
+    for run in range(args.repeat):
+        started = time.perf_counter()
+        chunks = app.split_audio(args.input, output_dir=os.path.join(work_dir, f"split_{run}"), silence_thresh=-40, min_silence_len=700)
+        latencies.append(time.perf_counter() - started)
+    return latencies, {"chunks": len(chunks), "stages": {"audio-processor": stage_report(app)}}
+
+def bench_transcribe(args, work_dir):
+    app = load_service(MONOLITH, "monolith_app")
+    chunks = app.split_audio(args.input, output_dir=os.path.join(work_dir, "chunks"), silence_thresh=-40, min_silence_len=700)
+    started = time.perf_counter()
+    app.model_registry.get(args.model)
+    model_load = time.perf_counter() - started
+
+    latencies = []
+    for run in range(args.repeat):
+        output_srt = os.path.join(work_dir, f"tts_{run}.txt")
+        started = time.perf_counter()
+        app.transcribe_chunks(chunks, output_srt=output_srt, model_size=args.model)
+        latencies.append(time.perf_counter() - started)
+    return latencies, {
+        "chunks": len(chunks),
+        "model_load_seconds": model_load,
+        "transcript": srt_text(output_srt),
+        "stages": {"audio-processor": stage_report(app)}
+    }
+
+def bench_merge(args, work_dir):
+    app = load_service(MONOLITH, "monolith_app")
+    chunks = app.split_audio(args.input, output_dir=os.path.join(work_dir, "chunks"), silence_thresh=-40, min_silence_len=700)
+    files = app.numeric_sort([c[0] for c in chunks])
+
+    latencies = []
+    for run in range(args.repeat):
+        started = time.perf_counter()
+        app.merge_audios(files, os.path.join(work_dir, f"merged_{run}.mp3"))
+        latencies.append(time.perf_counter() - started)
+    return latencies, {"chunks": len(chunks), "merge_mode": app.MERGE_MODE, "stages": {"audio-processor": stage_report(app)}}
+
+def bench_monolith(args, work_dir):
+    app = load_service(MONOLITH, "monolith_app")
+    storage = FakeMinio(os.path.join(work_dir, "minio"))
+    app.minio_client = storage
+    app.transfer_client = storage
+    app.model_registry.get(args.model)
+
+    key = f"uploads/{os.path.basename(args.input)}"
+    etag = storage.upload(BUCKET, key, args.input)
+    record = {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key, "eTag": etag}}}]}
+
+    latencies = []
+    for _ in range(args.repeat):
+        storage.clear(BUCKET, "results/")
+        started = time.perf_counter()
+        body, status = app.process_minio_event(record)
+        latencies.append(time.perf_counter() - started)
+        if status >= 400:
+            raise RuntimeError(f"Monolith failed: {body}")
+    return latencies, {"pipeline_mode": app.PIPELINE_MODE, "minio_requests": storage.requests, "stages": {"audio-processor": stage_report(app)}}
+
+def bench_microservices(args, work_dir):
+    services = os.path.join(ROOT, "Microservices", args.variant, "Services")
+    os.environ.update({"K_SINK": "http://fake-broker", "FAN_IN_STORE": "local", "ASYNC_MODE": "false"})
+    processor = load_service(os.path.join(services, "minio-processor", "app.py"), "processor_app")
+    splitter = load_service(os.path.join(services, "audio-splitter", "app.py"), "splitter_app")
+    transcriber = load_service(os.path.join(services, "audio-transcriber", "app.py"), "transcriber_app")
+    merger = load_service(os.path.join(services, "audio-merger", "app.py"), "merger_app")
+
+    storage = FakeMinio(os.path.join(work_dir, "minio"))
+    for service in (processor, splitter, transcriber, merger):
+        service.minio_client = storage
+        service.transfer_client = storage
+    transcriber.model_registry.get(args.model)
+
+    key = f"uploads/{os.path.basename(args.input)}"
+    etag = storage.upload(BUCKET, key, args.input)
+    record = {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key, "eTag": etag}}}]}
+    client = processor.app.test_client()
+
+    latencies = []
+    brokers = []
+    for run in range(args.repeat):
+        storage.clear(BUCKET, "results/")
+        storage.clear(BUCKET, "locks/")
+        merger.fan_in_store = merger.LocalFanInStore(os.path.join(work_dir, f"fan-in-{run}"))
+        broker = FakeBroker({
+            "dev.knative.minio.object.created": splitter.handle_cloudevent,
+            "dev.knative.audio.chunks.ready": transcriber.handle_cloudevent,
+            "dev.knative.audio.chunk.processed": merger.handle_cloudevent
+        }, concurrency=args.broker_concurrency)
+        for service in (processor, splitter, transcriber):
+            service.requests = requests_shim(broker)
+
+        started = time.perf_counter()
+        response = client.post("/minio-event", json=record)
+        if response.status_code >= 400:
+            raise RuntimeError(f"minio-processor failed: {response.get_data(as_text=True)}")
+        broker.drain()
+        latencies.append(time.perf_counter() - started)
+        brokers.append(broker)
+
+    return latencies, {
+        "variant": args.variant,
+        "broker_concurrency": args.broker_concurrency,
+        "events": brokers[-1].report(),
+        "minio_requests": storage.requests,
+        "stages": {
+            "minio-processor": stage_report(processor),
+            "audio-splitter": stage_report(splitter),
+            "audio-transcriber": stage_report(transcriber),
+            "audio-merger": stage_report(merger)
+        }
+    }
+
+BENCHMARKS = {
+    "split": bench_split,
+    "transcribe": bench_transcribe,
+    "merge": bench_merge,
+    "monolith": bench_monolith,
+    "microservices": bench_microservices
+}
+
+def run_worker(args):
+    with tempfile.TemporaryDirectory(prefix="audio-benchmark-") as work_dir:
+        os.environ.update({
+            "WORK_ROOT": work_dir,
+            "TRANSCRIPT_CACHE": "true" if args.cache else "false",
+            "WHISPER_BACKEND": args.backend,
+            "TORCH_THREADS": str(args.torch_threads)
+        })
+        latencies, details = BENCHMARKS[args.worker](args, work_dir)
+        result = {
+            "scenario": args.worker,
+            "input": os.path.basename(args.input),
+            "backend": args.backend,
+            **summarize(latencies, audio_duration(args.input)),
+            **details,
+            **peak_rss()
+        }
+    with open(args.result_file, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+
+
+def synthesize(source, minutes, output_file):
+    from pydub import AudioSegment
+
+    speech = AudioSegment.from_file(source)
+    gap = AudioSegment.silent(duration=1200, frame_rate=speech.frame_rate)
+    target = minutes * 60 * 1000
+    parts = []
+    length = 0
+    while length < target:
+        parts.append(speech)
+        parts.append(gap)
+        length += len(speech) + len(gap)
+    sum(parts[1:], parts[0])[:target].export(output_file, format="mp3")
+    return output_file
+
+def compare(results, baseline_file, tolerance):
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = {(r["scenario"], r["input"], r.get("backend", "torch")): r for r in json.load(f)["results"]}
+
+    regressions = []
+    for result in results:
+        previous = baseline.get((result["scenario"], result["input"], result.get("backend", "torch")))
+        if previous is None:
+            continue
+        for metric, current, before in (
+            ("latency_p50", result["latency_seconds"]["p50"], previous["latency_seconds"]["p50"]),
+            ("peak_rss_mb", result["peak_rss_mb"], previous["peak_rss_mb"])
+        ):
+            if before and current > before * (1 + tolerance):
+                regressions.append({
+                    "scenario": result["scenario"],
+                    "input": result["input"],
+                    "backend": result.get("backend", "torch"),
+                    "metric": metric,
+                    "baseline": before,
+                    "current": current,
+                    "change": current / before - 1
+                })
+    return regressions
+
+def score_transcripts(results, inputs):
+    # WER is measured against MP3-files/<name>.txt when present, otherwise
+    # against the first backend's transcript of the same input.
+    references = {os.path.basename(path): reference_text(path) for path in inputs}
+    for result in results:
+        if result.get("scenario") != "transcribe" or "transcript" not in result:
+            continue
+        reference = references.get(result["input"])
+        source = "reference"
+        if reference is None:
+            first = next(r for r in results if r.get("scenario") == "transcribe" and r["input"] == result["input"] and "transcript" in r)
+            reference, source = first["transcript"], first["backend"]
+        result["word_error_rate"] = word_error_rate(reference, result["transcript"])
+        result["wer_reference"] = source
+    for result in results:
+        result.pop("transcript", None)
+
+def run_scenario(args, scenario, input_file, backend="torch"):
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        result_file = f.name
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        "--worker", scenario,
+        "--input", input_file,
+        "--result-file", result_file,
+        "--repeat", str(args.repeat),
+        "--model", args.model,
+        "--variant", args.variant,
+        "--broker-concurrency", str(args.broker_concurrency),
+        "--backend", backend,
+        "--torch-threads", str(args.torch_threads)
+    ]
+    if args.cache:
+        command.append("--cache")
+
+    print(f"Running {scenario} on {os.path.basename(input_file)} ({backend})", file=sys.stderr, flush=True)
+    try:
+        completed = subprocess.run(command, stdout=sys.stderr)
+        if completed.returncode != 0:
+            return {"scenario": scenario, "input": os.path.basename(input_file), "backend": backend, "error": f"exit code {completed.returncode}"}
+        with open(result_file, encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        os.remove(result_file)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the monolithic and microservice audio pipelines")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--inputs", nargs="+", default=SAMPLES)
+    parser.add_argument("--synthetic-minutes", nargs="*", type=float, default=[10])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--model", default="tiny")
+    parser.add_argument("--variant", choices=["Cloud", "Local"], default="Cloud")
+    parser.add_argument("--broker-concurrency", type=int, default=1)
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=["torch"], help="transcription backends to compare")
+    parser.add_argument("--torch-threads", type=int, default=0, help="TORCH_THREADS for the workers (0 keeps the torch default)")
+    parser.add_argument("--cache", action="store_true", help="keep the transcript cache enabled")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="previous JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--worker", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument("--input", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    parser.add_argument("--backend", default="torch", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return 0
+
+    with tempfile.TemporaryDirectory(prefix="audio-benchmark-inputs-") as input_dir:
+        inputs = list(args.inputs)
+        for minutes in args.synthetic_minutes:
+            inputs.append(synthesize(SAMPLES[0], minutes, os.path.join(input_dir, f"synthetic_{minutes:g}min.mp3")))
+
+        results = [
+            run_scenario(args, scenario, input_file, backend)
+            for scenario in args.scenarios
+            for input_file in inputs
+            for backend in (args.backends if scenario in MODEL_SCENARIOS else args.backends[:1])
+        ]
+        score_transcripts(results, inputs)
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "repeat": args.repeat,
+            "model": args.model,
+            "variant": args.variant,
+            "broker_concurrency": args.broker_concurrency,
+            "backends": args.backends,
+            "torch_threads": args.torch_threads,
+            "cache": args.cache
+        },
+        "results": results
+    }
+    if args.baseline:
+        report["regressions"] = compare([r for r in results if "error" not in r], args.baseline, args.tolerance)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    failed = any("error" in r for r in results) or bool(report.get("regressions"))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
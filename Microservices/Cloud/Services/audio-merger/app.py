@@ -1,41 +1,614 @@
 import os
 import glob
 import re
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+import secrets
 from pydub import AudioSegment, silence
+from pydub.utils import mediainfo
+import numpy as np
 import whisper
 from minio import Minio
+from minio.error import S3Error
 import tempfile
+import base64
+import zlib
+import threading
+import fcntl
+import io
+from datetime import timedelta
+import time
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import subprocess
 from urllib.parse import unquote
 import requests
 import json
 
-minio_client = Minio(
-    os.environ.get("MINIO_ENDPOINT", "minio.minio:9000"),
-    access_key=os.environ.get("MINIO_ACCESS_KEY", "minioadmin"),
-    secret_key=os.environ.get("MINIO_SECRET_KEY", "minioadmin"),
-    secure=False
+SERVICE_NAME = "audio-merger"
+
+STAGE_SECONDS = Histogram(
+    "audio_stage_seconds", "Wall time spent in each pipeline stage", ["service", "stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
+AUDIO_SECONDS = Counter("audio_processed_seconds_total", "Seconds of audio processed", ["service"])
+REALTIME_FACTOR = Histogram(
+    "audio_realtime_factor", "Processing wall time divided by audio duration", ["service"],
+    buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
 )
+WORKER_QUEUED = Gauge("worker_queued_requests", "Requests waiting for a worker thread", ["service"])
+WORKER_IN_FLIGHT = Gauge("worker_in_flight_requests", "Requests being processed by a worker thread", ["service"])
+WORKER_CAPACITY = Gauge("worker_capacity_requests", "Requests accepted before the service answers 429", ["service"])
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(SERVICE_NAME, stage).observe(time.perf_counter() - started)
+
+def record_audio(audio_seconds, elapsed):
+    if audio_seconds > 0:
+        AUDIO_SECONDS.labels(SERVICE_NAME).inc(audio_seconds)
+        REALTIME_FACTOR.labels(SERVICE_NAME).observe(elapsed / audio_seconds)
+
+trace_context = threading.local()
+
+def start_trace(traceparent=None):
+    parts = (traceparent or "").split("-")
+    trace_context.trace_id = parts[1] if len(parts) == 4 and len(parts[1]) == 32 else secrets.token_hex(16)
+    return trace_context.trace_id
+
+MINIO_CONCURRENCY = int(os.environ.get("MINIO_CONCURRENCY", 8))
+MINIO_RETRIES = int(os.environ.get("MINIO_RETRIES", 3))
+MINIO_RETRY_BACKOFF = float(os.environ.get("MINIO_RETRY_BACKOFF", 0.5))
+
+def minio_connection(retries):
+    http_client = urllib3.PoolManager(
+        maxsize=MINIO_CONCURRENCY,
+        timeout=urllib3.Timeout(connect=10, read=300),
+        retries=retries
+    )
+    client = Minio(
+        os.environ.get("MINIO_ENDPOINT", "minio.minio:9000"),
+        access_key=os.environ.get("MINIO_ACCESS_KEY", "minioadmin"),
+        secret_key=os.environ.get("MINIO_SECRET_KEY", "minioadmin"),
+        secure=False,
+        http_client=http_client
+    )
+    return client, http_client
+
+minio_client, minio_http_client = minio_connection(
+    urllib3.Retry(total=MINIO_RETRIES, backoff_factor=MINIO_RETRY_BACKOFF, status_forcelist=[500, 502, 503, 504])
+)
+# Bulk object transfers retry whole objects in transfer_object, so their
+# connection must not retry underneath it.
+transfer_client, _ = minio_connection(False)
+
+def transfer_object(transfer, bucket, object_name, file_path, retries=MINIO_RETRIES, backoff=MINIO_RETRY_BACKOFF):
+    for attempt in range(retries + 1):
+        started = time.perf_counter()
+        try:
+            transfer(bucket, object_name, file_path)
+            return time.perf_counter() - started
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            print(f"Transfer failed: {object_name} ({e}), retrying in {delay:.1f}s", flush=True)
+            time.sleep(delay)
+
+def transfer_objects(transfer, bucket, items, concurrency=MINIO_CONCURRENCY):
+    timings = {}
+    if not items:
+        return timings
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items)))) as executor:
+        futures = {
+            executor.submit(transfer_object, transfer, bucket, object_name, file_path): object_name
+            for object_name, file_path in items
+        }
+        for future in as_completed(futures):
+            timings[futures[future]] = future.result()
+    return timings
+
+@timed("upload")
+def upload_objects(bucket, items, concurrency=MINIO_CONCURRENCY):
+    return transfer_objects(transfer_client.fput_object, bucket, items, concurrency=concurrency)
+
+@timed("download")
+def download_objects(bucket, items, concurrency=MINIO_CONCURRENCY):
+    for _, file_path in items:
+        if os.path.dirname(file_path):
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    return transfer_objects(transfer_client.fget_object, bucket, items, concurrency=concurrency)
 
 app = Flask(__name__)
 
-def merge_audios(input_files, output_file="merged.mp3"):
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 1))
+WORKER_QUEUE_SIZE = int(os.environ.get("WORKER_QUEUE_SIZE", 4))
+RETRY_AFTER_SECONDS = int(os.environ.get("RETRY_AFTER_SECONDS", 30))
+SERVER = os.environ.get("SERVER", "waitress")
+
+class WorkerPool:
+    def __init__(self, workers=1, queue_size=4):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+
+    def submit(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            return None
+
+        with self.lock:
+            self.queued += 1
+
+        def run():
+            with self.lock:
+                self.queued -= 1
+                self.in_flight += 1
+            try:
+                return fn(*args)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+                self.slots.release()
+
+        return self.executor.submit(run)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": self.queued,
+                "in_flight": self.in_flight,
+                "workers": self.workers,
+                "capacity": self.capacity
+            }
+
+worker_pool = WorkerPool(workers=WORKER_THREADS, queue_size=WORKER_QUEUE_SIZE)
+WORKER_QUEUED.labels(SERVICE_NAME).set_function(lambda: worker_pool.stats()["queued"])
+WORKER_IN_FLIGHT.labels(SERVICE_NAME).set_function(lambda: worker_pool.stats()["in_flight"])
+WORKER_CAPACITY.labels(SERVICE_NAME).set(worker_pool.capacity)
+
+def busy_response():
+    response = jsonify({"error": "Server busy", **worker_pool.stats()})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+    return response
+
+def run_in_pool(fn, *args):
+    future = worker_pool.submit(fn, *args)
+    if future is None:
+        return busy_response()
+    body, status = future.result()
+    return jsonify(body), status
+
+FAN_IN_STORE = os.environ.get("FAN_IN_STORE", "minio")
+FAN_IN_DIR = os.environ.get("FAN_IN_DIR", os.path.join(tempfile.gettempdir(), "fan-in"))
+MERGE_CLAIM_SECONDS = int(os.environ.get("MERGE_CLAIM_SECONDS", 900))
+
+class MinioFanInStore:
+    def __init__(self, client, http_client):
+        self.client = client
+        self.http_client = http_client
+
+    def put(self, bucket, name, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.client.put_object(bucket, name, io.BytesIO(data), len(data), content_type="application/json")
+
+    def list(self, bucket, prefix):
+        entries = {}
+        for obj in self.client.list_objects(bucket, prefix=prefix, recursive=True):
+            response = self.client.get_object(bucket, obj.object_name)
+            try:
+                entries[obj.object_name] = json.loads(response.read())
+            finally:
+                response.close()
+                response.release_conn()
+        return entries
+
+    def read(self, bucket, name):
+        try:
+            response = self.client.get_object(bucket, name)
+        except S3Error as e:
+            if e.code in ("NoSuchKey", "NoSuchObject"):
+                return None, None
+            raise
+        try:
+            return json.loads(response.read()), response.headers.get("ETag")
+        finally:
+            response.close()
+            response.release_conn()
+
+    def create(self, bucket, name, payload, tag=None):
+        url = self.client.presigned_put_object(bucket, name, expires=timedelta(hours=1))
+        response = self.http_client.request(
+            "PUT", url,
+            body=json.dumps(payload).encode("utf-8"),
+            headers={"If-Match": tag} if tag else {"If-None-Match": "*"},
+            retries=False
+        )
+        if response.status == 412:
+            return False
+        if response.status >= 300:
+            raise RuntimeError(f"Conditional put failed for {name}: HTTP {response.status}")
+        return True
+
+    def delete(self, bucket, name):
+        self.client.remove_object(bucket, name)
+
+class LocalFanInStore:
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, name):
+        path = os.path.join(self.root, bucket, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def put(self, bucket, name, payload):
+        path = self._path(bucket, name)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(payload, f)
+        os.replace(f"{path}.tmp", path)
+
+    def list(self, bucket, prefix):
+        entries = {}
+        base = os.path.join(self.root, bucket)
+        for dirpath, _, filenames in os.walk(os.path.join(base, prefix)):
+            for filename in filenames:
+                if filename.endswith((".tmp", ".lock")):
+                    continue
+                path = os.path.join(dirpath, filename)
+                with open(path, encoding="utf-8") as f:
+                    entries[os.path.relpath(path, base).replace(os.sep, "/")] = json.load(f)
+        return entries
+
+    def read(self, bucket, name):
+        try:
+            with open(self._path(bucket, name), encoding="utf-8") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None, None
+        if not data:
+            return None, None
+        return json.loads(data), data
+
+    def create(self, bucket, name, payload, tag=None):
+        path = self._path(bucket, name)
+        if tag is None:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(payload, f)
+            return True
+
+        with open(f"{path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.read(bucket, name)[1] != tag:
+                return False
+            self.put(bucket, name, payload)
+        return True
+
+    def delete(self, bucket, name):
+        os.remove(self._path(bucket, name))
+
+fan_in_store = LocalFanInStore(FAN_IN_DIR) if FAN_IN_STORE == "local" else MinioFanInStore(minio_client, minio_http_client)
+
+MERGE_MODE = os.environ.get("MERGE_MODE", "copy")
+WORK_ROOT = os.environ.get("WORK_ROOT") or None
+
+def work_directory():
+    return tempfile.TemporaryDirectory(prefix="audio-merger-", dir=WORK_ROOT)
+
+def mp3_stream_format(path):
+    with open(path, "rb") as f:
+        header = f.read(10)
+        offset = 0
+        if header[:3] == b"ID3":
+            offset = 10 + ((header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | (header[9] & 0x7f))
+            if header[5] & 0x10:
+                offset += 10
+        f.seek(offset)
+        data = f.read(4096)
+
+    for i in range(len(data) - 3):
+        if data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+            continue
+        version = (data[i + 1] >> 3) & 0x3
+        layer = (data[i + 1] >> 1) & 0x3
+        bitrate = data[i + 2] >> 4
+        sample_rate = (data[i + 2] >> 2) & 0x3
+        if version == 1 or layer == 0 or bitrate == 0xF or sample_rate == 3:
+            continue
+        return version, layer, sample_rate, (data[i + 3] >> 6) == 3
+    return None
+
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+def mp3_audio_params(path):
+    stream = mp3_stream_format(path)
+    if stream is None:
+        info = mediainfo(path)
+        return int(info["sample_rate"]), int(info["channels"])
+    version, _, sample_rate, mono = stream
+    return MP3_SAMPLE_RATES[version][sample_rate], 1 if mono else 2
+
+def overlap_trims(ranges):
+    trims = []
+    previous_end = None
+    for start_ms, end_ms in ranges:
+        trims.append(max(0, previous_end - start_ms) if previous_end is not None else 0)
+        previous_end = end_ms
+    return trims
+
+def concat_mp3(input_files, output_file, trims=None):
+    list_file = f"{output_file}.concat.txt"
+    with open(list_file, "w", encoding="utf-8") as f:
+        for idx, file in enumerate(input_files):
+            escaped = os.path.abspath(file).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+            if trims and trims[idx]:
+                f.write(f"inpoint {trims[idx] / 1000:.3f}\n")
+
+    try:
+        subprocess.run(
+            [AudioSegment.converter, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+             "-i", list_file, "-c", "copy", output_file],
+            check=True
+        )
+    finally:
+        os.remove(list_file)
+
+PCM_FORMATS = {1: "u8", 2: "s16le", 4: "s32le"}
+
+@timed("encode")
+def encode_pcm_parts(parts, frame_rate, channels, sample_width, output_file, format="mp3"):
+    process = subprocess.Popen(
+        [AudioSegment.converter, "-y", "-loglevel", "error",
+         "-f", PCM_FORMATS[sample_width], "-ar", str(frame_rate), "-ac", str(channels), "-i", "pipe:0",
+         "-f", format, output_file],
+        stdin=subprocess.PIPE
+    )
+    try:
+        for part in parts:
+            process.stdin.write(memoryview(part).cast("B"))
+    finally:
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to encode {output_file}")
+
+@timed("merge")
+def merge_audios(input_files, output_file="merged.mp3", mode=MERGE_MODE, trims=None):
     if not input_files:
         raise ValueError("No input files!")
 
-    merged = AudioSegment.empty()
+    if mode == "copy":
+        for file in input_files:
+            if not os.path.isfile(file):
+                raise FileNotFoundError(f"File not found: {file}")
+
+        formats = {mp3_stream_format(file) for file in input_files}
+        if len(formats) == 1 and None not in formats:
+            concat_mp3(input_files, output_file, trims)
+            print(f"Merged {len(input_files)} files without re-encoding")
+            print(f"Merged file saved as: {output_file}\n")
+            return
+
+        print("Chunk encodings differ, merging by re-encoding", flush=True)
+
     for file in input_files:
         if not os.path.isfile(file):
             raise FileNotFoundError(f"File not found: {file}")
-        audio = AudioSegment.from_file(file, format="mp3")
-        merged += audio
-        print(f"Merged: {file}")
 
-    merged.export(output_file, format="mp3")
+    # The output format comes from the MP3 headers, so chunks can be decoded
+    # and piped to the encoder one at a time instead of all held at once.
+    params = [mp3_audio_params(file) for file in input_files]
+    frame_rate = max(rate for rate, _ in params)
+    channels = max(count for _, count in params)
+
+    def decoded():
+        for idx, file in enumerate(input_files):
+            segment = AudioSegment.from_file(file, format="mp3")
+            if trims and trims[idx]:
+                segment = segment[trims[idx]:]
+            yield segment.set_channels(channels).set_frame_rate(frame_rate).set_sample_width(2).raw_data
+            print(f"Merged: {file}")
+
+    encode_pcm_parts(decoded(), frame_rate, channels, 2, output_file)
     print(f"Merged file saved as: {output_file}\n")
 
-def numeric_sort(file_list):
-    return sorted(file_list, key=lambda x: int(re.search(r"chunk_(\d+)\.mp3", x).group(1)))
+
+def parse_timestamp(value):
+    hours, minutes, rest = value.strip().split(":")
+    seconds, ms = rest.split(",")
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int(ms)
+
+def parse_srt(text):
+    cues = []
+    for block in re.split(r"\n\s*\n", text.strip()):
+        lines = block.strip().splitlines()
+        if len(lines) < 2 or " --> " not in lines[1]:
+            continue
+        cues.append((lines[1].strip(), "\n".join(lines[2:]).strip()))
+    return cues
+
+OVERLAP_DEDUP_WORDS = int(os.environ.get("OVERLAP_DEDUP_WORDS", 8))
+
+def normalize_word(word):
+    return re.sub(r"[^\w']", "", word.lower())
+
+def dedup_overlap(previous_text, text, max_words=OVERLAP_DEDUP_WORDS):
+    words = text.split()
+    tail = [normalize_word(word) for word in previous_text.split()[-max_words:]]
+    head = [normalize_word(word) for word in words[:max_words]]
+    for size in range(min(len(tail), len(head)), 0, -1):
+        if tail[-size:] == head[:size] and any(head[:size]):
+            return " ".join(words[size:])
+    return text
+
+def stitch_srt(fragment_files, output_srt="tts.txt"):
+    cues = []
+    for order, fragment in enumerate(fragment_files):
+        with open(fragment, encoding="utf-8") as f:
+            for position, (timing, text) in enumerate(parse_srt(f.read())):
+                start = parse_timestamp(timing.split(" --> ")[0])
+                cues.append((start, order, position, timing, text))
+    cues.sort(key=lambda cue: cue[:3])
+
+    for idx in range(1, len(cues)):
+        start, order, position, timing, text = cues[idx]
+        previous = cues[idx - 1]
+        if order != previous[1] and start < parse_timestamp(previous[3].split(" --> ")[1]):
+            cues[idx] = (start, order, position, timing, dedup_overlap(previous[4], text))
+
+    with open(output_srt, "w", encoding="utf-8") as f:
+        for idx, (_, _, _, timing, text) in enumerate(cues, start=1):
+            f.write(f"{idx}\n")
+            f.write(f"{timing}\n")
+            f.write(f"{text}\n\n")
+
+    print(f"Stitched {len(cues)} cues from {len(fragment_files)} fragments: {output_srt}")
+
+def chunk_index(name):
+    return int(re.search(r"chunk_(\d+)\.mp3", name).group(1))
+
+def unpack_ints(data):
+    deltas = np.frombuffer(zlib.decompress(base64.b64decode(data)), dtype="<i4")
+    return np.cumsum(deltas, dtype=np.int64).tolist()
+
+def decode_chunk_manifest(result_dir, manifest):
+    indices = unpack_ints(manifest["indices"])
+    bounds = unpack_ints(manifest["bounds"])
+    chunks = []
+    for position, index in enumerate(indices):
+        local_name = manifest["template"].format(index)
+        chunks.append([local_name, f"{result_dir}{local_name}", bounds[2 * position], bounds[2 * position + 1]])
+    return chunks
+
+def read_chunk_manifest(bucket, event_data):
+    if "chunks" in event_data:
+        return event_data["chunks"]
+
+    manifest = event_data.get("manifest")
+    if manifest is None:
+        response = minio_client.get_object(bucket, event_data["manifest_ref"])
+        try:
+            manifest = json.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
+    return decode_chunk_manifest(event_data["result_dir"], manifest)
+
+def manifest_object(result_dir):
+    return f"{result_dir}manifest.json"
+
+def completed_etag(bucket, result_dir):
+    try:
+        stat = minio_client.stat_object(bucket, manifest_object(result_dir))
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject"):
+            return None
+        raise
+    return stat.metadata.get("x-amz-meta-source-etag")
+
+def already_processed(bucket, result_dir, etag):
+    return bool(etag) and completed_etag(bucket, result_dir) == etag
+
+def write_manifest(bucket, result_dir, key, etag, version_id="", outputs=()):
+    manifest = {
+        "source": key,
+        "etag": etag,
+        "version_id": version_id,
+        "outputs": list(outputs),
+        "completed_at": time.time()
+    }
+    data = json.dumps(manifest).encode("utf-8")
+    minio_client.put_object(
+        bucket, manifest_object(result_dir), io.BytesIO(data), len(data),
+        content_type="application/json", metadata={"source-etag": etag, "source-version": version_id}
+    )
+    print(f"Manifest written: {manifest_object(result_dir)} ({etag})", flush=True)
+
+def record_shard(bucket, result_dir, event_data):
+    prefix = f"locks/{result_dir}"
+    fan_in_store.put(bucket, f"{prefix}shards/{event_data['shard']:05d}.json", {
+        "shard": event_data["shard"],
+        "chunks": event_data["chunks"]
+    })
+    if "total_chunks" in event_data:
+        fan_in_store.put(bucket, f"{prefix}total.json", {
+            "total_chunks": event_data["total_chunks"],
+            "total_shards": event_data["total_shards"]
+        })
+
+    entries = fan_in_store.list(bucket, prefix)
+    total = entries.get(f"{prefix}total.json")
+    shards = sorted(
+        (entry for name, entry in entries.items() if name.startswith(f"{prefix}shards/")),
+        key=lambda entry: entry["shard"]
+    )
+    done = {chunk_index(chunk[1]) for shard in shards for chunk in shard["chunks"]}
+
+    if total is None or len(shards) < total["total_shards"] or done != set(range(1, total["total_chunks"] + 1)):
+        expected = total["total_chunks"] if total else "?"
+        print(f"Waiting for chunks: {len(done)}/{expected} in {result_dir}", flush=True)
+        return None
+
+    return shards
+
+def claim_merge(bucket, result_dir, shard_count):
+    # The claim is a lease: a merger that dies mid-merge leaves a claim that
+    # another delivery takes over once claimed_at is MERGE_CLAIM_SECONDS old.
+    name = f"locks/{result_dir}merge.claim"
+    payload = {"shards": shard_count, "claimed_at": time.time()}
+    if fan_in_store.create(bucket, name, payload):
+        return "claimed"
+
+    current, tag = fan_in_store.read(bucket, name)
+    if current is None:
+        return "claimed" if fan_in_store.create(bucket, name, payload) else "running"
+    if "completed_at" in current:
+        return "done"
+    if current.get("claimed_at", 0) + MERGE_CLAIM_SECONDS >= time.time():
+        return "running"
+    if not fan_in_store.create(bucket, name, payload, tag):
+        return "running"
+    print(f"Stale merge claim taken over: {result_dir}", flush=True)
+    return "claimed"
+
+def complete_merge(bucket, result_dir, shard_count):
+    fan_in_store.put(bucket, f"locks/{result_dir}merge.claim", {"shards": shard_count, "completed_at": time.time()})
+
+def assemble_shards(bucket, result_dir, shards, work_dir):
+    parts = [f"{result_dir}parts/tts_{shard['shard']:05d}.txt" for shard in shards]
+    fragments = [os.path.join(work_dir, "parts", os.path.basename(part)) for part in parts]
+    chunks = sorted((chunk for shard in shards for chunk in shard["chunks"]), key=lambda chunk: chunk_index(chunk[1]))
+    chunk_files = [os.path.join(work_dir, "chunks", os.path.basename(chunk[1])) for chunk in chunks]
+    output_srt = os.path.join(work_dir, "tts.txt")
+    output_file = os.path.join(work_dir, "merged.mp3")
+
+    try:
+        download_objects(bucket, list(zip(parts, fragments)) + [(chunk[1], path) for chunk, path in zip(chunks, chunk_files)])
+        started = time.perf_counter()
+        stitch_srt(fragments, output_srt)
+        if chunk_files:
+            merge_audios(chunk_files, output_file, trims=overlap_trims([(chunk[2], chunk[3]) for chunk in chunks]))
+            upload_objects(bucket, [(f"{result_dir}merged.mp3", output_file), (f"{result_dir}tts.txt", output_srt)])
+        else:
+            upload_objects(bucket, [(f"{result_dir}tts.txt", output_srt)])
+        record_audio(sum(chunk[3] - chunk[2] for chunk in chunks) / 1000, time.perf_counter() - started)
+    except Exception:
+        fan_in_store.delete(bucket, f"locks/{result_dir}merge.claim")
+        raise
 
 
 @app.route('/', methods=['POST'])
@@ -43,35 +616,79 @@ def process_chunks():
     cloudevent = request.get_json()
     print("CloudEvent received:", cloudevent, flush=True)
 
+    return run_in_pool(handle_cloudevent, cloudevent, request.headers.get("ce-traceparent"))
+
+def handle_cloudevent(cloudevent, traceparent=None):
     try:
+        print(f"Trace: {start_trace(traceparent)}", flush=True)
         event_data = cloudevent.get("data") if isinstance(cloudevent, dict) and "data" in cloudevent else cloudevent
 
         bucket = event_data["bucket"]
         result_dir = event_data["result_dir"]
-        chunks_raw = event_data["chunks"]
-        
-        chunks = []
-        for local_name, object_name, start_ms, end_ms in chunks_raw:
-            os.makedirs(os.path.dirname(local_name), exist_ok=True)
-            minio_client.fget_object(bucket, object_name, local_name)
-            print(f"Downloaded: {object_name} → {local_name}")
-            chunks.append((local_name, start_ms, end_ms))
+        etag = event_data.get("etag", "")
+
+        if already_processed(bucket, result_dir, etag):
+            print(f"Already processed: {result_dir} ({etag})", flush=True)
+            return {"message": "Already processed"}, 200
 
-        files = [c[0] for c in chunks]
-        files = numeric_sort(files)
-        merge_audios(files, "merged.mp3")
+        chunks_raw = read_chunk_manifest(bucket, event_data)
 
-        minio_client.fput_object(bucket, f"{result_dir}merged.mp3", "merged.mp3")
+        if "shard" in event_data:
+            shards = record_shard(bucket, result_dir, {**event_data, "chunks": chunks_raw})
+            if shards is None:
+                return {"message": "Processing complete"}, 200
 
+            state = claim_merge(bucket, result_dir, len(shards))
+            if state == "running":
+                # Retryable, so the broker redelivers until the merge finishes
+                # or its claim goes stale and this delivery takes it over.
+                print(f"Merge already claimed: {result_dir}", flush=True)
+                return {"message": "Merge in progress"}, 503
+            if state == "claimed":
+                with work_directory() as work_dir:
+                    assemble_shards(bucket, result_dir, shards, work_dir)
+                if "key" in event_data:
+                    write_manifest(bucket, result_dir, event_data["key"], etag, event_data.get("version_id", ""), outputs=["merged.mp3", "tts.txt"])
+                complete_merge(bucket, result_dir, len(shards))
+                print(f"Results uploaded to: {result_dir}", flush=True)
+            return {"message": "Processing complete"}, 200
+
+        with work_directory() as work_dir:
+            downloads = [(object_name, os.path.join(work_dir, "chunks", os.path.basename(object_name))) for _, object_name, _, _ in chunks_raw]
+            timings = download_objects(bucket, downloads)
+            for object_name, local_name in downloads:
+                print(f"Downloaded: {object_name} → {local_name} ({timings[object_name] * 1000:.0f} ms)")
+
+            started = time.perf_counter()
+            ordered = sorted(zip(chunks_raw, downloads), key=lambda pair: chunk_index(pair[1][1]))
+            files = [local_name for _, (_, local_name) in ordered]
+            trims = overlap_trims([(chunk[2], chunk[3]) for chunk, _ in ordered])
+            output_file = os.path.join(work_dir, "merged.mp3")
+            merge_audios(files, output_file, trims=trims)
+
+            with timed("upload"):
+                minio_client.fput_object(bucket, f"{result_dir}merged.mp3", output_file)
+            record_audio(sum(chunk[3] - chunk[2] for chunk in chunks_raw) / 1000, time.perf_counter() - started)
+
+        if "key" in event_data:
+            write_manifest(bucket, result_dir, event_data["key"], etag, event_data.get("version_id", ""), outputs=["merged.mp3", "tts.txt"])
         print(f"Results uploaded to: {result_dir}", flush=True)
 
-        return jsonify({"message": "Processing complete"}), 200
+        return {"message": "Processing complete"}, 200
 
     except Exception as e:
         import traceback
         traceback.print_exc()
         print("Error:", e, flush=True)
-        return jsonify({"error": str(e)}), 500
+        return {"error": str(e)}, 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(worker_pool.stats())
 
 @app.route('/', methods=['GET'])
 def home():
@@ -79,4 +696,8 @@ def home():
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
-    app.run(debug=False, host="0.0.0.0", port=port)
\ No newline at end of file
+    if SERVER == "waitress":
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=port, threads=WORKER_THREADS + WORKER_QUEUE_SIZE + 2)
+    else:
+        app.run(debug=False, host="0.0.0.0", port=port, threaded=True)
\ No newline at end of file
@@ -1,15 +1,47 @@
 import os
 import glob
 import re
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, Histogram, generate_latest
+import secrets
+import threading
+import time
 from pydub import AudioSegment, silence
 import whisper
 from minio import Minio
+from minio.error import S3Error
 import tempfile
 from urllib.parse import unquote
 import requests
 import json
 
+SERVICE_NAME = "minio-processor"
+
+STAGE_SECONDS = Histogram(
+    "audio_stage_seconds", "Wall time spent in each pipeline stage", ["service", "stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(SERVICE_NAME, stage).observe(time.perf_counter() - started)
+
+trace_context = threading.local()
+
+def start_trace(traceparent=None):
+    parts = (traceparent or "").split("-")
+    trace_context.trace_id = parts[1] if len(parts) == 4 and len(parts[1]) == 32 else secrets.token_hex(16)
+    return trace_context.trace_id
+
+def next_traceparent():
+    trace_id = getattr(trace_context, "trace_id", None) or start_trace()
+    return f"00-{trace_id}-{secrets.token_hex(8)}-01"
+
 minio_client = Minio(
     os.environ.get("MINIO_ENDPOINT", "minio.minio:9000"),
     access_key=os.environ.get("MINIO_ACCESS_KEY", "minioadmin"),
@@ -19,6 +51,28 @@ minio_client = Minio(
 
 app = Flask(__name__)
 
+SERVER = os.environ.get("SERVER", "waitress")
+SERVER_THREADS = int(os.environ.get("SERVER_THREADS", 4))
+
+def manifest_object(result_dir):
+    return f"{result_dir}manifest.json"
+
+def completed_etag(bucket, result_dir):
+    try:
+        stat = minio_client.stat_object(bucket, manifest_object(result_dir))
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject"):
+            return None
+        raise
+    return stat.metadata.get("x-amz-meta-source-etag")
+
+def already_processed(bucket, result_dir, etag):
+    return bool(etag) and completed_etag(bucket, result_dir) == etag
+
+def event_subject(key, etag="", shard=None):
+    subject = f"{key}@{etag}" if etag else key
+    return subject if shard is None else f"{subject}#{shard}"
+
 def send_cloudevent(subject, data):
     broker_url = os.environ.get("K_SINK")
     
@@ -31,7 +85,8 @@ def send_cloudevent(subject, data):
         "ce-specversion": "1.0",
         "ce-type": "dev.knative.minio.object.created",
         "ce-source": "audio-splitter-service",
-        "ce-id": subject
+        "ce-id": subject,
+        "ce-traceparent": next_traceparent()
     }
 
     try:
@@ -55,17 +110,26 @@ def handle_minio_event():
 
             key = unquote(raw_key)
 
-            if key.startswith(("results/", "locks/", "chunks/")) or key.endswith(("_merged.mp3", "_tts.txt")):
+            if key.startswith(("results/", "locks/", "chunks/", "cache/")) or key.endswith(("_merged.mp3", "_tts.txt")):
                 print(f"Ignored (own file or result): {key}", flush=True)
                 continue
 
-            print(f"Bucket: {bucket}, Key: {key}", flush=True)
+            print(f"Bucket: {bucket}, Key: {key}, Trace: {start_trace()}", flush=True)
+
+            etag = record["s3"]["object"].get("eTag", "")
+            result_dir = f"results/{os.path.splitext(os.path.basename(key))[0]}/"
+            if already_processed(bucket, result_dir, etag):
+                print(f"Already processed: {key} ({etag})", flush=True)
+                continue
 
             event_data = {
                 "bucket": bucket,
-                "key": key
+                "key": key,
+                "etag": etag,
+                "version_id": record["s3"]["object"].get("versionId", "")
             }
-            send_cloudevent(subject=key, data=event_data)
+            with timed("publish"):
+                send_cloudevent(subject=event_subject(key, etag), data=event_data)
 
         return jsonify({"message": "Processing complete"}), 200
 
@@ -76,10 +140,18 @@ def handle_minio_event():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
 @app.route('/')
 def home():
     return "Audio Splitter Service is running (MinIO Event Handler)\n"
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
-    app.run(debug=False, host="0.0.0.0", port=port)
\ No newline at end of file
+    if SERVER == "waitress":
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=port, threads=SERVER_THREADS)
+    else:
+        app.run(debug=False, host="0.0.0.0", port=port, threaded=True)
\ No newline at end of file
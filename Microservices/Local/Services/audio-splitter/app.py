@@ -1,54 +1,732 @@
 import os
 import glob
 import re
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+import secrets
 from pydub import AudioSegment, silence
+from pydub.utils import db_to_float, mediainfo, ratio_to_db
+import numpy as np
 import whisper
 from minio import Minio
+from minio.error import S3Error
+from minio.deleteobjects import DeleteObject
 import tempfile
-from urllib.parse import unquote
+import base64
+import zlib
+import io
+from datetime import timedelta
+import threading
+import subprocess
+import time
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote, unquote
 import requests
 import json
 
-minio_client = Minio(
-    os.environ.get("MINIO_ENDPOINT", "minio.minio:9000"),
-    access_key=os.environ.get("MINIO_ACCESS_KEY", "minioadmin"),
-    secret_key=os.environ.get("MINIO_SECRET_KEY", "minioadmin"),
-    secure=False
+SERVICE_NAME = "audio-splitter"
+
+STAGE_SECONDS = Histogram(
+    "audio_stage_seconds", "Wall time spent in each pipeline stage", ["service", "stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
+AUDIO_SECONDS = Counter("audio_processed_seconds_total", "Seconds of audio processed", ["service"])
+REALTIME_FACTOR = Histogram(
+    "audio_realtime_factor", "Processing wall time divided by audio duration", ["service"],
+    buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
 )
+WORKER_QUEUED = Gauge("worker_queued_requests", "Requests waiting for a worker thread", ["service"])
+WORKER_IN_FLIGHT = Gauge("worker_in_flight_requests", "Requests being processed by a worker thread", ["service"])
+WORKER_CAPACITY = Gauge("worker_capacity_requests", "Requests accepted before the service answers 429", ["service"])
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(SERVICE_NAME, stage).observe(time.perf_counter() - started)
+
+def record_audio(audio_seconds, elapsed):
+    if audio_seconds > 0:
+        AUDIO_SECONDS.labels(SERVICE_NAME).inc(audio_seconds)
+        REALTIME_FACTOR.labels(SERVICE_NAME).observe(elapsed / audio_seconds)
+
+trace_context = threading.local()
+
+def start_trace(traceparent=None):
+    parts = (traceparent or "").split("-")
+    trace_context.trace_id = parts[1] if len(parts) == 4 and len(parts[1]) == 32 else secrets.token_hex(16)
+    return trace_context.trace_id
+
+def next_traceparent():
+    trace_id = getattr(trace_context, "trace_id", None) or start_trace()
+    return f"00-{trace_id}-{secrets.token_hex(8)}-01"
+
+MINIO_CONCURRENCY = int(os.environ.get("MINIO_CONCURRENCY", 8))
+MINIO_RETRIES = int(os.environ.get("MINIO_RETRIES", 3))
+MINIO_RETRY_BACKOFF = float(os.environ.get("MINIO_RETRY_BACKOFF", 0.5))
+
+def minio_connection(retries):
+    http_client = urllib3.PoolManager(
+        maxsize=MINIO_CONCURRENCY,
+        timeout=urllib3.Timeout(connect=10, read=300),
+        retries=retries
+    )
+    client = Minio(
+        os.environ.get("MINIO_ENDPOINT", "minio.minio:9000"),
+        access_key=os.environ.get("MINIO_ACCESS_KEY", "minioadmin"),
+        secret_key=os.environ.get("MINIO_SECRET_KEY", "minioadmin"),
+        secure=False,
+        http_client=http_client
+    )
+    return client, http_client
+
+minio_client, minio_http_client = minio_connection(
+    urllib3.Retry(total=MINIO_RETRIES, backoff_factor=MINIO_RETRY_BACKOFF, status_forcelist=[500, 502, 503, 504])
+)
+# Bulk object transfers retry whole objects in transfer_object, so their
+# connection must not retry underneath it.
+transfer_client, _ = minio_connection(False)
+
+def transfer_object(transfer, bucket, object_name, file_path, retries=MINIO_RETRIES, backoff=MINIO_RETRY_BACKOFF):
+    for attempt in range(retries + 1):
+        started = time.perf_counter()
+        try:
+            transfer(bucket, object_name, file_path)
+            return time.perf_counter() - started
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            print(f"Transfer failed: {object_name} ({e}), retrying in {delay:.1f}s", flush=True)
+            time.sleep(delay)
+
+def transfer_objects(transfer, bucket, items, concurrency=MINIO_CONCURRENCY):
+    timings = {}
+    if not items:
+        return timings
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items)))) as executor:
+        futures = {
+            executor.submit(transfer_object, transfer, bucket, object_name, file_path): object_name
+            for object_name, file_path in items
+        }
+        for future in as_completed(futures):
+            timings[futures[future]] = future.result()
+    return timings
+
+@timed("upload")
+def upload_objects(bucket, items, concurrency=MINIO_CONCURRENCY):
+    return transfer_objects(transfer_client.fput_object, bucket, items, concurrency=concurrency)
 
 app = Flask(__name__)
 
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 1))
+WORKER_QUEUE_SIZE = int(os.environ.get("WORKER_QUEUE_SIZE", 4))
+RETRY_AFTER_SECONDS = int(os.environ.get("RETRY_AFTER_SECONDS", 30))
+SERVER = os.environ.get("SERVER", "waitress")
+
+class WorkerPool:
+    def __init__(self, workers=1, queue_size=4):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+
+    def submit(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            return None
+
+        with self.lock:
+            self.queued += 1
+
+        def run():
+            with self.lock:
+                self.queued -= 1
+                self.in_flight += 1
+            try:
+                return fn(*args)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+                self.slots.release()
+
+        return self.executor.submit(run)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": self.queued,
+                "in_flight": self.in_flight,
+                "workers": self.workers,
+                "capacity": self.capacity
+            }
+
+worker_pool = WorkerPool(workers=WORKER_THREADS, queue_size=WORKER_QUEUE_SIZE)
+WORKER_QUEUED.labels(SERVICE_NAME).set_function(lambda: worker_pool.stats()["queued"])
+WORKER_IN_FLIGHT.labels(SERVICE_NAME).set_function(lambda: worker_pool.stats()["in_flight"])
+WORKER_CAPACITY.labels(SERVICE_NAME).set(worker_pool.capacity)
+
+def busy_response():
+    response = jsonify({"error": "Server busy", **worker_pool.stats()})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+    return response
+
+def run_in_pool(fn, *args):
+    future = worker_pool.submit(fn, *args)
+    if future is None:
+        return busy_response()
+    body, status = future.result()
+    return jsonify(body), status
+
+SILENCE_DETECTOR = os.environ.get("SILENCE_DETECTOR", "numpy")
+SPLIT_MODE = os.environ.get("SPLIT_MODE", "batch")
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 4))
+STREAM_WINDOW_MS = int(os.environ.get("STREAM_WINDOW_MS", 10000))
+TRANSCRIBE_SHARDS = int(os.environ.get("TRANSCRIBE_SHARDS", 1))
+MERGER_FAN_IN = os.environ.get("MERGER_FAN_IN", "false").lower() == "true"
+
+if (SPLIT_MODE == "stream" or TRANSCRIBE_SHARDS > 1) and not MERGER_FAN_IN:
+    raise RuntimeError("SPLIT_MODE=stream and TRANSCRIBE_SHARDS>1 emit shard fragments; set MERGER_FAN_IN=true only when the merger runs the fan-in stage")
+WORK_ROOT = os.environ.get("WORK_ROOT") or None
+
+def work_directory():
+    return tempfile.TemporaryDirectory(prefix="audio-splitter-", dir=WORK_ROOT)
+
+SAMPLE_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+def pcm_frames(audio):
+    samples = np.frombuffer(audio.raw_data, dtype=SAMPLE_DTYPES[audio.sample_width])
+    return samples.reshape(-1, audio.channels)
+
+def nonsilent_ranges(frames, frame_rate, max_amplitude, seg_len, min_silence_len=1000, silence_thresh=-16, seek_step=1):
+    if seg_len < min_silence_len:
+        return [[0, seg_len]]
+
+    if np.issubdtype(frames.dtype, np.integer) and frames.dtype.itemsize <= 2:
+        energy = np.square(frames, dtype=np.int64).sum(axis=1)
+    else:
+        energy = np.square(frames, dtype=np.float64).sum(axis=1)
+    cumulative = np.concatenate(([0], np.cumsum(energy)))
+    frame_count = len(frames)
+
+    last_slice_start = seg_len - min_silence_len
+    starts = np.arange(0, last_slice_start + 1, seek_step, dtype=np.int64)
+    if last_slice_start % seek_step:
+        starts = np.append(starts, last_slice_start)
+
+    first = np.minimum((starts * frame_rate / 1000.0).astype(np.int64), frame_count)
+    last = (starts + min_silence_len) * frame_rate / 1000.0
+    count = (last.astype(np.int64) - first) * frames.shape[1]
+    last = np.minimum(last.astype(np.int64), frame_count)
+
+    sum_squares = (cumulative[last] - cumulative[first]).astype(np.float64)
+    mean_squares = np.divide(sum_squares, count, out=np.zeros_like(sum_squares), where=count > 0)
+    rms = np.sqrt(mean_squares)
+    if np.issubdtype(frames.dtype, np.integer):
+        rms = np.floor(rms)
+
+    threshold = db_to_float(silence_thresh) * max_amplitude
+    silence_starts = starts[rms <= threshold]
+    if len(silence_starts) == 0:
+        return [[0, seg_len]]
+
+    gaps = np.diff(silence_starts)
+    breaks = np.flatnonzero((gaps != seek_step) & (gaps > min_silence_len))
+    range_starts = silence_starts[np.concatenate(([0], breaks + 1))]
+    range_ends = silence_starts[np.concatenate((breaks, [len(silence_starts) - 1]))] + min_silence_len
+
+    if range_starts[0] == 0 and range_ends[0] == seg_len:
+        return []
+
+    ranges = []
+    prev_end = 0
+    for start, end in zip(range_starts.tolist(), range_ends.tolist()):
+        ranges.append([prev_end, start])
+        prev_end = end
+    if prev_end != seg_len:
+        ranges.append([prev_end, seg_len])
+    if ranges[0] == [0, 0]:
+        ranges.pop(0)
+    return ranges
+
+@timed("silence_detection")
+def detect_nonsilent_ranges(audio, min_silence_len=1000, silence_thresh=-16, seek_step=1):
+    if SILENCE_DETECTOR == "pydub":
+        return silence.detect_nonsilent(audio, min_silence_len=min_silence_len, silence_thresh=silence_thresh, seek_step=seek_step)
+
+    return nonsilent_ranges(
+        pcm_frames(audio),
+        audio.frame_rate,
+        audio.max_possible_amplitude,
+        len(audio),
+        min_silence_len=min_silence_len,
+        silence_thresh=silence_thresh,
+        seek_step=seek_step
+    )
+
+SPLIT_ENGINE = os.environ.get("SPLIT_ENGINE", "silence")
+SPLIT_MIN_CHUNK_MS = int(os.environ.get("SPLIT_MIN_CHUNK_MS", 1000))
+SPLIT_MAX_CHUNK_MS = int(os.environ.get("SPLIT_MAX_CHUNK_MS", 30000))
+SPLIT_OVERLAP_MS = int(os.environ.get("SPLIT_OVERLAP_MS", 1000))
+VAD_FRAME_MS = int(os.environ.get("VAD_FRAME_MS", 20))
+VAD_ENERGY_MARGIN_DB = float(os.environ.get("VAD_ENERGY_MARGIN_DB", 12))
+VAD_FLATNESS = float(os.environ.get("VAD_FLATNESS", 0.45))
+VAD_BAND_RATIO = float(os.environ.get("VAD_BAND_RATIO", 0.5))
+VAD_MIN_SPEECH_MS = int(os.environ.get("VAD_MIN_SPEECH_MS", 100))
+VAD_PADDING_MS = int(os.environ.get("VAD_PADDING_MS", 100))
+
+def vad_features(audio, frame_ms=VAD_FRAME_MS, block_frames=3000):
+    samples = pcm_frames(audio)
+    frame_len = int(audio.frame_rate * frame_ms / 1000)
+    count = len(samples) // frame_len if frame_len else 0
+    energy = np.empty(count)
+    flatness = np.empty(count)
+    band_ratio = np.empty(count)
+
+    window = np.hanning(frame_len)
+    freqs = np.fft.rfftfreq(frame_len, 1.0 / audio.frame_rate)
+    band = (freqs >= 300) & (freqs <= 3400)
+    scale = float(audio.max_possible_amplitude)
+    for first in range(0, count, block_frames):
+        last = min(count, first + block_frames)
+        frames = samples[first * frame_len:last * frame_len].mean(axis=1, dtype=np.float64).reshape(-1, frame_len) / scale
+        energy[first:last] = 10 * np.log10(np.mean(np.square(frames), axis=1) + 1e-10)
+        spectrum = np.square(np.abs(np.fft.rfft(frames * window, axis=1))) + 1e-12
+        total = spectrum.sum(axis=1)
+        flatness[first:last] = np.exp(np.mean(np.log(spectrum), axis=1)) / (total / spectrum.shape[1])
+        band_ratio[first:last] = spectrum[:, band].sum(axis=1) / total
+    return energy, flatness, band_ratio
+
+def frame_runs(mask):
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+def limit_ranges(ranges, energy, frame_ms, min_ms=SPLIT_MIN_CHUNK_MS, max_ms=SPLIT_MAX_CHUNK_MS):
+    limited = []
+    for start_ms, end_ms in ranges:
+        while max_ms and end_ms - start_ms > max_ms:
+            first = (start_ms + max(min_ms, max_ms // 2)) // frame_ms
+            last = min((start_ms + max_ms) // frame_ms, len(energy))
+            cut = (first + int(np.argmin(energy[first:last]))) * frame_ms if last > first else start_ms + max_ms
+            limited.append([start_ms, cut])
+            start_ms = cut
+        limited.append([start_ms, end_ms])
+
+    merged = []
+    for start_ms, end_ms in limited:
+        if merged and (merged[-1][1] - merged[-1][0] < min_ms or end_ms - start_ms < min_ms) and (not max_ms or end_ms - merged[-1][0] <= max_ms):
+            merged[-1][1] = end_ms
+        else:
+            merged.append([start_ms, end_ms])
+    return merged
+
+def vad_ranges(audio, min_silence_len=1000, silence_thresh=-16, frame_ms=VAD_FRAME_MS, min_ms=SPLIT_MIN_CHUNK_MS, max_ms=SPLIT_MAX_CHUNK_MS):
+    energy, flatness, band_ratio = vad_features(audio, frame_ms)
+    if not len(energy):
+        return [[0, len(audio)]] if len(audio) else []
+
+    noise_floor = min(np.percentile(energy, 10), np.percentile(energy, 95) - 30)
+    voiced = (energy > noise_floor + VAD_ENERGY_MARGIN_DB) & ((flatness <= VAD_FLATNESS) | (band_ratio >= VAD_BAND_RATIO))
+
+    starts, ends = frame_runs(~voiced)
+    for start, end in zip(starts, ends):
+        if 0 < start and end < len(voiced) and (end - start) * frame_ms < min_silence_len:
+            voiced[start:end] = True
+
+    starts, ends = frame_runs(voiced)
+    keep = (ends - starts) * frame_ms >= VAD_MIN_SPEECH_MS
+    padding = VAD_PADDING_MS // frame_ms
+    ranges = []
+    for start, end in zip(starts[keep], ends[keep]):
+        start = max(int(start) - padding, ranges[-1][1] // frame_ms if ranges else 0)
+        end = min(int(end) + padding, len(voiced))
+        ranges.append([start * frame_ms, end * frame_ms])
+    if ranges and ends[keep][-1] == len(voiced):
+        ranges[-1][1] = len(audio)
+
+    return limit_ranges(ranges, energy, frame_ms, min_ms=min_ms, max_ms=max_ms)
+
+def silence_ranges(audio, min_silence_len=1000, silence_thresh=-16):
+    return detect_nonsilent_ranges(audio, min_silence_len=min_silence_len, silence_thresh=audio.dBFS + silence_thresh)
+
+SPLIT_ENGINES = {
+    "silence": silence_ranges,
+    "vad": vad_ranges
+}
+
+def quietest_ms(frames, frame_rate, lo_ms, hi_ms, first_frame=0, bin_ms=10):
+    bin_len = max(1, int(frame_rate * bin_ms / 1000))
+    window = frames[max(0, int(lo_ms * frame_rate / 1000) - first_frame):max(0, int(hi_ms * frame_rate / 1000) - first_frame)]
+    count = len(window) // bin_len
+    if count == 0:
+        return lo_ms
+    energy = np.square(window[:count * bin_len], dtype=np.float64).sum(axis=1).reshape(count, bin_len).sum(axis=1)
+    return lo_ms + int(np.argmin(energy)) * bin_ms + bin_ms // 2
+
+def cut_long_range(start_ms, end_ms, quietest, max_ms=SPLIT_MAX_CHUNK_MS, overlap_ms=SPLIT_OVERLAP_MS):
+    pieces = []
+    half = overlap_ms // 2
+    while max_ms and end_ms - start_ms > max_ms:
+        cut = quietest(start_ms + max(max_ms // 2, overlap_ms), start_ms + max_ms - half)
+        pieces.append([start_ms, cut + half])
+        start_ms = cut - half
+    return pieces, start_ms
+
+def force_max_length(audio, ranges, max_ms=SPLIT_MAX_CHUNK_MS, overlap_ms=SPLIT_OVERLAP_MS):
+    if not max_ms:
+        return ranges
+
+    frames = pcm_frames(audio)
+
+    def quietest(lo_ms, hi_ms):
+        return quietest_ms(frames, audio.frame_rate, lo_ms, hi_ms)
+
+    limited = []
+    for start_ms, end_ms in ranges:
+        pieces, start_ms = cut_long_range(start_ms, end_ms, quietest, max_ms, overlap_ms)
+        if pieces:
+            print(f"Forced {len(pieces)} cuts in a {end_ms - pieces[0][0]} ms range without pauses", flush=True)
+        limited.extend(pieces)
+        limited.append([start_ms, end_ms])
+    return limited
+
+def split_ranges(audio, min_silence_len=1000, silence_thresh=-16, engine=SPLIT_ENGINE):
+    if engine not in SPLIT_ENGINES:
+        raise ValueError(f"Unknown split engine: {engine}")
+    ranges = SPLIT_ENGINES[engine](audio, min_silence_len=min_silence_len, silence_thresh=silence_thresh)
+    return force_max_length(audio, ranges)
+
+class StreamingSilenceSplitter:
+    # silence_thresh is relative to loudness_db, the dBFS of the whole input
+    # (see pcm_dbfs), so the cuts match detect_nonsilent_ranges on the same audio.
+    def __init__(self, frame_rate, channels, loudness_db, sample_width=2, min_silence_len=1000, silence_thresh=-16, max_ms=SPLIT_MAX_CHUNK_MS, overlap_ms=SPLIT_OVERLAP_MS):
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.min_silence_len = min_silence_len
+        self.silence_thresh = silence_thresh
+        self.max_ms = max_ms
+        self.overlap_ms = overlap_ms
+        self.max_amplitude = float(1 << (8 * sample_width - 1))
+        self.threshold = db_to_float(loudness_db + silence_thresh) * self.max_amplitude
+
+        self.frames = np.empty((0, channels), dtype=SAMPLE_DTYPES[sample_width])
+        self.frames_start = 0
+        self.frames_read = 0
+
+        self.bin_energy = np.empty(0, dtype=np.float64)
+        self.bin_count = np.empty(0, dtype=np.int64)
+        self.bins_start = 0
+        self.bins_end = 0
+        self.next_window = 0
+
+        self.silence = None
+        self.chunk_start = 0
+
+    def _frame(self, ms):
+        return int(ms * self.frame_rate / 1000.0)
+
+    def _add_bins(self, bins_end):
+        if bins_end <= self.bins_end:
+            return
+
+        edges = (np.arange(self.bins_end, bins_end + 1) * self.frame_rate / 1000.0).astype(np.int64)
+        local = np.minimum(edges, self.frames_read) - self.frames_start
+        segment = self.frames[local[0]:local[-1]]
+        cumulative = np.concatenate(([0], np.cumsum(np.square(segment, dtype=np.int64).sum(axis=1))))
+
+        self.bin_energy = np.concatenate((self.bin_energy, cumulative[local[1:] - local[0]] - cumulative[local[:-1] - local[0]]))
+        self.bin_count = np.concatenate((self.bin_count, np.diff(edges) * self.channels))
+        self.bins_end = bins_end
+
+    def _chunk(self, start_ms, end_ms):
+        first = self._frame(start_ms) - self.frames_start
+        last = self._frame(end_ms) - self.frames_start
+        return start_ms, end_ms, self.frames[first:last].copy()
+
+    def _quietest(self, lo_ms, hi_ms):
+        return quietest_ms(self.frames, self.frame_rate, lo_ms, hi_ms, first_frame=self.frames_start)
+
+    def _chunks(self, start_ms, end_ms):
+        pieces, start_ms = cut_long_range(start_ms, end_ms, self._quietest, self.max_ms, self.overlap_ms)
+        return [self._chunk(s, e) for s, e in pieces] + [self._chunk(start_ms, end_ms)]
+
+    def _force_split(self):
+        length = self.min_silence_len
+        open_start = self.silence[1] + length if self.silence is not None else self.chunk_start
+        pieces, open_start = cut_long_range(open_start, self.next_window, self._quietest, self.max_ms, self.overlap_ms)
+        if self.silence is not None:
+            self.silence[1] = open_start - length
+        else:
+            self.chunk_start = open_start
+        return [self._chunk(s, e) for s, e in pieces]
+
+    def _scan(self, last_start):
+        chunks = []
+        if last_start < self.next_window:
+            return chunks
+
+        length = self.min_silence_len
+        energy = np.concatenate(([0], np.cumsum(self.bin_energy)))
+        count = np.concatenate(([0], np.cumsum(self.bin_count)))
+        starts = np.arange(self.next_window, last_start + 1, dtype=np.int64)
+        rel = starts - self.bins_start
+        sums = energy[rel + length] - energy[rel]
+        counts = count[rel + length] - count[rel]
+        rms = np.floor(np.sqrt(np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)))
+
+        silent = starts[rms <= self.threshold]
+        if len(silent):
+            previous = np.concatenate(([self.silence[1] if self.silence else -length - 1], silent[:-1]))
+            for idx in np.flatnonzero(silent - previous > length).tolist():
+                start = int(silent[idx])
+                if self.silence is not None:
+                    self.chunk_start = int(previous[idx]) + length
+                if start > self.chunk_start:
+                    chunks.extend(self._chunks(self.chunk_start, start))
+                self.silence = [start, start]
+            self.silence[1] = int(silent[-1])
+
+        self.next_window = last_start + 1
+        chunks.extend(self._force_split())
+        drop = self.next_window - self.bins_start
+        self.bin_energy = self.bin_energy[drop:]
+        self.bin_count = self.bin_count[drop:]
+        self.bins_start = self.next_window
+
+        keep_from = self.silence[1] + length if self.silence is not None else self.chunk_start
+        trim = min(self._frame(keep_from), self.frames_read) - self.frames_start
+        if trim > 0:
+            self.frames = self.frames[trim:]
+            self.frames_start += trim
+        return chunks
+
+    def feed(self, frames):
+        self.frames = np.concatenate((self.frames, frames))
+        self.frames_read += len(frames)
+
+        bins_end = int(self.frames_read * 1000 // self.frame_rate)
+        while self._frame(bins_end + 1) <= self.frames_read:
+            bins_end += 1
+        while bins_end > self.bins_end and self._frame(bins_end) > self.frames_read:
+            bins_end -= 1
+        self._add_bins(bins_end)
+        return self._scan(self.bins_end - self.min_silence_len)
+
+    def finish(self):
+        seg_len = round(1000 * (self.frames_read / self.frame_rate))
+        if seg_len < self.min_silence_len:
+            return [self._chunk(0, seg_len)] if self.silence is None else []
+
+        self._add_bins(seg_len)
+        chunks = self._scan(seg_len - self.min_silence_len)
+        if self.silence is not None:
+            self.chunk_start = self.silence[1] + self.min_silence_len
+        if self.chunk_start != seg_len:
+            chunks.extend(self._chunks(self.chunk_start, seg_len))
+        return chunks
+
 def split_audio(input_file, output_dir="chunks", silence_thresh=-40, min_silence_len=500):
     if not os.path.isfile(input_file):
         raise FileNotFoundError(f"File not found: {input_file}")
 
     os.makedirs(output_dir, exist_ok=True)
 
-    audio = AudioSegment.from_file(input_file, format="mp3")
+    started = time.perf_counter()
+    with timed("decode"):
+        audio = AudioSegment.from_file(input_file, format="mp3")
 
-    nonsilent_ranges = silence.detect_nonsilent(
-        audio,
-        min_silence_len=min_silence_len,
-        silence_thresh=audio.dBFS + silence_thresh
-    )
+    ranges = split_ranges(audio, min_silence_len=min_silence_len, silence_thresh=silence_thresh)
 
     chunk_files = []
-    for idx, (start_ms, end_ms) in enumerate(nonsilent_ranges, start=1):
+    for idx, (start_ms, end_ms) in enumerate(ranges, start=1):
         chunk = audio[start_ms:end_ms]
         chunk_filename = os.path.join(output_dir, f"chunk_{idx}.mp3")
-        chunk.export(chunk_filename, format="mp3")
+        with timed("chunk_export"):
+            chunk.export(chunk_filename, format="mp3")
         chunk_files.append((chunk_filename, start_ms, end_ms))
         print(f"Saved: {chunk_filename}")
 
     print(f"Audio split complete: {len(chunk_files)} chunks created")
+    record_audio(len(audio) / 1000, time.perf_counter() - started)
     return chunk_files
 
+def clear_fan_in_state(bucket, result_dir):
+    stale = [DeleteObject(obj.object_name) for obj in minio_client.list_objects(bucket, prefix=f"locks/{result_dir}", recursive=True)]
+    for error in minio_client.remove_objects(bucket, stale):
+        print(f"Could not remove {error.name}: {error}", flush=True)
+
+def stream_pcm(input_file, frame_rate, channels, block_ms=1000):
+    frame_width = 2 * channels
+    block_bytes = frame_rate * block_ms // 1000 * frame_width
+    process = subprocess.Popen(
+        [AudioSegment.converter, "-loglevel", "error", "-i", input_file,
+         "-f", "s16le", "-ac", str(channels), "-ar", str(frame_rate), "pipe:1"],
+        stdout=subprocess.PIPE
+    )
+    try:
+        while True:
+            data = process.stdout.read(block_bytes)
+            if not data:
+                break
+            usable = len(data) - len(data) % frame_width
+            yield np.frombuffer(data[:usable], dtype=np.int16).reshape(-1, channels)
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to decode {input_file}")
+
+def pcm_dbfs(blocks, sample_width=2):
+    # Same value as AudioSegment.dBFS, accumulated block by block.
+    sum_squares = 0
+    samples = 0
+    for frames in blocks:
+        sum_squares += int(np.square(frames, dtype=np.int64).sum())
+        samples += frames.size
+    rms = int(np.sqrt(sum_squares / samples)) if samples else 0
+    return ratio_to_db(rms / float(1 << (8 * sample_width - 1))) if rms else -float("inf")
+
+def split_audio_stream(input_file, bucket, result_dir, key, etag="", version_id="", output_dir="chunks", silence_thresh=-40, min_silence_len=500, batch_size=STREAM_BATCH_SIZE):
+    if not os.path.isfile(input_file):
+        raise FileNotFoundError(f"File not found: {input_file}")
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    info = mediainfo(input_file)
+    frame_rate = int(info["sample_rate"])
+    channels = int(info["channels"])
+    with timed("loudness"):
+        loudness_db = pcm_dbfs(stream_pcm(input_file, frame_rate, channels, block_ms=STREAM_WINDOW_MS))
+    splitter = StreamingSilenceSplitter(frame_rate, channels, loudness_db, min_silence_len=min_silence_len, silence_thresh=silence_thresh)
+
+    state = {"shard": 0, "total": 0}
+    pending = []
+    uploads = []
+
+    def emit(chunks):
+        for start_ms, end_ms, frames in chunks:
+            state["total"] += 1
+            chunk_filename = os.path.join(output_dir, f"chunk_{state['total']}.mp3")
+            chunk = AudioSegment(data=frames.tobytes(), sample_width=2, frame_rate=frame_rate, channels=channels)
+            with timed("chunk_export"):
+                chunk.export(chunk_filename, format="mp3")
+            remote_path = f"{result_dir}chunks/{os.path.basename(chunk_filename)}"
+            pending.append([f"chunks/{os.path.basename(chunk_filename)}", remote_path, start_ms, end_ms])
+            uploads.append((remote_path, chunk_filename))
+            print(f"Saved: {chunk_filename}")
+            if len(pending) >= batch_size:
+                flush(final=False)
+
+    def flush(final):
+        timings = upload_objects(bucket, uploads)
+        for remote_path, elapsed in timings.items():
+            print(f"Chunk uploaded: {remote_path} ({elapsed * 1000:.0f} ms)", flush=True)
+
+        event_data = {
+            "bucket": bucket,
+            "result_dir": result_dir,
+            **chunk_manifest_fields(bucket, result_dir, list(pending), f"chunks_{state['shard']:05d}"),
+            "key": key,
+            "etag": etag,
+            "version_id": version_id,
+            "shard": state["shard"],
+            "final": final
+        }
+        if final:
+            event_data["total_chunks"] = state["total"]
+            event_data["total_shards"] = state["shard"] + 1
+        send_cloudevent(subject=event_subject(key, etag, state["shard"]), data=event_data)
+
+        state["shard"] += 1
+        pending.clear()
+        uploads.clear()
+
+    for frames in stream_pcm(input_file, frame_rate, channels, block_ms=STREAM_WINDOW_MS):
+        with timed("silence_detection"):
+            chunks = splitter.feed(frames)
+        emit(chunks)
+    emit(splitter.finish())
+    flush(final=True)
+    record_audio(float(info.get("duration", 0)), time.perf_counter() - started)
+
+    print(f"Done: {state['total']} audio files streamed in {state['shard']} events.")
+    return state["total"]
+
+CHUNK_MANIFEST = os.environ.get("CHUNK_MANIFEST", "compact")
+CHUNK_MANIFEST_INLINE_BYTES = int(os.environ.get("CHUNK_MANIFEST_INLINE_BYTES", 16384))
+CHUNK_TEMPLATE = "chunks/chunk_{}.mp3"
+
+def pack_ints(values):
+    deltas = np.diff(np.asarray(values, dtype=np.int64), prepend=0).astype("<i4")
+    return base64.b64encode(zlib.compress(deltas.tobytes())).decode("ascii")
+
+def encode_chunk_manifest(result_dir, chunks, template=CHUNK_TEMPLATE):
+    prefix, suffix = template.split("{}")
+    indices = []
+    bounds = []
+    for local_name, remote_path, start_ms, end_ms in chunks:
+        index = local_name[len(prefix):len(local_name) - len(suffix)]
+        if not (local_name.startswith(prefix) and local_name.endswith(suffix) and index.isdigit() and remote_path == f"{result_dir}{local_name}"):
+            return None
+        indices.append(int(index))
+        bounds.extend((int(start_ms), int(end_ms)))
+
+    return {
+        "format": "delta-v1",
+        "template": template,
+        "count": len(chunks),
+        "indices": pack_ints(indices),
+        "bounds": pack_ints(bounds)
+    }
+
+def chunk_manifest_fields(bucket, result_dir, chunks, name="chunks"):
+    manifest = encode_chunk_manifest(result_dir, chunks) if CHUNK_MANIFEST == "compact" else None
+    if manifest is None:
+        return {"chunks": chunks}
+
+    data = json.dumps(manifest, separators=(",", ":")).encode("utf-8")
+    if len(data) <= CHUNK_MANIFEST_INLINE_BYTES:
+        return {"manifest": manifest}
+
+    object_name = f"{result_dir}manifests/{name}.json"
+    minio_client.put_object(bucket, object_name, io.BytesIO(data), len(data), content_type="application/json")
+    return {"manifest_ref": object_name}
+
+def manifest_object(result_dir):
+    return f"{result_dir}manifest.json"
+
+def completed_etag(bucket, result_dir):
+    try:
+        stat = minio_client.stat_object(bucket, manifest_object(result_dir))
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject"):
+            return None
+        raise
+    return stat.metadata.get("x-amz-meta-source-etag")
+
+def already_processed(bucket, result_dir, etag):
+    return bool(etag) and completed_etag(bucket, result_dir) == etag
+
+def event_subject(key, etag="", shard=None):
+    subject = f"{key}@{etag}" if etag else key
+    return subject if shard is None else f"{subject}#{shard}"
+
 def send_cloudevent(subject, data):
     broker_url = os.environ.get("K_SINK")
     
     if not broker_url:
         print("K_SINK environment variable is not set. CloudEvent will not be sent.", flush=True)
+        if ASYNC_MODE:
+            raise RuntimeError("K_SINK is not set")
         return
 
     headers = {
@@ -56,7 +734,8 @@ def send_cloudevent(subject, data):
         "ce-specversion": "1.0",
         "ce-type": "dev.knative.audio.chunks.ready",
         "ce-source": "audio-splitter-service",
-        "ce-id": subject
+        "ce-id": subject,
+        "ce-traceparent": next_traceparent()
     }
 
     try:
@@ -65,6 +744,229 @@ def send_cloudevent(subject, data):
         print(f"CloudEvent sent: {response.status_code}", flush=True)
     except requests.exceptions.RequestException as e:
         print(f"CloudEvent error: {e}", flush=True)
+        # An accepted event has already been acknowledged to the broker, so a
+        # failed publish must fail the run and leave its lease for replay.
+        if ASYNC_MODE:
+            raise
+
+
+def shard_chunks(chunks, shard_count):
+    shard_count = max(1, min(shard_count, len(chunks)))
+    size, extra = divmod(len(chunks), shard_count)
+    shards = []
+    start = 0
+    for shard in range(shard_count):
+        end = start + size + (1 if shard < extra else 0)
+        shards.append(chunks[start:end])
+        start = end
+    return shards
+
+def send_sharded_events(bucket, result_dir, key, chunks_event_list, shard_count, etag="", version_id=""):
+    shards = shard_chunks(chunks_event_list, shard_count)
+    for shard, shard_chunks_list in enumerate(shards):
+        event_data = {
+            "bucket": bucket,
+            "result_dir": result_dir,
+            **chunk_manifest_fields(bucket, result_dir, shard_chunks_list, f"chunks_{shard:05d}"),
+            "key": key,
+            "etag": etag,
+            "version_id": version_id,
+            "shard": shard,
+            "final": shard == len(shards) - 1,
+            "total_chunks": len(chunks_event_list),
+            "total_shards": len(shards)
+        }
+        send_cloudevent(subject=event_subject(key, etag, shard), data=event_data)
+
+
+REQUIRED_FIELDS = ["bucket", "key"]
+ASYNC_MODE = os.environ.get("ASYNC_MODE", "false").lower() == "true"
+
+EVENT_LEASE_SECONDS = int(os.environ.get("EVENT_LEASE_SECONDS", 900))
+EVENT_REPLAY_INTERVAL = int(os.environ.get("EVENT_REPLAY_INTERVAL", 60))
+EVENT_MAX_ATTEMPTS = int(os.environ.get("EVENT_MAX_ATTEMPTS", 5))
+EVENT_MARKER_PREFIX = f"locks/events/{SERVICE_NAME}/"
+
+active_leases = {}
+active_leases_lock = threading.Lock()
+
+def put_object_conditional(bucket, name, payload, etag=None):
+    url = minio_client.presigned_put_object(bucket, name, expires=timedelta(hours=1))
+    response = minio_http_client.request(
+        "PUT", url,
+        body=json.dumps(payload).encode("utf-8"),
+        headers={"If-Match": etag} if etag else {"If-None-Match": "*"},
+        retries=False
+    )
+    if response.status == 412:
+        return None
+    if response.status >= 300:
+        raise RuntimeError(f"Conditional put failed for {name}: HTTP {response.status}")
+    return response.headers.get("ETag", "")
+
+def object_exists(bucket, name):
+    try:
+        minio_client.stat_object(bucket, name)
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject"):
+            return False
+        raise
+    return True
+
+def read_marker(bucket, marker):
+    try:
+        response = minio_client.get_object(bucket, marker)
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject"):
+            return None, None
+        raise
+    try:
+        return json.loads(response.read()), response.headers.get("ETag")
+    finally:
+        response.close()
+        response.release_conn()
+
+def done_marker(marker):
+    return f"{marker[:-len('.json')]}.done"
+
+def failed_marker(marker):
+    return f"{marker[:-len('.json')]}.failed"
+
+def lease_expired(payload):
+    return payload.get("accepted_at", 0) + EVENT_LEASE_SECONDS < time.time()
+
+def hold_lease(bucket, marker, payload, etag):
+    with active_leases_lock:
+        active_leases[marker] = (bucket, payload, etag)
+
+def claim_event(bucket, marker, payload):
+    etag = put_object_conditional(bucket, marker, payload)
+    if etag is None:
+        current, current_etag = read_marker(bucket, marker)
+        if current is None:
+            etag = put_object_conditional(bucket, marker, payload)
+        elif lease_expired(current):
+            etag = put_object_conditional(bucket, marker, payload, current_etag)
+            if etag is not None:
+                print(f"Stale event lease taken over: {marker}", flush=True)
+    if etag is None:
+        return False
+    hold_lease(bucket, marker, payload, etag)
+    return True
+
+def release_event(bucket, marker):
+    with active_leases_lock:
+        active_leases.pop(marker, None)
+    minio_client.remove_object(bucket, marker)
+
+def retry_event(bucket, marker):
+    with active_leases_lock:
+        lease = active_leases.pop(marker, None)
+    if lease is None:
+        return
+
+    _, payload, etag = lease
+    attempts = payload.get("attempts", 0) + 1
+    if attempts >= EVENT_MAX_ATTEMPTS:
+        data = json.dumps({**payload, "attempts": attempts, "failed_at": time.time()}).encode("utf-8")
+        minio_client.put_object(bucket, failed_marker(marker), io.BytesIO(data), len(data), content_type="application/json")
+        minio_client.remove_object(bucket, marker)
+        print(f"Accepted event failed {attempts} times, dead-lettered: {failed_marker(marker)}", flush=True)
+        return
+
+    # Keep the lease but mark it expired so the next replay pass retries it.
+    payload = {**payload, "attempts": attempts, "accepted_at": time.time() - EVENT_LEASE_SECONDS}
+    if put_object_conditional(bucket, marker, payload, etag) is None:
+        print(f"Event lease lost before retry: {marker}", flush=True)
+    else:
+        print(f"Accepted event failed (attempt {attempts}/{EVENT_MAX_ATTEMPTS}), left for replay: {marker}", flush=True)
+
+def run_accepted(cloudevent, bucket, marker, traceparent=None):
+    status = 500
+    try:
+        body, status = handle_cloudevent(cloudevent, traceparent)
+        if status < 400:
+            data = json.dumps({"marker": marker, "completed_at": time.time()}).encode("utf-8")
+            minio_client.put_object(bucket, done_marker(marker), io.BytesIO(data), len(data), content_type="application/json")
+    finally:
+        if status < 400:
+            release_event(bucket, marker)
+        else:
+            retry_event(bucket, marker)
+
+def renew_leases():
+    with active_leases_lock:
+        leases = list(active_leases.items())
+    for marker, (bucket, payload, etag) in leases:
+        payload = {**payload, "accepted_at": time.time()}
+        etag = put_object_conditional(bucket, marker, payload, etag)
+        with active_leases_lock:
+            if marker not in active_leases:
+                continue
+            if etag is None:
+                active_leases.pop(marker)
+                print(f"Event lease lost: {marker}", flush=True)
+            else:
+                active_leases[marker] = (bucket, payload, etag)
+
+def replay_stale_events():
+    for bucket in minio_client.list_buckets():
+        for obj in minio_client.list_objects(bucket.name, prefix=EVENT_MARKER_PREFIX, recursive=True):
+            marker = obj.object_name
+            with active_leases_lock:
+                held = marker in active_leases
+            if held or not marker.endswith(".json"):
+                continue
+
+            current, etag = read_marker(bucket.name, marker)
+            if current is None or not lease_expired(current):
+                continue
+            if object_exists(bucket.name, done_marker(marker)):
+                minio_client.remove_object(bucket.name, marker)
+                continue
+
+            payload = {**current, "accepted_at": time.time()}
+            etag = put_object_conditional(bucket.name, marker, payload, etag)
+            if etag is None:
+                continue
+            hold_lease(bucket.name, marker, payload, etag)
+            if worker_pool.submit(run_accepted, current["event"], bucket.name, marker) is None:
+                with active_leases_lock:
+                    active_leases.pop(marker, None)
+                continue
+            print(f"Replaying unfinished event: {marker}", flush=True)
+
+def lease_keeper():
+    while True:
+        time.sleep(EVENT_REPLAY_INTERVAL)
+        try:
+            renew_leases()
+            replay_stale_events()
+        except Exception as e:
+            print(f"Event lease keeper error: {e}", flush=True)
+
+if ASYNC_MODE:
+    threading.Thread(target=lease_keeper, name="event-lease-keeper", daemon=True).start()
+
+def accept_event(cloudevent, event_id, traceparent=None):
+    event_data = cloudevent.get("data") if isinstance(cloudevent, dict) and "data" in cloudevent else cloudevent
+    missing = [field for field in REQUIRED_FIELDS if not isinstance(event_data, dict) or field not in event_data]
+    if missing:
+        return jsonify({"error": f"Missing fields: {', '.join(missing)}"}), 400
+
+    event_id = event_id or cloudevent.get("id") or event_data["key"]
+    bucket = event_data["bucket"]
+    marker = f"{EVENT_MARKER_PREFIX}{quote(event_id, safe='')}.json"
+
+    if object_exists(bucket, done_marker(marker)) or not claim_event(bucket, marker, {"id": event_id, "event": cloudevent, "accepted_at": time.time()}):
+        print(f"Duplicate event ignored: {event_id}", flush=True)
+        return jsonify({"message": "Duplicate event ignored", "id": event_id}), 200
+
+    if worker_pool.submit(run_accepted, cloudevent, bucket, marker, traceparent) is None:
+        release_event(bucket, marker)
+        return busy_response()
+
+    return jsonify({"message": "Accepted", "id": event_id}), 202
 
 
 @app.route('/', methods=['POST'])
@@ -72,44 +974,86 @@ def process_chunks():
     cloudevent = request.get_json()
     print("CloudEvent received:", cloudevent, flush=True)
 
+    if ASYNC_MODE:
+        return accept_event(cloudevent, request.headers.get("ce-id"), request.headers.get("ce-traceparent"))
+    return run_in_pool(handle_cloudevent, cloudevent, request.headers.get("ce-traceparent"))
+
+def handle_cloudevent(cloudevent, traceparent=None):
     try:
+        print(f"Trace: {start_trace(traceparent)}", flush=True)
         event_data = cloudevent.get("data") if isinstance(cloudevent, dict) and "data" in cloudevent else cloudevent
 
         bucket = event_data["bucket"]
         key = event_data["key"]
-        
-        temp_path = os.path.join(tempfile.gettempdir(), os.path.basename(key))
-        print(f"Temp path: {temp_path}", flush=True)
+        etag = event_data.get("etag", "")
+        version_id = event_data.get("version_id", "")
+
+        if already_processed(bucket, f"results/{os.path.splitext(os.path.basename(key))[0]}/", etag):
+            print(f"Already processed: {key} ({etag})", flush=True)
+            return {"message": "Already processed"}, 200
+
+        with work_directory() as work_dir:
+            temp_path = os.path.join(work_dir, os.path.basename(key))
+            chunk_dir = os.path.join(work_dir, "chunks")
+            print(f"Temp path: {temp_path}", flush=True)
+
+            with timed("download"):
+                minio_client.fget_object(bucket, key, temp_path)
+            print(f"File downloaded: {temp_path}", flush=True)
+
+            result_dir = f"results/{os.path.splitext(os.path.basename(key))[0]}/"
 
-        minio_client.fget_object(bucket, key, temp_path)
-        print(f"File downloaded: {temp_path}", flush=True)
+            if SPLIT_MODE == "stream" or TRANSCRIBE_SHARDS > 1:
+                clear_fan_in_state(bucket, result_dir)
 
-        chunks = split_audio(temp_path, output_dir="chunks", silence_thresh=-40, min_silence_len=700)
-        print(f"Chunks created: {len(chunks)}", flush=True)
+            if SPLIT_MODE == "stream":
+                total = split_audio_stream(temp_path, bucket, result_dir, key, etag=etag, version_id=version_id, output_dir=chunk_dir, silence_thresh=-40, min_silence_len=700)
+                print(f"Chunks created: {total}", flush=True)
+                return {"message": "Processing complete"}, 200
 
-        result_dir = f"results/{os.path.splitext(os.path.basename(key))[0]}/"
-        chunks_event_list = []
-        for chunk_file, start_ms, end_ms in chunks:
-            remote_path = f"{result_dir}chunks/{os.path.basename(chunk_file)}"
-            minio_client.fput_object(bucket, remote_path, chunk_file)
-            print(f"Chunk uploaded: {remote_path}", flush=True)
-            chunks_event_list.append([chunk_file, remote_path, start_ms, end_ms])
+            chunks = split_audio(temp_path, output_dir=chunk_dir, silence_thresh=-40, min_silence_len=700)
+            print(f"Chunks created: {len(chunks)}", flush=True)
+
+            chunks_event_list = []
+            uploads = []
+            for chunk_file, start_ms, end_ms in chunks:
+                remote_path = f"{result_dir}chunks/{os.path.basename(chunk_file)}"
+                chunks_event_list.append([f"chunks/{os.path.basename(chunk_file)}", remote_path, start_ms, end_ms])
+                uploads.append((remote_path, chunk_file))
+
+            timings = upload_objects(bucket, uploads)
+            for remote_path, elapsed in timings.items():
+                print(f"Chunk uploaded: {remote_path} ({elapsed * 1000:.0f} ms)", flush=True)
+
+        if TRANSCRIBE_SHARDS > 1:
+            send_sharded_events(bucket, result_dir, key, chunks_event_list, TRANSCRIBE_SHARDS, etag=etag, version_id=version_id)
+            return {"message": "Processing complete"}, 200
 
         event_data = {
             "bucket": bucket,
             "result_dir": result_dir,
-            "chunks": chunks_event_list,
-            "key": key
+            **chunk_manifest_fields(bucket, result_dir, chunks_event_list),
+            "key": key,
+            "etag": etag,
+            "version_id": version_id
         }
-        send_cloudevent(subject=key, data=event_data)
+        send_cloudevent(subject=event_subject(key, etag), data=event_data)
 
-        return jsonify({"message": "Processing complete"}), 200
+        return {"message": "Processing complete"}, 200
 
     except Exception as e:
         import traceback
         traceback.print_exc()
         print("Error:", e, flush=True)
-        return jsonify({"error": str(e)}), 500
+        return {"error": str(e)}, 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(worker_pool.stats())
 
 @app.route('/', methods=['GET'])
 def home():
@@ -117,4 +1061,8 @@ def home():
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
-    app.run(debug=False, host="0.0.0.0", port=port)
\ No newline at end of file
+    if SERVER == "waitress":
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=port, threads=WORKER_THREADS + WORKER_QUEUE_SIZE + 2)
+    else:
+        app.run(debug=False, host="0.0.0.0", port=port, threaded=True)
\ No newline at end of file
@@ -1,24 +1,469 @@
 import os
 import glob
 import re
-from flask import Flask, jsonify, request
+import bisect
+from flask import Flask, Response, jsonify, request
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+import secrets
 from pydub import AudioSegment, silence
+import numpy as np
 import whisper
+import torch
 from minio import Minio
+from minio.error import S3Error
 import tempfile
-from urllib.parse import unquote
+import base64
+import zlib
+import hashlib
+import io
+from datetime import timedelta
+import time
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from collections import OrderedDict
+from urllib.parse import quote, unquote
 import requests
 import json
 
-minio_client = Minio(
-    os.environ.get("MINIO_ENDPOINT", "minio.minio:9000"),
-    access_key=os.environ.get("MINIO_ACCESS_KEY", "minioadmin"),
-    secret_key=os.environ.get("MINIO_SECRET_KEY", "minioadmin"),
-    secure=False
+SERVICE_NAME = "audio-transcriber"
+
+STAGE_SECONDS = Histogram(
+    "audio_stage_seconds", "Wall time spent in each pipeline stage", ["service", "stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
+AUDIO_SECONDS = Counter("audio_processed_seconds_total", "Seconds of audio processed", ["service"])
+REALTIME_FACTOR = Histogram(
+    "audio_realtime_factor", "Processing wall time divided by audio duration", ["service"],
+    buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
 )
+WORKER_QUEUED = Gauge("worker_queued_requests", "Requests waiting for a worker thread", ["service"])
+WORKER_IN_FLIGHT = Gauge("worker_in_flight_requests", "Requests being processed by a worker thread", ["service"])
+WORKER_CAPACITY = Gauge("worker_capacity_requests", "Requests accepted before the service answers 429", ["service"])
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(SERVICE_NAME, stage).observe(time.perf_counter() - started)
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.labels(SERVICE_NAME, stage).observe(seconds)
+
+def record_audio(audio_seconds, elapsed):
+    if audio_seconds > 0:
+        AUDIO_SECONDS.labels(SERVICE_NAME).inc(audio_seconds)
+        REALTIME_FACTOR.labels(SERVICE_NAME).observe(elapsed / audio_seconds)
+
+trace_context = threading.local()
+
+def start_trace(traceparent=None):
+    parts = (traceparent or "").split("-")
+    trace_context.trace_id = parts[1] if len(parts) == 4 and len(parts[1]) == 32 else secrets.token_hex(16)
+    return trace_context.trace_id
+
+def next_traceparent():
+    trace_id = getattr(trace_context, "trace_id", None) or start_trace()
+    return f"00-{trace_id}-{secrets.token_hex(8)}-01"
+
+MINIO_CONCURRENCY = int(os.environ.get("MINIO_CONCURRENCY", 8))
+MINIO_RETRIES = int(os.environ.get("MINIO_RETRIES", 3))
+MINIO_RETRY_BACKOFF = float(os.environ.get("MINIO_RETRY_BACKOFF", 0.5))
+
+def minio_connection(retries):
+    http_client = urllib3.PoolManager(
+        maxsize=MINIO_CONCURRENCY,
+        timeout=urllib3.Timeout(connect=10, read=300),
+        retries=retries
+    )
+    client = Minio(
+        os.environ.get("MINIO_ENDPOINT", "minio.minio:9000"),
+        access_key=os.environ.get("MINIO_ACCESS_KEY", "minioadmin"),
+        secret_key=os.environ.get("MINIO_SECRET_KEY", "minioadmin"),
+        secure=False,
+        http_client=http_client
+    )
+    return client, http_client
+
+minio_client, minio_http_client = minio_connection(
+    urllib3.Retry(total=MINIO_RETRIES, backoff_factor=MINIO_RETRY_BACKOFF, status_forcelist=[500, 502, 503, 504])
+)
+# Bulk object transfers retry whole objects in transfer_object, so their
+# connection must not retry underneath it.
+transfer_client, _ = minio_connection(False)
+
+def transfer_object(transfer, bucket, object_name, file_path, retries=MINIO_RETRIES, backoff=MINIO_RETRY_BACKOFF):
+    for attempt in range(retries + 1):
+        started = time.perf_counter()
+        try:
+            transfer(bucket, object_name, file_path)
+            return time.perf_counter() - started
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            print(f"Transfer failed: {object_name} ({e}), retrying in {delay:.1f}s", flush=True)
+            time.sleep(delay)
+
+def transfer_objects(transfer, bucket, items, concurrency=MINIO_CONCURRENCY):
+    timings = {}
+    if not items:
+        return timings
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items)))) as executor:
+        futures = {
+            executor.submit(transfer_object, transfer, bucket, object_name, file_path): object_name
+            for object_name, file_path in items
+        }
+        for future in as_completed(futures):
+            timings[futures[future]] = future.result()
+    return timings
+
+@timed("download")
+def download_objects(bucket, items, concurrency=MINIO_CONCURRENCY):
+    for _, file_path in items:
+        if os.path.dirname(file_path):
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    return transfer_objects(transfer_client.fget_object, bucket, items, concurrency=concurrency)
 
 app = Flask(__name__)
 
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 1))
+WORKER_QUEUE_SIZE = int(os.environ.get("WORKER_QUEUE_SIZE", 4))
+RETRY_AFTER_SECONDS = int(os.environ.get("RETRY_AFTER_SECONDS", 30))
+SERVER = os.environ.get("SERVER", "waitress")
+
+class WorkerPool:
+    def __init__(self, workers=1, queue_size=4):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+
+    def submit(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            return None
+
+        with self.lock:
+            self.queued += 1
+
+        def run():
+            with self.lock:
+                self.queued -= 1
+                self.in_flight += 1
+            try:
+                return fn(*args)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+                self.slots.release()
+
+        return self.executor.submit(run)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": self.queued,
+                "in_flight": self.in_flight,
+                "workers": self.workers,
+                "capacity": self.capacity
+            }
+
+worker_pool = WorkerPool(workers=WORKER_THREADS, queue_size=WORKER_QUEUE_SIZE)
+WORKER_QUEUED.labels(SERVICE_NAME).set_function(lambda: worker_pool.stats()["queued"])
+WORKER_IN_FLIGHT.labels(SERVICE_NAME).set_function(lambda: worker_pool.stats()["in_flight"])
+WORKER_CAPACITY.labels(SERVICE_NAME).set(worker_pool.capacity)
+
+def busy_response():
+    response = jsonify({"error": "Server busy", **worker_pool.stats()})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+    return response
+
+def run_in_pool(fn, *args):
+    future = worker_pool.submit(fn, *args)
+    if future is None:
+        return busy_response()
+    body, status = future.result()
+    return jsonify(body), status
+
+WHISPER_DEVICE = os.environ.get("WHISPER_DEVICE", "cpu")
+WHISPER_PRELOAD = [s.strip() for s in os.environ.get("WHISPER_PRELOAD", "").split(",") if s.strip()]
+WHISPER_MAX_MODELS = int(os.environ.get("WHISPER_MAX_MODELS", 2))
+WHISPER_MAX_MEMORY_MB = int(os.environ.get("WHISPER_MAX_MEMORY_MB", 0))
+WHISPER_BATCH_SIZE = int(os.environ.get("WHISPER_BATCH_SIZE", 1))
+WHISPER_PACK_MS = int(os.environ.get("WHISPER_PACK_MS", 0))
+WHISPER_PACK_GAP_MS = int(os.environ.get("WHISPER_PACK_GAP_MS", 300))
+
+WHISPER_BACKEND = os.environ.get("WHISPER_BACKEND", "torch")
+WHISPER_COMPUTE_TYPE = os.environ.get("WHISPER_COMPUTE_TYPE", "int8")
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", 0))
+TORCH_INTEROP_THREADS = int(os.environ.get("TORCH_INTEROP_THREADS", 0))
+
+if TORCH_THREADS:
+    torch.set_num_threads(TORCH_THREADS)
+if TORCH_INTEROP_THREADS:
+    torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+
+class FasterWhisperModel:
+    def __init__(self, model_size, device="cpu", compute_type=WHISPER_COMPUTE_TYPE, cpu_threads=TORCH_THREADS):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError:
+            raise RuntimeError("WHISPER_BACKEND=faster-whisper requires the faster-whisper package")
+        self.model = WhisperModel(model_size, device=device, compute_type=compute_type, cpu_threads=cpu_threads)
+        self.device = torch.device(device)
+
+    def transcribe(self, audio, language=None, word_timestamps=False, **kwargs):
+        segments, _ = self.model.transcribe(
+            np.asarray(audio, dtype=np.float32), language=language, beam_size=1, word_timestamps=word_timestamps
+        )
+        segments = [
+            {
+                "text": segment.text,
+                "start": segment.start,
+                "end": segment.end,
+                "words": [{"word": word.word, "start": word.start, "end": word.end} for word in segment.words or []]
+            }
+            for segment in segments
+        ]
+        return {"text": "".join(segment["text"] for segment in segments), "segments": segments}
+
+def quantize_int8(model):
+    # whisper subclasses nn.Linear, and quantize_dynamic only swaps exact
+    # nn.Linear modules.
+    for module in model.modules():
+        if isinstance(module, torch.nn.Linear):
+            module.__class__ = torch.nn.Linear
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_whisper_model(model_size, device="cpu", backend=WHISPER_BACKEND):
+    if backend == "faster-whisper":
+        return FasterWhisperModel(model_size, device=device)
+    if backend not in ("torch", "int8"):
+        raise ValueError(f"Unknown whisper backend: {backend}")
+
+    model = whisper.load_model(model_size, device=device)
+    if backend == "int8":
+        if device != "cpu":
+            raise ValueError("WHISPER_BACKEND=int8 requires WHISPER_DEVICE=cpu")
+        model = quantize_int8(model)
+    return model
+
+def tensor_bytes(value):
+    if torch.is_tensor(value):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(tensor_bytes(item) for item in value)
+    return 0
+
+def model_bytes(model):
+    if isinstance(model, FasterWhisperModel):
+        return 0
+    return sum(tensor_bytes(value) for value in model.state_dict().values())
+
+class ModelRegistry:
+    def __init__(self, max_models=2, max_memory_mb=0, device="cpu", backend=WHISPER_BACKEND):
+        self.max_models = max_models
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self.device = device
+        self.backend = backend
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        model = self._models.get(key)
+        if model is not None:
+            self._models.move_to_end(key)
+        return model
+
+    def _evict(self):
+        while self._models and (
+            (self.max_models and len(self._models) > self.max_models)
+            or (self.max_memory and sum(self._sizes.values()) > self.max_memory and len(self._models) > 1)
+        ):
+            key, _ = self._models.popitem(last=False)
+            self._sizes.pop(key, None)
+            print(f"Model evicted: {key[0]} ({key[1]}, {key[2]})", flush=True)
+
+    def model_id(self, model_size):
+        return model_size if self.backend == "torch" else f"{model_size}-{self.backend}"
+
+    def get(self, model_size, device=None):
+        key = (model_size, device or self.device, self.backend)
+
+        with self._lock:
+            model = self._lookup(key)
+            if model is not None:
+                return model
+            load_lock = self._loading.setdefault(key, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                model = self._lookup(key)
+                if model is not None:
+                    return model
+
+            with timed("model_load"):
+                model = load_whisper_model(key[0], device=key[1], backend=key[2])
+            size = model_bytes(model)
+            print(f"Model loaded: {key[0]} ({key[1]}, {key[2]}, {size // (1024 * 1024)} MB)", flush=True)
+
+            with self._lock:
+                self._models[key] = model
+                self._sizes[key] = size
+                self._loading.pop(key, None)
+                self._evict()
+
+        return model
+
+    def preload(self, model_sizes):
+        for model_size in model_sizes:
+            self.get(model_size)
+
+model_registry = ModelRegistry(
+    max_models=WHISPER_MAX_MODELS,
+    max_memory_mb=WHISPER_MAX_MEMORY_MB,
+    device=WHISPER_DEVICE,
+    backend=WHISPER_BACKEND
+)
+model_registry.preload(WHISPER_PRELOAD)
+
+WORK_ROOT = os.environ.get("WORK_ROOT") or None
+
+def work_directory():
+    return tempfile.TemporaryDirectory(prefix="audio-transcriber-", dir=WORK_ROOT)
+
+TRANSCRIPT_CACHE = os.environ.get("TRANSCRIPT_CACHE", "true").lower() == "true"
+TRANSCRIPT_CACHE_DIR = os.environ.get("TRANSCRIPT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "transcript-cache"))
+TRANSCRIPT_CACHE_MAX_MB = int(os.environ.get("TRANSCRIPT_CACHE_MAX_MB", 256))
+TRANSCRIPT_CACHE_BUCKET = os.environ.get("TRANSCRIPT_CACHE_BUCKET", "")
+
+class TranscriptCache:
+    def __init__(self, directory, max_mb=256, bucket=""):
+        self.directory = directory
+        self.max_bytes = max_mb * 1024 * 1024
+        self.bucket = bucket
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        for name in os.listdir(directory):
+            if name.endswith(".txt"):
+                stat = os.stat(os.path.join(directory, name))
+                existing.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(existing):
+            self._entries[key] = size
+            self._size += size
+
+    def key(self, audio, model_size, language):
+        digest = hashlib.sha256(f"{model_size}:{language}:".encode("utf-8"))
+        digest.update(np.ascontiguousarray(audio, dtype=np.float32).data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.txt")
+
+    def _store(self, key, text):
+        data = text.encode("utf-8")
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=f"{key}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self._lock:
+            self._size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                evicted, size = self._entries.popitem(last=False)
+                self._size -= size
+                try:
+                    os.remove(self._path(evicted))
+                except FileNotFoundError:
+                    pass
+
+    def get(self, key):
+        with self._lock:
+            cached = key in self._entries
+            if cached:
+                self._entries.move_to_end(key)
+
+        if cached:
+            try:
+                with open(self._path(key), encoding="utf-8") as f:
+                    text = f.read()
+                os.utime(self._path(key))
+                with self._lock:
+                    self.hits += 1
+                return text
+            except FileNotFoundError:
+                pass
+
+        if self.bucket:
+            # The shared tier is best-effort: any MinIO failure is a miss.
+            text = None
+            try:
+                response = minio_client.get_object(self.bucket, f"cache/transcripts/{key}.txt")
+                try:
+                    text = response.read().decode("utf-8")
+                finally:
+                    response.close()
+                    response.release_conn()
+            except S3Error as e:
+                if e.code not in ("NoSuchKey", "NoSuchObject"):
+                    print(f"Shared transcript cache unavailable: {e}", flush=True)
+            except Exception as e:
+                print(f"Shared transcript cache unavailable: {e}", flush=True)
+            if text is not None:
+                self._store(key, text)
+                with self._lock:
+                    self.hits += 1
+                    self.shared_hits += 1
+                return text
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, text):
+        self._store(key, text)
+        if self.bucket:
+            data = text.encode("utf-8")
+            try:
+                minio_client.put_object(self.bucket, f"cache/transcripts/{key}.txt", io.BytesIO(data), len(data), content_type="text/plain")
+            except Exception as e:
+                print(f"Shared transcript cache write failed: {e}", flush=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._size
+            }
+
+transcript_cache = TranscriptCache(TRANSCRIPT_CACHE_DIR, TRANSCRIPT_CACHE_MAX_MB, TRANSCRIPT_CACHE_BUCKET) if TRANSCRIPT_CACHE else None
+
 def format_timestamp(ms):
     hours = ms // (3600 * 1000)
     ms -= hours * 3600 * 1000
@@ -28,16 +473,198 @@ def format_timestamp(ms):
     ms -= seconds * 1000
     return f"{hours:02}:{minutes:02}:{seconds:02},{ms:03}"
 
-def transcribe_chunks(chunk_files, output_srt="output.txt", model_size="base"):
-    model = whisper.load_model(model_size)
+# model.transcribe's defaults for its first, temperature-0 pass over a window.
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+NO_SPEECH_THRESHOLD = 0.6
+
+def window_mel(model, audio):
+    # Same features transcribe uses: padded before the log-mel, then trimmed.
+    mel = whisper.log_mel_spectrogram(audio, model.dims.n_mels, padding=whisper.audio.N_SAMPLES)
+    return whisper.pad_or_trim(mel[:, :mel.shape[-1] - whisper.audio.N_FRAMES], whisper.audio.N_FRAMES)
+
+def batched_text(result, timestamp_begin):
+    # Returns None where transcribe would not stop at this decode: a result it
+    # would retry at a higher temperature, or a window it would seek into.
+    silent = result.no_speech_prob > NO_SPEECH_THRESHOLD
+    needs_fallback = result.compression_ratio > COMPRESSION_RATIO_THRESHOLD or result.avg_logprob < LOGPROB_THRESHOLD
+    if silent and result.avg_logprob < LOGPROB_THRESHOLD:
+        needs_fallback = False
+    if needs_fallback:
+        return None
+    if silent and not result.avg_logprob > LOGPROB_THRESHOLD:
+        return ""
+
+    timestamps = [token >= timestamp_begin for token in result.tokens]
+    consecutive = any(a and b for a, b in zip(timestamps, timestamps[1:]))
+    if consecutive and timestamps[-2:] != [False, True]:
+        return None
+    return result.text.strip()
+
+def transcribe_batched(model, chunk_audios, batch_size=8, language="en"):
+    fp16 = model.device.type != "cpu"
+    options = whisper.DecodingOptions(language=language, temperature=0.0, fp16=fp16)
+    tokenizer = whisper.tokenizer.get_tokenizer(
+        model.is_multilingual, num_languages=model.num_languages, language=language, task=options.task
+    )
+
+    texts = [None] * len(chunk_audios)
+    pending = []
+    retry = []
+    for idx, chunk_audio in enumerate(chunk_audios):
+        audio = whisper.load_audio(chunk_audio) if isinstance(chunk_audio, str) else chunk_audio
+        if audio.shape[-1] > whisper.audio.N_SAMPLES:
+            retry.append((idx, audio))
+        else:
+            pending.append((idx, audio))
+
+    for offset in range(0, len(pending), batch_size):
+        batch = pending[offset:offset + batch_size]
+        started = time.perf_counter()
+        mels = torch.stack([window_mel(model, audio) for _, audio in batch]).to(model.device)
+        results = whisper.decode(model, mels, options)
+        elapsed = (time.perf_counter() - started) / len(batch)
+        for (idx, audio), result in zip(batch, results):
+            texts[idx] = batched_text(result, tokenizer.timestamp_begin)
+            if texts[idx] is None:
+                retry.append((idx, audio))
+            observe_stage("inference", elapsed)
+
+    for idx, audio in retry:
+        with timed("inference"):
+            texts[idx] = model.transcribe(audio, language=language, fp16=fp16)["text"].strip()
+
+    return texts
+
+def pack_windows(lengths, max_samples, gap_samples):
+    windows = []
+    current = []
+    size = 0
+    for idx, length in enumerate(lengths):
+        added = length + (gap_samples if current else 0)
+        if current and size + added > max_samples:
+            windows.append(current)
+            current = []
+            size = 0
+            added = length
+        current.append(idx)
+        size += added
+    if current:
+        windows.append(current)
+    return windows
+
+def transcribe_packed(model, chunk_audios, max_ms=30000, gap_ms=WHISPER_PACK_GAP_MS, language="en"):
+    sample_rate = whisper.audio.SAMPLE_RATE
+    gap = np.zeros(sample_rate * gap_ms // 1000, dtype=np.float32)
+    windows = pack_windows([len(audio) for audio in chunk_audios], sample_rate * max_ms // 1000, len(gap))
+
+    texts = [""] * len(chunk_audios)
+    for window in windows:
+        parts = []
+        bounds = []
+        offset = 0
+        for idx in window:
+            if parts:
+                parts.append(gap)
+                offset += len(gap)
+            parts.append(np.asarray(chunk_audios[idx], dtype=np.float32))
+            bounds.append((offset / sample_rate, (offset + len(parts[-1])) / sample_rate))
+            offset += len(parts[-1])
+
+        with timed("inference"):
+            result = model.transcribe(np.concatenate(parts), language=language, word_timestamps=len(window) > 1)
+        if len(window) == 1:
+            texts[window[0]] = result["text"].strip()
+            continue
+
+        cuts = [(bounds[pos][1] + bounds[pos + 1][0]) / 2 for pos in range(len(bounds) - 1)]
+        pieces = [[] for _ in window]
+        for segment in result["segments"]:
+            for word in segment.get("words") or [segment]:
+                text = word.get("word", word.get("text", ""))
+                pieces[bisect.bisect_right(cuts, (word["start"] + word["end"]) / 2)].append(text)
+        for idx, words in zip(window, pieces):
+            texts[idx] = " ".join("".join(words).split())
+
+    print(f"Packed {len(chunk_audios)} chunks into {len(windows)} windows", flush=True)
+    return texts
+
+@timed("decode")
+def load_chunk_audio(chunk):
+    return whisper.load_audio(chunk) if isinstance(chunk, str) else chunk
+
+OVERLAP_DEDUP_WORDS = int(os.environ.get("OVERLAP_DEDUP_WORDS", 8))
+
+def normalize_word(word):
+    return re.sub(r"[^\w']", "", word.lower())
+
+def dedup_overlap(previous_text, text, max_words=OVERLAP_DEDUP_WORDS):
+    words = text.split()
+    tail = [normalize_word(word) for word in previous_text.split()[-max_words:]]
+    head = [normalize_word(word) for word in words[:max_words]]
+    for size in range(min(len(tail), len(head)), 0, -1):
+        if tail[-size:] == head[:size] and any(head[:size]):
+            return " ".join(words[size:])
+    return text
+
+def transcribe_group(model, audios, batch_size=WHISPER_BATCH_SIZE, language="en", pack_ms=WHISPER_PACK_MS):
+    if pack_ms > 0:
+        return transcribe_packed(model, audios, max_ms=pack_ms, language=language)
+    if batch_size > 1 and not isinstance(model, FasterWhisperModel):
+        return transcribe_batched(model, audios, batch_size=batch_size, language=language)
+
+    results = []
+    for audio in audios:
+        with timed("inference"):
+            results.append(model.transcribe(audio, language=language)["text"].strip())
+    return results
+
+def transcribe_texts(chunks, model_size="base", batch_size=WHISPER_BATCH_SIZE, language="en", pack_ms=WHISPER_PACK_MS):
+    model = model_registry.get(model_size)
+    texts = [None] * len(chunks)
+    pending = []
+
+    def group_full():
+        if pack_ms > 0:
+            return sum(len(audio) for _, _, audio in pending) >= whisper.audio.SAMPLE_RATE * pack_ms // 1000
+        return len(pending) >= max(1, batch_size)
+
+    def flush():
+        results = transcribe_group(model, [audio for _, _, audio in pending], batch_size=batch_size, language=language, pack_ms=pack_ms)
+        for (idx, key, _), text in zip(pending, results):
+            texts[idx] = text
+            if key is not None:
+                transcript_cache.put(key, text)
+        pending.clear()
+
+    # Chunks are decoded, hashed and looked up one at a time; only cache
+    # misses are held, and only until their group is transcribed.
+    for idx, chunk in enumerate(chunks):
+        audio = load_chunk_audio(chunk)
+        key = None
+        if transcript_cache is not None:
+            key = transcript_cache.key(audio, model_registry.model_id(model_size), language)
+            texts[idx] = transcript_cache.get(key)
+            if texts[idx] is not None:
+                continue
+        pending.append((idx, key, audio))
+        if group_full():
+            flush()
+    if pending:
+        flush()
+    return texts
+
+def transcribe_chunks(chunk_files, output_srt="output.txt", model_size="base", batch_size=WHISPER_BATCH_SIZE, language="en", pack_ms=WHISPER_PACK_MS):
+    started = time.perf_counter()
+    texts = transcribe_texts([c[0] for c in chunk_files], model_size=model_size, batch_size=batch_size, language=language, pack_ms=pack_ms)
 
     with open(output_srt, "w", encoding="utf-8") as f:
         for idx, (chunk_filename, start_ms, end_ms) in enumerate(chunk_files, start=1):
             start = format_timestamp(start_ms)
             end = format_timestamp(end_ms)
-
-            result = model.transcribe(chunk_filename, language="en")
-            text = result["text"].strip()
+            text = texts[idx - 1]
+            if idx > 1 and start_ms < chunk_files[idx - 2][2]:
+                text = dedup_overlap(texts[idx - 2], text)
 
             f.write(f"{idx}\n")
             f.write(f"{start} --> {end}\n")
@@ -45,13 +672,66 @@ def transcribe_chunks(chunk_files, output_srt="output.txt", model_size="base"):
 
             print(f"Transcribed: {chunk_filename} → {text}")
 
+    if transcript_cache is not None:
+        print(f"Transcript cache: {transcript_cache.stats()}")
+    record_audio(sum(end_ms - start_ms for _, start_ms, end_ms in chunk_files) / 1000, time.perf_counter() - started)
     print(f"Transcription complete: {output_srt}")
 
+CHUNK_FIELDS = ("chunks", "manifest", "manifest_ref")
+
+def unpack_ints(data):
+    deltas = np.frombuffer(zlib.decompress(base64.b64decode(data)), dtype="<i4")
+    return np.cumsum(deltas, dtype=np.int64).tolist()
+
+def decode_chunk_manifest(result_dir, manifest):
+    indices = unpack_ints(manifest["indices"])
+    bounds = unpack_ints(manifest["bounds"])
+    chunks = []
+    for position, index in enumerate(indices):
+        local_name = manifest["template"].format(index)
+        chunks.append([local_name, f"{result_dir}{local_name}", bounds[2 * position], bounds[2 * position + 1]])
+    return chunks
+
+def read_chunk_manifest(bucket, event_data):
+    if "chunks" in event_data:
+        return event_data["chunks"]
+
+    manifest = event_data.get("manifest")
+    if manifest is None:
+        response = minio_client.get_object(bucket, event_data["manifest_ref"])
+        try:
+            manifest = json.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
+    return decode_chunk_manifest(event_data["result_dir"], manifest)
+
+def manifest_object(result_dir):
+    return f"{result_dir}manifest.json"
+
+def completed_etag(bucket, result_dir):
+    try:
+        stat = minio_client.stat_object(bucket, manifest_object(result_dir))
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject"):
+            return None
+        raise
+    return stat.metadata.get("x-amz-meta-source-etag")
+
+def already_processed(bucket, result_dir, etag):
+    return bool(etag) and completed_etag(bucket, result_dir) == etag
+
+def event_subject(key, etag="", shard=None):
+    subject = f"{key}@{etag}" if etag else key
+    return subject if shard is None else f"{subject}#{shard}"
+
 def send_cloudevent(subject, data):
     broker_url = os.environ.get("K_SINK")
     
     if not broker_url:
         print("K_SINK environment variable is not set. CloudEvent will not be sent.", flush=True)
+        if ASYNC_MODE:
+            raise RuntimeError("K_SINK is not set")
         return
 
     headers = {
@@ -59,7 +739,8 @@ def send_cloudevent(subject, data):
         "ce-specversion": "1.0",
         "ce-type": "dev.knative.audio.chunk.processed",
         "ce-source": "audio-splitter-service",
-        "ce-id": subject
+        "ce-id": subject,
+        "ce-traceparent": next_traceparent()
     }
 
     try:
@@ -68,6 +749,202 @@ def send_cloudevent(subject, data):
         print(f"CloudEvent sent: {response.status_code}", flush=True)
     except requests.exceptions.RequestException as e:
         print(f"CloudEvent error: {e}", flush=True)
+        # An accepted event has already been acknowledged to the broker, so a
+        # failed publish must fail the run and leave its lease for replay.
+        if ASYNC_MODE:
+            raise
+
+
+REQUIRED_FIELDS = ["bucket", "result_dir", "key"]
+ASYNC_MODE = os.environ.get("ASYNC_MODE", "false").lower() == "true"
+
+EVENT_LEASE_SECONDS = int(os.environ.get("EVENT_LEASE_SECONDS", 900))
+EVENT_REPLAY_INTERVAL = int(os.environ.get("EVENT_REPLAY_INTERVAL", 60))
+EVENT_MAX_ATTEMPTS = int(os.environ.get("EVENT_MAX_ATTEMPTS", 5))
+EVENT_MARKER_PREFIX = f"locks/events/{SERVICE_NAME}/"
+
+active_leases = {}
+active_leases_lock = threading.Lock()
+
+def put_object_conditional(bucket, name, payload, etag=None):
+    url = minio_client.presigned_put_object(bucket, name, expires=timedelta(hours=1))
+    response = minio_http_client.request(
+        "PUT", url,
+        body=json.dumps(payload).encode("utf-8"),
+        headers={"If-Match": etag} if etag else {"If-None-Match": "*"},
+        retries=False
+    )
+    if response.status == 412:
+        return None
+    if response.status >= 300:
+        raise RuntimeError(f"Conditional put failed for {name}: HTTP {response.status}")
+    return response.headers.get("ETag", "")
+
+def object_exists(bucket, name):
+    try:
+        minio_client.stat_object(bucket, name)
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject"):
+            return False
+        raise
+    return True
+
+def read_marker(bucket, marker):
+    try:
+        response = minio_client.get_object(bucket, marker)
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject"):
+            return None, None
+        raise
+    try:
+        return json.loads(response.read()), response.headers.get("ETag")
+    finally:
+        response.close()
+        response.release_conn()
+
+def done_marker(marker):
+    return f"{marker[:-len('.json')]}.done"
+
+def failed_marker(marker):
+    return f"{marker[:-len('.json')]}.failed"
+
+def lease_expired(payload):
+    return payload.get("accepted_at", 0) + EVENT_LEASE_SECONDS < time.time()
+
+def hold_lease(bucket, marker, payload, etag):
+    with active_leases_lock:
+        active_leases[marker] = (bucket, payload, etag)
+
+def claim_event(bucket, marker, payload):
+    etag = put_object_conditional(bucket, marker, payload)
+    if etag is None:
+        current, current_etag = read_marker(bucket, marker)
+        if current is None:
+            etag = put_object_conditional(bucket, marker, payload)
+        elif lease_expired(current):
+            etag = put_object_conditional(bucket, marker, payload, current_etag)
+            if etag is not None:
+                print(f"Stale event lease taken over: {marker}", flush=True)
+    if etag is None:
+        return False
+    hold_lease(bucket, marker, payload, etag)
+    return True
+
+def release_event(bucket, marker):
+    with active_leases_lock:
+        active_leases.pop(marker, None)
+    minio_client.remove_object(bucket, marker)
+
+def retry_event(bucket, marker):
+    with active_leases_lock:
+        lease = active_leases.pop(marker, None)
+    if lease is None:
+        return
+
+    _, payload, etag = lease
+    attempts = payload.get("attempts", 0) + 1
+    if attempts >= EVENT_MAX_ATTEMPTS:
+        data = json.dumps({**payload, "attempts": attempts, "failed_at": time.time()}).encode("utf-8")
+        minio_client.put_object(bucket, failed_marker(marker), io.BytesIO(data), len(data), content_type="application/json")
+        minio_client.remove_object(bucket, marker)
+        print(f"Accepted event failed {attempts} times, dead-lettered: {failed_marker(marker)}", flush=True)
+        return
+
+    # Keep the lease but mark it expired so the next replay pass retries it.
+    payload = {**payload, "attempts": attempts, "accepted_at": time.time() - EVENT_LEASE_SECONDS}
+    if put_object_conditional(bucket, marker, payload, etag) is None:
+        print(f"Event lease lost before retry: {marker}", flush=True)
+    else:
+        print(f"Accepted event failed (attempt {attempts}/{EVENT_MAX_ATTEMPTS}), left for replay: {marker}", flush=True)
+
+def run_accepted(cloudevent, bucket, marker, traceparent=None):
+    status = 500
+    try:
+        body, status = handle_cloudevent(cloudevent, traceparent)
+        if status < 400:
+            data = json.dumps({"marker": marker, "completed_at": time.time()}).encode("utf-8")
+            minio_client.put_object(bucket, done_marker(marker), io.BytesIO(data), len(data), content_type="application/json")
+    finally:
+        if status < 400:
+            release_event(bucket, marker)
+        else:
+            retry_event(bucket, marker)
+
+def renew_leases():
+    with active_leases_lock:
+        leases = list(active_leases.items())
+    for marker, (bucket, payload, etag) in leases:
+        payload = {**payload, "accepted_at": time.time()}
+        etag = put_object_conditional(bucket, marker, payload, etag)
+        with active_leases_lock:
+            if marker not in active_leases:
+                continue
+            if etag is None:
+                active_leases.pop(marker)
+                print(f"Event lease lost: {marker}", flush=True)
+            else:
+                active_leases[marker] = (bucket, payload, etag)
+
+def replay_stale_events():
+    for bucket in minio_client.list_buckets():
+        for obj in minio_client.list_objects(bucket.name, prefix=EVENT_MARKER_PREFIX, recursive=True):
+            marker = obj.object_name
+            with active_leases_lock:
+                held = marker in active_leases
+            if held or not marker.endswith(".json"):
+                continue
+
+            current, etag = read_marker(bucket.name, marker)
+            if current is None or not lease_expired(current):
+                continue
+            if object_exists(bucket.name, done_marker(marker)):
+                minio_client.remove_object(bucket.name, marker)
+                continue
+
+            payload = {**current, "accepted_at": time.time()}
+            etag = put_object_conditional(bucket.name, marker, payload, etag)
+            if etag is None:
+                continue
+            hold_lease(bucket.name, marker, payload, etag)
+            if worker_pool.submit(run_accepted, current["event"], bucket.name, marker) is None:
+                with active_leases_lock:
+                    active_leases.pop(marker, None)
+                continue
+            print(f"Replaying unfinished event: {marker}", flush=True)
+
+def lease_keeper():
+    while True:
+        time.sleep(EVENT_REPLAY_INTERVAL)
+        try:
+            renew_leases()
+            replay_stale_events()
+        except Exception as e:
+            print(f"Event lease keeper error: {e}", flush=True)
+
+if ASYNC_MODE:
+    threading.Thread(target=lease_keeper, name="event-lease-keeper", daemon=True).start()
+
+def accept_event(cloudevent, event_id, traceparent=None):
+    event_data = cloudevent.get("data") if isinstance(cloudevent, dict) and "data" in cloudevent else cloudevent
+    missing = [field for field in REQUIRED_FIELDS if not isinstance(event_data, dict) or field not in event_data]
+    if isinstance(event_data, dict) and not any(field in event_data for field in CHUNK_FIELDS):
+        missing.append("chunks")
+    if missing:
+        return jsonify({"error": f"Missing fields: {', '.join(missing)}"}), 400
+
+    event_id = event_id or cloudevent.get("id") or event_data["key"]
+    bucket = event_data["bucket"]
+    marker = f"{EVENT_MARKER_PREFIX}{quote(event_id, safe='')}.json"
+
+    if object_exists(bucket, done_marker(marker)) or not claim_event(bucket, marker, {"id": event_id, "event": cloudevent, "accepted_at": time.time()}):
+        print(f"Duplicate event ignored: {event_id}", flush=True)
+        return jsonify({"message": "Duplicate event ignored", "id": event_id}), 200
+
+    if worker_pool.submit(run_accepted, cloudevent, bucket, marker, traceparent) is None:
+        release_event(bucket, marker)
+        return busy_response()
+
+    return jsonify({"message": "Accepted", "id": event_id}), 202
 
 
 @app.route('/', methods=['POST'])
@@ -75,38 +952,73 @@ def process_chunks():
     cloudevent = request.get_json()
     print("CloudEvent received:", cloudevent, flush=True)
 
+    if ASYNC_MODE:
+        return accept_event(cloudevent, request.headers.get("ce-id"), request.headers.get("ce-traceparent"))
+    return run_in_pool(handle_cloudevent, cloudevent, request.headers.get("ce-traceparent"))
+
+def handle_cloudevent(cloudevent, traceparent=None):
     try:
+        print(f"Trace: {start_trace(traceparent)}", flush=True)
         event_data = cloudevent.get("data") if isinstance(cloudevent, dict) and "data" in cloudevent else cloudevent
 
         bucket = event_data["bucket"]
         result_dir = event_data["result_dir"]
-        chunks_raw = event_data["chunks"]
         key = event_data["key"]
-        
-        chunks = []
-        for local_name, object_name, start_ms, end_ms in chunks_raw:
-            os.makedirs(os.path.dirname(local_name), exist_ok=True)
-            minio_client.fget_object(bucket, object_name, local_name)
-            print(f"Downloaded: {object_name} → {local_name}")
-            chunks.append((local_name, start_ms, end_ms))
-
-        transcribe_chunks(chunks, output_srt="tts.txt", model_size="tiny")
-        minio_client.fput_object(bucket, f"{result_dir}tts.txt", "tts.txt")
-
-        event_data = {
+
+        if already_processed(bucket, result_dir, event_data.get("etag", "")):
+            print(f"Already processed: {key} ({event_data['etag']})", flush=True)
+            return {"message": "Already processed"}, 200
+
+        chunks_raw = read_chunk_manifest(bucket, event_data)
+        shard = event_data.get("shard")
+        srt_object = f"{result_dir}tts.txt" if shard is None else f"{result_dir}parts/tts_{shard:05d}.txt"
+
+        with work_directory() as work_dir:
+            downloads = [(object_name, os.path.join(work_dir, "chunks", os.path.basename(object_name))) for _, object_name, _, _ in chunks_raw]
+            timings = download_objects(bucket, downloads)
+            chunks = []
+            for (object_name, local_name), (_, _, start_ms, end_ms) in zip(downloads, chunks_raw):
+                print(f"Downloaded: {object_name} → {local_name} ({timings[object_name] * 1000:.0f} ms)")
+                chunks.append((local_name, start_ms, end_ms))
+
+            output_srt = os.path.join(work_dir, "tts.txt")
+            transcribe_chunks(chunks, output_srt=output_srt, model_size="tiny")
+            with timed("upload"):
+                minio_client.fput_object(bucket, srt_object, output_srt)
+
+        processed = {
             "bucket": bucket,
             "result_dir": result_dir,
-            "chunks": chunks_raw
+            **{field: event_data[field] for field in CHUNK_FIELDS if field in event_data},
+            "key": key
         }
-        send_cloudevent(subject=key, data=event_data)
+        for field in ("etag", "version_id"):
+            if field in event_data:
+                processed[field] = event_data[field]
+        if shard is not None:
+            for field in ("shard", "final", "total_chunks", "total_shards"):
+                if field in event_data:
+                    processed[field] = event_data[field]
+        send_cloudevent(subject=event_subject(key, event_data.get("etag", ""), shard), data=processed)
 
-        return jsonify({"message": "Processing complete"}), 200
+        return {"message": "Processing complete"}, 200
 
     except Exception as e:
         import traceback
         traceback.print_exc()
         print("Error:", e, flush=True)
-        return jsonify({"error": str(e)}), 500
+        return {"error": str(e)}, 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        **worker_pool.stats(),
+        "transcript_cache": transcript_cache.stats() if transcript_cache is not None else None
+    })
 
 @app.route('/', methods=['GET'])
 def home():
@@ -114,4 +1026,8 @@ def home():
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
-    app.run(debug=False, host="0.0.0.0", port=port)
\ No newline at end of file
+    if SERVER == "waitress":
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=port, threads=WORKER_THREADS + WORKER_QUEUE_SIZE + 2)
+    else:
+        app.run(debug=False, host="0.0.0.0", port=port, threaded=True)
\ No newline at end of file
@@ -1,24 +1,461 @@
 import os
 import glob
 import re
-from flask import Flask, jsonify, request
+import bisect
+import json
+from flask import Flask, Response, jsonify, request
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 
 from pydub import AudioSegment, silence
+from pydub.utils import db_to_float, mediainfo, ratio_to_db
+import numpy as np
 import whisper
+import torch
 
 from minio import Minio
+from minio.error import S3Error
 import tempfile
+import hashlib
+import io
+import time
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import subprocess
+import threading
+from collections import OrderedDict
 from urllib.parse import unquote
 
-minio_client = Minio(
-    os.environ.get("MINIO_ENDPOINT", "minio.minio:9000"),
-    access_key=os.environ.get("MINIO_ACCESS_KEY", "minioadmin"),
-    secret_key=os.environ.get("MINIO_SECRET_KEY", "minioadmin"),
-    secure=False
+SERVICE_NAME = "audio-processor"
+
+STAGE_SECONDS = Histogram(
+    "audio_stage_seconds", "Wall time spent in each pipeline stage", ["service", "stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
+AUDIO_SECONDS = Counter("audio_processed_seconds_total", "Seconds of audio processed", ["service"])
+REALTIME_FACTOR = Histogram(
+    "audio_realtime_factor", "Processing wall time divided by audio duration", ["service"],
+    buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+)
+WORKER_QUEUED = Gauge("worker_queued_requests", "Requests waiting for a worker thread", ["service"])
+WORKER_IN_FLIGHT = Gauge("worker_in_flight_requests", "Requests being processed by a worker thread", ["service"])
+WORKER_CAPACITY = Gauge("worker_capacity_requests", "Requests accepted before the service answers 429", ["service"])
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(SERVICE_NAME, stage).observe(time.perf_counter() - started)
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.labels(SERVICE_NAME, stage).observe(seconds)
+
+def record_audio(audio_seconds, elapsed):
+    if audio_seconds > 0:
+        AUDIO_SECONDS.labels(SERVICE_NAME).inc(audio_seconds)
+        REALTIME_FACTOR.labels(SERVICE_NAME).observe(elapsed / audio_seconds)
+
+MINIO_CONCURRENCY = int(os.environ.get("MINIO_CONCURRENCY", 8))
+MINIO_RETRIES = int(os.environ.get("MINIO_RETRIES", 3))
+MINIO_RETRY_BACKOFF = float(os.environ.get("MINIO_RETRY_BACKOFF", 0.5))
+
+def minio_connection(retries):
+    http_client = urllib3.PoolManager(
+        maxsize=MINIO_CONCURRENCY,
+        timeout=urllib3.Timeout(connect=10, read=300),
+        retries=retries
+    )
+    client = Minio(
+        os.environ.get("MINIO_ENDPOINT", "minio.minio:9000"),
+        access_key=os.environ.get("MINIO_ACCESS_KEY", "minioadmin"),
+        secret_key=os.environ.get("MINIO_SECRET_KEY", "minioadmin"),
+        secure=False,
+        http_client=http_client
+    )
+    return client, http_client
+
+minio_client, minio_http_client = minio_connection(
+    urllib3.Retry(total=MINIO_RETRIES, backoff_factor=MINIO_RETRY_BACKOFF, status_forcelist=[500, 502, 503, 504])
 )
+# Bulk object transfers retry whole objects in transfer_object, so their
+# connection must not retry underneath it.
+transfer_client, _ = minio_connection(False)
+
+def transfer_object(transfer, bucket, object_name, file_path, retries=MINIO_RETRIES, backoff=MINIO_RETRY_BACKOFF):
+    for attempt in range(retries + 1):
+        started = time.perf_counter()
+        try:
+            transfer(bucket, object_name, file_path)
+            return time.perf_counter() - started
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            print(f"Transfer failed: {object_name} ({e}), retrying in {delay:.1f}s", flush=True)
+            time.sleep(delay)
+
+def transfer_objects(transfer, bucket, items, concurrency=MINIO_CONCURRENCY):
+    timings = {}
+    if not items:
+        return timings
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items)))) as executor:
+        futures = {
+            executor.submit(transfer_object, transfer, bucket, object_name, file_path): object_name
+            for object_name, file_path in items
+        }
+        for future in as_completed(futures):
+            timings[futures[future]] = future.result()
+    return timings
+
+@timed("upload")
+def upload_objects(bucket, items, concurrency=MINIO_CONCURRENCY):
+    return transfer_objects(transfer_client.fput_object, bucket, items, concurrency=concurrency)
 
 app = Flask(__name__)
 
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 1))
+WORKER_QUEUE_SIZE = int(os.environ.get("WORKER_QUEUE_SIZE", 4))
+RETRY_AFTER_SECONDS = int(os.environ.get("RETRY_AFTER_SECONDS", 30))
+SERVER = os.environ.get("SERVER", "waitress")
+
+class WorkerPool:
+    def __init__(self, workers=1, queue_size=4):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+
+    def submit(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            return None
+
+        with self.lock:
+            self.queued += 1
+
+        def run():
+            with self.lock:
+                self.queued -= 1
+                self.in_flight += 1
+            try:
+                return fn(*args)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+                self.slots.release()
+
+        return self.executor.submit(run)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": self.queued,
+                "in_flight": self.in_flight,
+                "workers": self.workers,
+                "capacity": self.capacity
+            }
+
+worker_pool = WorkerPool(workers=WORKER_THREADS, queue_size=WORKER_QUEUE_SIZE)
+WORKER_QUEUED.labels(SERVICE_NAME).set_function(lambda: worker_pool.stats()["queued"])
+WORKER_IN_FLIGHT.labels(SERVICE_NAME).set_function(lambda: worker_pool.stats()["in_flight"])
+WORKER_CAPACITY.labels(SERVICE_NAME).set(worker_pool.capacity)
+
+def busy_response():
+    response = jsonify({"error": "Server busy", **worker_pool.stats()})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+    return response
+
+def run_in_pool(fn, *args):
+    future = worker_pool.submit(fn, *args)
+    if future is None:
+        return busy_response()
+    body, status = future.result()
+    return jsonify(body), status
+
+MERGE_MODE = os.environ.get("MERGE_MODE", "copy")
+
+WHISPER_DEVICE = os.environ.get("WHISPER_DEVICE", "cpu")
+WHISPER_PRELOAD = [s.strip() for s in os.environ.get("WHISPER_PRELOAD", "").split(",") if s.strip()]
+WHISPER_MAX_MODELS = int(os.environ.get("WHISPER_MAX_MODELS", 2))
+WHISPER_MAX_MEMORY_MB = int(os.environ.get("WHISPER_MAX_MEMORY_MB", 0))
+WHISPER_BATCH_SIZE = int(os.environ.get("WHISPER_BATCH_SIZE", 1))
+WHISPER_PACK_MS = int(os.environ.get("WHISPER_PACK_MS", 0))
+WHISPER_PACK_GAP_MS = int(os.environ.get("WHISPER_PACK_GAP_MS", 300))
+PIPELINE_MODE = os.environ.get("PIPELINE_MODE", "files")
+UPLOAD_CHUNKS = os.environ.get("UPLOAD_CHUNKS", "true").lower() == "true"
+WORK_ROOT = os.environ.get("WORK_ROOT") or None
+PROCESS_OUTPUT_ROOT = os.environ.get("PROCESS_OUTPUT_ROOT", "outputs")
+STREAM_WINDOW_MS = int(os.environ.get("STREAM_WINDOW_MS", 10000))
+CHUNK_STORE = os.environ.get("CHUNK_STORE", "mmap")
+ANALYSIS_SAMPLE_RATE = int(os.environ.get("ANALYSIS_SAMPLE_RATE", 0))
+
+def work_directory():
+    return tempfile.TemporaryDirectory(prefix="audio-processor-", dir=WORK_ROOT)
+
+WHISPER_BACKEND = os.environ.get("WHISPER_BACKEND", "torch")
+WHISPER_COMPUTE_TYPE = os.environ.get("WHISPER_COMPUTE_TYPE", "int8")
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", 0))
+TORCH_INTEROP_THREADS = int(os.environ.get("TORCH_INTEROP_THREADS", 0))
+
+if TORCH_THREADS:
+    torch.set_num_threads(TORCH_THREADS)
+if TORCH_INTEROP_THREADS:
+    torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+
+class FasterWhisperModel:
+    def __init__(self, model_size, device="cpu", compute_type=WHISPER_COMPUTE_TYPE, cpu_threads=TORCH_THREADS):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError:
+            raise RuntimeError("WHISPER_BACKEND=faster-whisper requires the faster-whisper package")
+        self.model = WhisperModel(model_size, device=device, compute_type=compute_type, cpu_threads=cpu_threads)
+        self.device = torch.device(device)
+
+    def transcribe(self, audio, language=None, word_timestamps=False, **kwargs):
+        segments, _ = self.model.transcribe(
+            np.asarray(audio, dtype=np.float32), language=language, beam_size=1, word_timestamps=word_timestamps
+        )
+        segments = [
+            {
+                "text": segment.text,
+                "start": segment.start,
+                "end": segment.end,
+                "words": [{"word": word.word, "start": word.start, "end": word.end} for word in segment.words or []]
+            }
+            for segment in segments
+        ]
+        return {"text": "".join(segment["text"] for segment in segments), "segments": segments}
+
+def quantize_int8(model):
+    # whisper subclasses nn.Linear, and quantize_dynamic only swaps exact
+    # nn.Linear modules.
+    for module in model.modules():
+        if isinstance(module, torch.nn.Linear):
+            module.__class__ = torch.nn.Linear
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_whisper_model(model_size, device="cpu", backend=WHISPER_BACKEND):
+    if backend == "faster-whisper":
+        return FasterWhisperModel(model_size, device=device)
+    if backend not in ("torch", "int8"):
+        raise ValueError(f"Unknown whisper backend: {backend}")
+
+    model = whisper.load_model(model_size, device=device)
+    if backend == "int8":
+        if device != "cpu":
+            raise ValueError("WHISPER_BACKEND=int8 requires WHISPER_DEVICE=cpu")
+        model = quantize_int8(model)
+    return model
+
+def tensor_bytes(value):
+    if torch.is_tensor(value):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(tensor_bytes(item) for item in value)
+    return 0
+
+def model_bytes(model):
+    if isinstance(model, FasterWhisperModel):
+        return 0
+    return sum(tensor_bytes(value) for value in model.state_dict().values())
+
+class ModelRegistry:
+    def __init__(self, max_models=2, max_memory_mb=0, device="cpu", backend=WHISPER_BACKEND):
+        self.max_models = max_models
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self.device = device
+        self.backend = backend
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        model = self._models.get(key)
+        if model is not None:
+            self._models.move_to_end(key)
+        return model
+
+    def _evict(self):
+        while self._models and (
+            (self.max_models and len(self._models) > self.max_models)
+            or (self.max_memory and sum(self._sizes.values()) > self.max_memory and len(self._models) > 1)
+        ):
+            key, _ = self._models.popitem(last=False)
+            self._sizes.pop(key, None)
+            print(f"Model evicted: {key[0]} ({key[1]}, {key[2]})", flush=True)
+
+    def model_id(self, model_size):
+        return model_size if self.backend == "torch" else f"{model_size}-{self.backend}"
+
+    def get(self, model_size, device=None):
+        key = (model_size, device or self.device, self.backend)
+
+        with self._lock:
+            model = self._lookup(key)
+            if model is not None:
+                return model
+            load_lock = self._loading.setdefault(key, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                model = self._lookup(key)
+                if model is not None:
+                    return model
+
+            with timed("model_load"):
+                model = load_whisper_model(key[0], device=key[1], backend=key[2])
+            size = model_bytes(model)
+            print(f"Model loaded: {key[0]} ({key[1]}, {key[2]}, {size // (1024 * 1024)} MB)", flush=True)
+
+            with self._lock:
+                self._models[key] = model
+                self._sizes[key] = size
+                self._loading.pop(key, None)
+                self._evict()
+
+        return model
+
+    def preload(self, model_sizes):
+        for model_size in model_sizes:
+            self.get(model_size)
+
+model_registry = ModelRegistry(
+    max_models=WHISPER_MAX_MODELS,
+    max_memory_mb=WHISPER_MAX_MEMORY_MB,
+    device=WHISPER_DEVICE,
+    backend=WHISPER_BACKEND
+)
+model_registry.preload(WHISPER_PRELOAD)
+
+TRANSCRIPT_CACHE = os.environ.get("TRANSCRIPT_CACHE", "true").lower() == "true"
+TRANSCRIPT_CACHE_DIR = os.environ.get("TRANSCRIPT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "transcript-cache"))
+TRANSCRIPT_CACHE_MAX_MB = int(os.environ.get("TRANSCRIPT_CACHE_MAX_MB", 256))
+TRANSCRIPT_CACHE_BUCKET = os.environ.get("TRANSCRIPT_CACHE_BUCKET", "")
+
+class TranscriptCache:
+    def __init__(self, directory, max_mb=256, bucket=""):
+        self.directory = directory
+        self.max_bytes = max_mb * 1024 * 1024
+        self.bucket = bucket
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        for name in os.listdir(directory):
+            if name.endswith(".txt"):
+                stat = os.stat(os.path.join(directory, name))
+                existing.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(existing):
+            self._entries[key] = size
+            self._size += size
+
+    def key(self, audio, model_size, language):
+        digest = hashlib.sha256(f"{model_size}:{language}:".encode("utf-8"))
+        digest.update(np.ascontiguousarray(audio, dtype=np.float32).data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.txt")
+
+    def _store(self, key, text):
+        data = text.encode("utf-8")
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=f"{key}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self._lock:
+            self._size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                evicted, size = self._entries.popitem(last=False)
+                self._size -= size
+                try:
+                    os.remove(self._path(evicted))
+                except FileNotFoundError:
+                    pass
+
+    def get(self, key):
+        with self._lock:
+            cached = key in self._entries
+            if cached:
+                self._entries.move_to_end(key)
+
+        if cached:
+            try:
+                with open(self._path(key), encoding="utf-8") as f:
+                    text = f.read()
+                os.utime(self._path(key))
+                with self._lock:
+                    self.hits += 1
+                return text
+            except FileNotFoundError:
+                pass
+
+        if self.bucket:
+            # The shared tier is best-effort: any MinIO failure is a miss.
+            text = None
+            try:
+                response = minio_client.get_object(self.bucket, f"cache/transcripts/{key}.txt")
+                try:
+                    text = response.read().decode("utf-8")
+                finally:
+                    response.close()
+                    response.release_conn()
+            except S3Error as e:
+                if e.code not in ("NoSuchKey", "NoSuchObject"):
+                    print(f"Shared transcript cache unavailable: {e}", flush=True)
+            except Exception as e:
+                print(f"Shared transcript cache unavailable: {e}", flush=True)
+            if text is not None:
+                self._store(key, text)
+                with self._lock:
+                    self.hits += 1
+                    self.shared_hits += 1
+                return text
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, text):
+        self._store(key, text)
+        if self.bucket:
+            data = text.encode("utf-8")
+            try:
+                minio_client.put_object(self.bucket, f"cache/transcripts/{key}.txt", io.BytesIO(data), len(data), content_type="text/plain")
+            except Exception as e:
+                print(f"Shared transcript cache write failed: {e}", flush=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._size
+            }
+
+transcript_cache = TranscriptCache(TRANSCRIPT_CACHE_DIR, TRANSCRIPT_CACHE_MAX_MB, TRANSCRIPT_CACHE_BUCKET) if TRANSCRIPT_CACHE else None
+
 def format_timestamp(ms):
     hours = ms // (3600 * 1000)
     ms -= hours * 3600 * 1000
@@ -28,96 +465,1080 @@ def format_timestamp(ms):
     ms -= seconds * 1000
     return f"{hours:02}:{minutes:02}:{seconds:02},{ms:03}"
 
+SILENCE_DETECTOR = os.environ.get("SILENCE_DETECTOR", "numpy")
+
+SAMPLE_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+def pcm_frames(audio):
+    samples = np.frombuffer(audio.raw_data, dtype=SAMPLE_DTYPES[audio.sample_width])
+    return samples.reshape(-1, audio.channels)
+
+def nonsilent_ranges(frames, frame_rate, max_amplitude, seg_len, min_silence_len=1000, silence_thresh=-16, seek_step=1):
+    if seg_len < min_silence_len:
+        return [[0, seg_len]]
+
+    if np.issubdtype(frames.dtype, np.integer) and frames.dtype.itemsize <= 2:
+        energy = np.square(frames, dtype=np.int64).sum(axis=1)
+    else:
+        energy = np.square(frames, dtype=np.float64).sum(axis=1)
+    cumulative = np.concatenate(([0], np.cumsum(energy)))
+    frame_count = len(frames)
+
+    last_slice_start = seg_len - min_silence_len
+    starts = np.arange(0, last_slice_start + 1, seek_step, dtype=np.int64)
+    if last_slice_start % seek_step:
+        starts = np.append(starts, last_slice_start)
+
+    first = np.minimum((starts * frame_rate / 1000.0).astype(np.int64), frame_count)
+    last = (starts + min_silence_len) * frame_rate / 1000.0
+    count = (last.astype(np.int64) - first) * frames.shape[1]
+    last = np.minimum(last.astype(np.int64), frame_count)
+
+    sum_squares = (cumulative[last] - cumulative[first]).astype(np.float64)
+    mean_squares = np.divide(sum_squares, count, out=np.zeros_like(sum_squares), where=count > 0)
+    rms = np.sqrt(mean_squares)
+    if np.issubdtype(frames.dtype, np.integer):
+        rms = np.floor(rms)
+
+    threshold = db_to_float(silence_thresh) * max_amplitude
+    silence_starts = starts[rms <= threshold]
+    if len(silence_starts) == 0:
+        return [[0, seg_len]]
+
+    gaps = np.diff(silence_starts)
+    breaks = np.flatnonzero((gaps != seek_step) & (gaps > min_silence_len))
+    range_starts = silence_starts[np.concatenate(([0], breaks + 1))]
+    range_ends = silence_starts[np.concatenate((breaks, [len(silence_starts) - 1]))] + min_silence_len
+
+    if range_starts[0] == 0 and range_ends[0] == seg_len:
+        return []
+
+    ranges = []
+    prev_end = 0
+    for start, end in zip(range_starts.tolist(), range_ends.tolist()):
+        ranges.append([prev_end, start])
+        prev_end = end
+    if prev_end != seg_len:
+        ranges.append([prev_end, seg_len])
+    if ranges[0] == [0, 0]:
+        ranges.pop(0)
+    return ranges
+
+@timed("silence_detection")
+def detect_nonsilent_ranges(audio, min_silence_len=1000, silence_thresh=-16, seek_step=1):
+    if SILENCE_DETECTOR == "pydub":
+        return silence.detect_nonsilent(audio, min_silence_len=min_silence_len, silence_thresh=silence_thresh, seek_step=seek_step)
+
+    return nonsilent_ranges(
+        pcm_frames(audio),
+        audio.frame_rate,
+        audio.max_possible_amplitude,
+        len(audio),
+        min_silence_len=min_silence_len,
+        silence_thresh=silence_thresh,
+        seek_step=seek_step
+    )
+
+SPLIT_ENGINE = os.environ.get("SPLIT_ENGINE", "silence")
+SPLIT_MIN_CHUNK_MS = int(os.environ.get("SPLIT_MIN_CHUNK_MS", 1000))
+SPLIT_MAX_CHUNK_MS = int(os.environ.get("SPLIT_MAX_CHUNK_MS", 30000))
+SPLIT_OVERLAP_MS = int(os.environ.get("SPLIT_OVERLAP_MS", 1000))
+VAD_FRAME_MS = int(os.environ.get("VAD_FRAME_MS", 20))
+VAD_ENERGY_MARGIN_DB = float(os.environ.get("VAD_ENERGY_MARGIN_DB", 12))
+VAD_FLATNESS = float(os.environ.get("VAD_FLATNESS", 0.45))
+VAD_BAND_RATIO = float(os.environ.get("VAD_BAND_RATIO", 0.5))
+VAD_MIN_SPEECH_MS = int(os.environ.get("VAD_MIN_SPEECH_MS", 100))
+VAD_PADDING_MS = int(os.environ.get("VAD_PADDING_MS", 100))
+
+def vad_features(audio, frame_ms=VAD_FRAME_MS, block_frames=3000):
+    samples = pcm_frames(audio)
+    frame_len = int(audio.frame_rate * frame_ms / 1000)
+    count = len(samples) // frame_len if frame_len else 0
+    energy = np.empty(count)
+    flatness = np.empty(count)
+    band_ratio = np.empty(count)
+
+    window = np.hanning(frame_len)
+    freqs = np.fft.rfftfreq(frame_len, 1.0 / audio.frame_rate)
+    band = (freqs >= 300) & (freqs <= 3400)
+    scale = float(audio.max_possible_amplitude)
+    for first in range(0, count, block_frames):
+        last = min(count, first + block_frames)
+        frames = samples[first * frame_len:last * frame_len].mean(axis=1, dtype=np.float64).reshape(-1, frame_len) / scale
+        energy[first:last] = 10 * np.log10(np.mean(np.square(frames), axis=1) + 1e-10)
+        spectrum = np.square(np.abs(np.fft.rfft(frames * window, axis=1))) + 1e-12
+        total = spectrum.sum(axis=1)
+        flatness[first:last] = np.exp(np.mean(np.log(spectrum), axis=1)) / (total / spectrum.shape[1])
+        band_ratio[first:last] = spectrum[:, band].sum(axis=1) / total
+    return energy, flatness, band_ratio
+
+def frame_runs(mask):
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+def limit_ranges(ranges, energy, frame_ms, min_ms=SPLIT_MIN_CHUNK_MS, max_ms=SPLIT_MAX_CHUNK_MS):
+    limited = []
+    for start_ms, end_ms in ranges:
+        while max_ms and end_ms - start_ms > max_ms:
+            first = (start_ms + max(min_ms, max_ms // 2)) // frame_ms
+            last = min((start_ms + max_ms) // frame_ms, len(energy))
+            cut = (first + int(np.argmin(energy[first:last]))) * frame_ms if last > first else start_ms + max_ms
+            limited.append([start_ms, cut])
+            start_ms = cut
+        limited.append([start_ms, end_ms])
+
+    merged = []
+    for start_ms, end_ms in limited:
+        if merged and (merged[-1][1] - merged[-1][0] < min_ms or end_ms - start_ms < min_ms) and (not max_ms or end_ms - merged[-1][0] <= max_ms):
+            merged[-1][1] = end_ms
+        else:
+            merged.append([start_ms, end_ms])
+    return merged
+
+def vad_ranges(audio, min_silence_len=1000, silence_thresh=-16, frame_ms=VAD_FRAME_MS, min_ms=SPLIT_MIN_CHUNK_MS, max_ms=SPLIT_MAX_CHUNK_MS):
+    energy, flatness, band_ratio = vad_features(audio, frame_ms)
+    if not len(energy):
+        return [[0, len(audio)]] if len(audio) else []
+
+    noise_floor = min(np.percentile(energy, 10), np.percentile(energy, 95) - 30)
+    voiced = (energy > noise_floor + VAD_ENERGY_MARGIN_DB) & ((flatness <= VAD_FLATNESS) | (band_ratio >= VAD_BAND_RATIO))
+
+    starts, ends = frame_runs(~voiced)
+    for start, end in zip(starts, ends):
+        if 0 < start and end < len(voiced) and (end - start) * frame_ms < min_silence_len:
+            voiced[start:end] = True
+
+    starts, ends = frame_runs(voiced)
+    keep = (ends - starts) * frame_ms >= VAD_MIN_SPEECH_MS
+    padding = VAD_PADDING_MS // frame_ms
+    ranges = []
+    for start, end in zip(starts[keep], ends[keep]):
+        start = max(int(start) - padding, ranges[-1][1] // frame_ms if ranges else 0)
+        end = min(int(end) + padding, len(voiced))
+        ranges.append([start * frame_ms, end * frame_ms])
+    if ranges and ends[keep][-1] == len(voiced):
+        ranges[-1][1] = len(audio)
+
+    return limit_ranges(ranges, energy, frame_ms, min_ms=min_ms, max_ms=max_ms)
+
+def silence_ranges(audio, min_silence_len=1000, silence_thresh=-16):
+    return detect_nonsilent_ranges(audio, min_silence_len=min_silence_len, silence_thresh=audio.dBFS + silence_thresh)
+
+SPLIT_ENGINES = {
+    "silence": silence_ranges,
+    "vad": vad_ranges
+}
+
+def quietest_ms(frames, frame_rate, lo_ms, hi_ms, first_frame=0, bin_ms=10):
+    bin_len = max(1, int(frame_rate * bin_ms / 1000))
+    window = frames[max(0, int(lo_ms * frame_rate / 1000) - first_frame):max(0, int(hi_ms * frame_rate / 1000) - first_frame)]
+    count = len(window) // bin_len
+    if count == 0:
+        return lo_ms
+    energy = np.square(window[:count * bin_len], dtype=np.float64).sum(axis=1).reshape(count, bin_len).sum(axis=1)
+    return lo_ms + int(np.argmin(energy)) * bin_ms + bin_ms // 2
+
+def cut_long_range(start_ms, end_ms, quietest, max_ms=SPLIT_MAX_CHUNK_MS, overlap_ms=SPLIT_OVERLAP_MS):
+    pieces = []
+    half = overlap_ms // 2
+    while max_ms and end_ms - start_ms > max_ms:
+        cut = quietest(start_ms + max(max_ms // 2, overlap_ms), start_ms + max_ms - half)
+        pieces.append([start_ms, cut + half])
+        start_ms = cut - half
+    return pieces, start_ms
+
+def force_max_length(audio, ranges, max_ms=SPLIT_MAX_CHUNK_MS, overlap_ms=SPLIT_OVERLAP_MS):
+    if not max_ms:
+        return ranges
+
+    frames = pcm_frames(audio)
+
+    def quietest(lo_ms, hi_ms):
+        return quietest_ms(frames, audio.frame_rate, lo_ms, hi_ms)
+
+    limited = []
+    for start_ms, end_ms in ranges:
+        pieces, start_ms = cut_long_range(start_ms, end_ms, quietest, max_ms, overlap_ms)
+        if pieces:
+            print(f"Forced {len(pieces)} cuts in a {end_ms - pieces[0][0]} ms range without pauses", flush=True)
+        limited.extend(pieces)
+        limited.append([start_ms, end_ms])
+    return limited
+
+def split_ranges(audio, min_silence_len=1000, silence_thresh=-16, engine=SPLIT_ENGINE):
+    if engine not in SPLIT_ENGINES:
+        raise ValueError(f"Unknown split engine: {engine}")
+    ranges = SPLIT_ENGINES[engine](audio, min_silence_len=min_silence_len, silence_thresh=silence_thresh)
+    return force_max_length(audio, ranges)
+
+class StreamingSilenceSplitter:
+    # silence_thresh is relative to loudness_db, the dBFS of the whole input
+    # (see pcm_dbfs), so the cuts match detect_nonsilent_ranges on the same audio.
+    def __init__(self, frame_rate, channels, loudness_db, sample_width=2, min_silence_len=1000, silence_thresh=-16, max_ms=SPLIT_MAX_CHUNK_MS, overlap_ms=SPLIT_OVERLAP_MS):
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.min_silence_len = min_silence_len
+        self.silence_thresh = silence_thresh
+        self.max_ms = max_ms
+        self.overlap_ms = overlap_ms
+        self.max_amplitude = float(1 << (8 * sample_width - 1))
+        self.threshold = db_to_float(loudness_db + silence_thresh) * self.max_amplitude
+
+        self.frames = np.empty((0, channels), dtype=SAMPLE_DTYPES[sample_width])
+        self.frames_start = 0
+        self.frames_read = 0
+
+        self.bin_energy = np.empty(0, dtype=np.float64)
+        self.bin_count = np.empty(0, dtype=np.int64)
+        self.bins_start = 0
+        self.bins_end = 0
+        self.next_window = 0
+
+        self.silence = None
+        self.chunk_start = 0
+
+    def _frame(self, ms):
+        return int(ms * self.frame_rate / 1000.0)
+
+    def _add_bins(self, bins_end):
+        if bins_end <= self.bins_end:
+            return
+
+        edges = (np.arange(self.bins_end, bins_end + 1) * self.frame_rate / 1000.0).astype(np.int64)
+        local = np.minimum(edges, self.frames_read) - self.frames_start
+        segment = self.frames[local[0]:local[-1]]
+        cumulative = np.concatenate(([0], np.cumsum(np.square(segment, dtype=np.int64).sum(axis=1))))
+
+        self.bin_energy = np.concatenate((self.bin_energy, cumulative[local[1:] - local[0]] - cumulative[local[:-1] - local[0]]))
+        self.bin_count = np.concatenate((self.bin_count, np.diff(edges) * self.channels))
+        self.bins_end = bins_end
+
+    def _chunk(self, start_ms, end_ms):
+        first = self._frame(start_ms) - self.frames_start
+        last = self._frame(end_ms) - self.frames_start
+        return start_ms, end_ms, self.frames[first:last].copy()
+
+    def _quietest(self, lo_ms, hi_ms):
+        return quietest_ms(self.frames, self.frame_rate, lo_ms, hi_ms, first_frame=self.frames_start)
+
+    def _chunks(self, start_ms, end_ms):
+        pieces, start_ms = cut_long_range(start_ms, end_ms, self._quietest, self.max_ms, self.overlap_ms)
+        return [self._chunk(s, e) for s, e in pieces] + [self._chunk(start_ms, end_ms)]
+
+    def _force_split(self):
+        length = self.min_silence_len
+        open_start = self.silence[1] + length if self.silence is not None else self.chunk_start
+        pieces, open_start = cut_long_range(open_start, self.next_window, self._quietest, self.max_ms, self.overlap_ms)
+        if self.silence is not None:
+            self.silence[1] = open_start - length
+        else:
+            self.chunk_start = open_start
+        return [self._chunk(s, e) for s, e in pieces]
+
+    def _scan(self, last_start):
+        chunks = []
+        if last_start < self.next_window:
+            return chunks
+
+        length = self.min_silence_len
+        energy = np.concatenate(([0], np.cumsum(self.bin_energy)))
+        count = np.concatenate(([0], np.cumsum(self.bin_count)))
+        starts = np.arange(self.next_window, last_start + 1, dtype=np.int64)
+        rel = starts - self.bins_start
+        sums = energy[rel + length] - energy[rel]
+        counts = count[rel + length] - count[rel]
+        rms = np.floor(np.sqrt(np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)))
+
+        silent = starts[rms <= self.threshold]
+        if len(silent):
+            previous = np.concatenate(([self.silence[1] if self.silence else -length - 1], silent[:-1]))
+            for idx in np.flatnonzero(silent - previous > length).tolist():
+                start = int(silent[idx])
+                if self.silence is not None:
+                    self.chunk_start = int(previous[idx]) + length
+                if start > self.chunk_start:
+                    chunks.extend(self._chunks(self.chunk_start, start))
+                self.silence = [start, start]
+            self.silence[1] = int(silent[-1])
+
+        self.next_window = last_start + 1
+        chunks.extend(self._force_split())
+        drop = self.next_window - self.bins_start
+        self.bin_energy = self.bin_energy[drop:]
+        self.bin_count = self.bin_count[drop:]
+        self.bins_start = self.next_window
+
+        keep_from = self.silence[1] + length if self.silence is not None else self.chunk_start
+        trim = min(self._frame(keep_from), self.frames_read) - self.frames_start
+        if trim > 0:
+            self.frames = self.frames[trim:]
+            self.frames_start += trim
+        return chunks
+
+    def feed(self, frames):
+        self.frames = np.concatenate((self.frames, frames))
+        self.frames_read += len(frames)
+
+        bins_end = int(self.frames_read * 1000 // self.frame_rate)
+        while self._frame(bins_end + 1) <= self.frames_read:
+            bins_end += 1
+        while bins_end > self.bins_end and self._frame(bins_end) > self.frames_read:
+            bins_end -= 1
+        self._add_bins(bins_end)
+        return self._scan(self.bins_end - self.min_silence_len)
+
+    def finish(self):
+        seg_len = round(1000 * (self.frames_read / self.frame_rate))
+        if seg_len < self.min_silence_len:
+            return [self._chunk(0, seg_len)] if self.silence is None else []
+
+        self._add_bins(seg_len)
+        chunks = self._scan(seg_len - self.min_silence_len)
+        if self.silence is not None:
+            self.chunk_start = self.silence[1] + self.min_silence_len
+        if self.chunk_start != seg_len:
+            chunks.extend(self._chunks(self.chunk_start, seg_len))
+        return chunks
+
+def stream_pcm(input_file, frame_rate, channels, block_ms=1000):
+    frame_width = 2 * channels
+    block_bytes = frame_rate * block_ms // 1000 * frame_width
+    process = subprocess.Popen(
+        [AudioSegment.converter, "-loglevel", "error", "-i", input_file,
+         "-f", "s16le", "-ac", str(channels), "-ar", str(frame_rate), "pipe:1"],
+        stdout=subprocess.PIPE
+    )
+    try:
+        while True:
+            data = process.stdout.read(block_bytes)
+            if not data:
+                break
+            usable = len(data) - len(data) % frame_width
+            yield np.frombuffer(data[:usable], dtype=np.int16).reshape(-1, channels)
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to decode {input_file}")
+
+def pcm_dbfs(blocks, sample_width=2):
+    # Same value as AudioSegment.dBFS, accumulated block by block.
+    sum_squares = 0
+    samples = 0
+    for frames in blocks:
+        sum_squares += int(np.square(frames, dtype=np.int64).sum())
+        samples += frames.size
+    rms = int(np.sqrt(sum_squares / samples)) if samples else 0
+    return ratio_to_db(rms / float(1 << (8 * sample_width - 1))) if rms else -float("inf")
+
+@timed("decode")
+def decode_audio(input_file, sample_rate=ANALYSIS_SAMPLE_RATE):
+    if not sample_rate:
+        return AudioSegment.from_file(input_file, format="mp3")
+
+    result = subprocess.run(
+        [AudioSegment.converter, "-loglevel", "error", "-i", input_file,
+         "-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"],
+        stdout=subprocess.PIPE,
+        check=True
+    )
+    return AudioSegment(data=result.stdout, sample_width=2, frame_rate=sample_rate, channels=1)
+
 def split_audio(input_file, output_dir="chunks", silence_thresh=-40, min_silence_len=500):
     if not os.path.isfile(input_file):
         raise FileNotFoundError(f"File not found: {input_file}")
 
     os.makedirs(output_dir, exist_ok=True)
 
-    audio = AudioSegment.from_file(input_file, format="mp3")
+    audio = decode_audio(input_file)
 
-    nonsilent_ranges = silence.detect_nonsilent(
-        audio,
-        min_silence_len=min_silence_len,
-        silence_thresh=audio.dBFS + silence_thresh
-    )
+    ranges = split_ranges(audio, min_silence_len=min_silence_len, silence_thresh=silence_thresh)
 
     chunk_files = []
-    for idx, (start_ms, end_ms) in enumerate(nonsilent_ranges, start=1):
+    for idx, (start_ms, end_ms) in enumerate(ranges, start=1):
         chunk = audio[start_ms:end_ms]
         chunk_filename = os.path.join(output_dir, f"chunk_{idx}.mp3")
-        chunk.export(chunk_filename, format="mp3")
+        with timed("chunk_export"):
+            chunk.export(chunk_filename, format="mp3")
         chunk_files.append((chunk_filename, start_ms, end_ms))
         print(f"Saved: {chunk_filename}")
 
     print(f"Created {len(chunk_files)} audio files in the '{output_dir}' folder.")
     return chunk_files
 
-def transcribe_chunks(chunk_files, output_srt="output.txt", model_size="base"):
-    model = whisper.load_model(model_size)
+# model.transcribe's defaults for its first, temperature-0 pass over a window.
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+NO_SPEECH_THRESHOLD = 0.6
 
-    with open(output_srt, "w", encoding="utf-8") as f:
-        for idx, (chunk_filename, start_ms, end_ms) in enumerate(chunk_files, start=1):
-            start = format_timestamp(start_ms)
-            end = format_timestamp(end_ms)
+def window_mel(model, audio):
+    # Same features transcribe uses: padded before the log-mel, then trimmed.
+    mel = whisper.log_mel_spectrogram(audio, model.dims.n_mels, padding=whisper.audio.N_SAMPLES)
+    return whisper.pad_or_trim(mel[:, :mel.shape[-1] - whisper.audio.N_FRAMES], whisper.audio.N_FRAMES)
+
+def batched_text(result, timestamp_begin):
+    # Returns None where transcribe would not stop at this decode: a result it
+    # would retry at a higher temperature, or a window it would seek into.
+    silent = result.no_speech_prob > NO_SPEECH_THRESHOLD
+    needs_fallback = result.compression_ratio > COMPRESSION_RATIO_THRESHOLD or result.avg_logprob < LOGPROB_THRESHOLD
+    if silent and result.avg_logprob < LOGPROB_THRESHOLD:
+        needs_fallback = False
+    if needs_fallback:
+        return None
+    if silent and not result.avg_logprob > LOGPROB_THRESHOLD:
+        return ""
+
+    timestamps = [token >= timestamp_begin for token in result.tokens]
+    consecutive = any(a and b for a, b in zip(timestamps, timestamps[1:]))
+    if consecutive and timestamps[-2:] != [False, True]:
+        return None
+    return result.text.strip()
+
+def transcribe_batched(model, chunk_audios, batch_size=8, language="en"):
+    fp16 = model.device.type != "cpu"
+    options = whisper.DecodingOptions(language=language, temperature=0.0, fp16=fp16)
+    tokenizer = whisper.tokenizer.get_tokenizer(
+        model.is_multilingual, num_languages=model.num_languages, language=language, task=options.task
+    )
+
+    texts = [None] * len(chunk_audios)
+    pending = []
+    retry = []
+    for idx, chunk_audio in enumerate(chunk_audios):
+        audio = whisper.load_audio(chunk_audio) if isinstance(chunk_audio, str) else chunk_audio
+        if audio.shape[-1] > whisper.audio.N_SAMPLES:
+            retry.append((idx, audio))
+        else:
+            pending.append((idx, audio))
+
+    for offset in range(0, len(pending), batch_size):
+        batch = pending[offset:offset + batch_size]
+        started = time.perf_counter()
+        mels = torch.stack([window_mel(model, audio) for _, audio in batch]).to(model.device)
+        results = whisper.decode(model, mels, options)
+        elapsed = (time.perf_counter() - started) / len(batch)
+        for (idx, audio), result in zip(batch, results):
+            texts[idx] = batched_text(result, tokenizer.timestamp_begin)
+            if texts[idx] is None:
+                retry.append((idx, audio))
+            observe_stage("inference", elapsed)
+
+    for idx, audio in retry:
+        with timed("inference"):
+            texts[idx] = model.transcribe(audio, language=language, fp16=fp16)["text"].strip()
+
+    return texts
+
+def pack_windows(lengths, max_samples, gap_samples):
+    windows = []
+    current = []
+    size = 0
+    for idx, length in enumerate(lengths):
+        added = length + (gap_samples if current else 0)
+        if current and size + added > max_samples:
+            windows.append(current)
+            current = []
+            size = 0
+            added = length
+        current.append(idx)
+        size += added
+    if current:
+        windows.append(current)
+    return windows
+
+def transcribe_packed(model, chunk_audios, max_ms=30000, gap_ms=WHISPER_PACK_GAP_MS, language="en"):
+    sample_rate = whisper.audio.SAMPLE_RATE
+    gap = np.zeros(sample_rate * gap_ms // 1000, dtype=np.float32)
+    windows = pack_windows([len(audio) for audio in chunk_audios], sample_rate * max_ms // 1000, len(gap))
+
+    texts = [""] * len(chunk_audios)
+    for window in windows:
+        parts = []
+        bounds = []
+        offset = 0
+        for idx in window:
+            if parts:
+                parts.append(gap)
+                offset += len(gap)
+            parts.append(np.asarray(chunk_audios[idx], dtype=np.float32))
+            bounds.append((offset / sample_rate, (offset + len(parts[-1])) / sample_rate))
+            offset += len(parts[-1])
+
+        with timed("inference"):
+            result = model.transcribe(np.concatenate(parts), language=language, word_timestamps=len(window) > 1)
+        if len(window) == 1:
+            texts[window[0]] = result["text"].strip()
+            continue
+
+        cuts = [(bounds[pos][1] + bounds[pos + 1][0]) / 2 for pos in range(len(bounds) - 1)]
+        pieces = [[] for _ in window]
+        for segment in result["segments"]:
+            for word in segment.get("words") or [segment]:
+                text = word.get("word", word.get("text", ""))
+                pieces[bisect.bisect_right(cuts, (word["start"] + word["end"]) / 2)].append(text)
+        for idx, words in zip(window, pieces):
+            texts[idx] = " ".join("".join(words).split())
+
+    print(f"Packed {len(chunk_audios)} chunks into {len(windows)} windows", flush=True)
+    return texts
+
+@timed("decode")
+def load_chunk_audio(chunk):
+    return whisper.load_audio(chunk) if isinstance(chunk, str) else chunk
+
+def transcribe_group(model, audios, batch_size=WHISPER_BATCH_SIZE, language="en", pack_ms=WHISPER_PACK_MS):
+    if pack_ms > 0:
+        return transcribe_packed(model, audios, max_ms=pack_ms, language=language)
+    if batch_size > 1 and not isinstance(model, FasterWhisperModel):
+        return transcribe_batched(model, audios, batch_size=batch_size, language=language)
+
+    results = []
+    for audio in audios:
+        with timed("inference"):
+            results.append(model.transcribe(audio, language=language)["text"].strip())
+    return results
+
+def transcribe_texts(chunks, model_size="base", batch_size=WHISPER_BATCH_SIZE, language="en", pack_ms=WHISPER_PACK_MS):
+    model = model_registry.get(model_size)
+    texts = [None] * len(chunks)
+    pending = []
+
+    def group_full():
+        if pack_ms > 0:
+            return sum(len(audio) for _, _, audio in pending) >= whisper.audio.SAMPLE_RATE * pack_ms // 1000
+        return len(pending) >= max(1, batch_size)
+
+    def flush():
+        results = transcribe_group(model, [audio for _, _, audio in pending], batch_size=batch_size, language=language, pack_ms=pack_ms)
+        for (idx, key, _), text in zip(pending, results):
+            texts[idx] = text
+            if key is not None:
+                transcript_cache.put(key, text)
+        pending.clear()
 
-            result = model.transcribe(chunk_filename, language="en")
-            text = result["text"].strip()
+    # Chunks are decoded, hashed and looked up one at a time; only cache
+    # misses are held, and only until their group is transcribed.
+    for idx, chunk in enumerate(chunks):
+        audio = load_chunk_audio(chunk)
+        key = None
+        if transcript_cache is not None:
+            key = transcript_cache.key(audio, model_registry.model_id(model_size), language)
+            texts[idx] = transcript_cache.get(key)
+            if texts[idx] is not None:
+                continue
+        pending.append((idx, key, audio))
+        if group_full():
+            flush()
+    if pending:
+        flush()
+    return texts
+
+OVERLAP_DEDUP_WORDS = int(os.environ.get("OVERLAP_DEDUP_WORDS", 8))
+
+def normalize_word(word):
+    return re.sub(r"[^\w']", "", word.lower())
+
+def dedup_overlap(previous_text, text, max_words=OVERLAP_DEDUP_WORDS):
+    words = text.split()
+    tail = [normalize_word(word) for word in previous_text.split()[-max_words:]]
+    head = [normalize_word(word) for word in words[:max_words]]
+    for size in range(min(len(tail), len(head)), 0, -1):
+        if tail[-size:] == head[:size] and any(head[:size]):
+            return " ".join(words[size:])
+    return text
 
-            f.write(f"{idx}\n")
-            f.write(f"{start} --> {end}\n")
-            f.write(f"{text}\n\n")
+def write_srt_entries(f, chunk_files, texts, first_index=1, previous=None):
+    for idx, ((chunk_filename, start_ms, end_ms), raw_text) in enumerate(zip(chunk_files, texts), start=first_index):
+        text = dedup_overlap(previous[1], raw_text) if previous is not None and start_ms < previous[0] else raw_text
+        previous = (end_ms, raw_text)
+        start = format_timestamp(start_ms)
+        end = format_timestamp(end_ms)
 
-            print(f"Recognized: {chunk_filename} → {text}")
+        f.write(f"{idx}\n")
+        f.write(f"{start} --> {end}\n")
+        f.write(f"{text}\n\n")
+
+        label = chunk_filename if isinstance(chunk_filename, str) else f"chunk_{idx}"
+        print(f"Recognized: {label} → {text}")
+    return previous
+
+def transcribe_chunks(chunk_files, output_srt="output.txt", model_size="base", batch_size=WHISPER_BATCH_SIZE, language="en"):
+    texts = transcribe_texts([c[0] for c in chunk_files], model_size=model_size, batch_size=batch_size, language=language)
+
+    with open(output_srt, "w", encoding="utf-8") as f:
+        write_srt_entries(f, chunk_files, texts)
 
+    if transcript_cache is not None:
+        print(f"Transcript cache: {transcript_cache.stats()}")
     print(f"Transcription completed: {output_srt}")
 
-def merge_audios(input_files, output_file="merged.mp3"):
+def mp3_stream_format(path):
+    with open(path, "rb") as f:
+        header = f.read(10)
+        offset = 0
+        if header[:3] == b"ID3":
+            offset = 10 + ((header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | (header[9] & 0x7f))
+            if header[5] & 0x10:
+                offset += 10
+        f.seek(offset)
+        data = f.read(4096)
+
+    for i in range(len(data) - 3):
+        if data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+            continue
+        version = (data[i + 1] >> 3) & 0x3
+        layer = (data[i + 1] >> 1) & 0x3
+        bitrate = data[i + 2] >> 4
+        sample_rate = (data[i + 2] >> 2) & 0x3
+        if version == 1 or layer == 0 or bitrate == 0xF or sample_rate == 3:
+            continue
+        return version, layer, sample_rate, (data[i + 3] >> 6) == 3
+    return None
+
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+def mp3_audio_params(path):
+    stream = mp3_stream_format(path)
+    if stream is None:
+        info = mediainfo(path)
+        return int(info["sample_rate"]), int(info["channels"])
+    version, _, sample_rate, mono = stream
+    return MP3_SAMPLE_RATES[version][sample_rate], 1 if mono else 2
+
+def overlap_trims(ranges):
+    trims = []
+    previous_end = None
+    for start_ms, end_ms in ranges:
+        trims.append(max(0, previous_end - start_ms) if previous_end is not None else 0)
+        previous_end = end_ms
+    return trims
+
+def concat_mp3(input_files, output_file, trims=None):
+    list_file = f"{output_file}.concat.txt"
+    with open(list_file, "w", encoding="utf-8") as f:
+        for idx, file in enumerate(input_files):
+            escaped = os.path.abspath(file).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+            if trims and trims[idx]:
+                f.write(f"inpoint {trims[idx] / 1000:.3f}\n")
+
+    try:
+        subprocess.run(
+            [AudioSegment.converter, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+             "-i", list_file, "-c", "copy", output_file],
+            check=True
+        )
+    finally:
+        os.remove(list_file)
+
+PCM_FORMATS = {1: "u8", 2: "s16le", 4: "s32le"}
+
+@timed("encode")
+def encode_pcm(data, frame_rate, channels, sample_width, output_file, format="mp3"):
+    subprocess.run(
+        [AudioSegment.converter, "-y", "-loglevel", "error",
+         "-f", PCM_FORMATS[sample_width], "-ar", str(frame_rate), "-ac", str(channels), "-i", "pipe:0",
+         "-f", format, output_file],
+        input=memoryview(data).cast("B"),
+        check=True
+    )
+
+@timed("encode")
+def encode_pcm_parts(parts, frame_rate, channels, sample_width, output_file, format="mp3"):
+    process = subprocess.Popen(
+        [AudioSegment.converter, "-y", "-loglevel", "error",
+         "-f", PCM_FORMATS[sample_width], "-ar", str(frame_rate), "-ac", str(channels), "-i", "pipe:0",
+         "-f", format, output_file],
+        stdin=subprocess.PIPE
+    )
+    try:
+        for part in parts:
+            process.stdin.write(memoryview(part).cast("B"))
+    finally:
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to encode {output_file}")
+
+@timed("merge")
+def merge_audios(input_files, output_file="merged.mp3", mode=MERGE_MODE, trims=None):
     if not input_files:
         raise ValueError("No input files!")
 
-    merged = AudioSegment.empty()
+    if mode == "copy":
+        for file in input_files:
+            if not os.path.isfile(file):
+                raise FileNotFoundError(f"File not found: {file}")
+
+        formats = {mp3_stream_format(file) for file in input_files}
+        if len(formats) == 1 and None not in formats:
+            concat_mp3(input_files, output_file, trims)
+            print(f"Merged {len(input_files)} files without re-encoding")
+            print(f"Merged file saved as: {output_file}\n")
+            return
+
+        print("Chunk encodings differ, merging by re-encoding", flush=True)
+
     for file in input_files:
         if not os.path.isfile(file):
             raise FileNotFoundError(f"File not found: {file}")
-        audio = AudioSegment.from_file(file, format="mp3")
-        merged += audio
-        print(f"Merged: {file}")
 
-    merged.export(output_file, format="mp3")
+    # The output format comes from the MP3 headers, so chunks can be decoded
+    # and piped to the encoder one at a time instead of all held at once.
+    params = [mp3_audio_params(file) for file in input_files]
+    frame_rate = max(rate for rate, _ in params)
+    channels = max(count for _, count in params)
+
+    def decoded():
+        for idx, file in enumerate(input_files):
+            segment = AudioSegment.from_file(file, format="mp3")
+            if trims and trims[idx]:
+                segment = segment[trims[idx]:]
+            yield segment.set_channels(channels).set_frame_rate(frame_rate).set_sample_width(2).raw_data
+            print(f"Merged: {file}")
+
+    encode_pcm_parts(decoded(), frame_rate, channels, 2, output_file)
     print(f"Merged file saved as: {output_file}\n")
 
+def whisper_pcm(audio):
+    mono = audio.set_channels(1).set_frame_rate(whisper.audio.SAMPLE_RATE).set_sample_width(2)
+    return pcm_frames(mono)[:, 0].astype(np.float32) / 32768.0
+
+def pcm_chunks(pcm, ranges, sample_rate=whisper.audio.SAMPLE_RATE):
+    per_ms = sample_rate // 1000
+    return [(pcm[start_ms * per_ms:end_ms * per_ms], start_ms, end_ms) for start_ms, end_ms in ranges]
+
+def merge_ranges(audio, ranges, output_file="merged.mp3"):
+    if not ranges:
+        raise ValueError("No input ranges!")
+
+    frames = pcm_frames(audio)
+    parts = [
+        frames[int((start_ms + trim) * audio.frame_rate / 1000.0):int(end_ms * audio.frame_rate / 1000.0)]
+        for (start_ms, end_ms), trim in zip(ranges, overlap_trims(ranges))
+    ]
+    encode_pcm(np.concatenate(parts), audio.frame_rate, audio.channels, audio.sample_width, output_file)
+    print(f"Merged file saved as: {output_file}\n")
+
+@timed("merge")
+def merge_source_ranges(input_file, ranges, output_file="merged.mp3", mode=MERGE_MODE):
+    if not ranges:
+        raise ValueError("No input ranges!")
+
+    list_file = f"{output_file}.concat.txt"
+    escaped = os.path.abspath(input_file).replace("'", "'\\''")
+    with open(list_file, "w", encoding="utf-8") as f:
+        for (start_ms, end_ms), trim in zip(ranges, overlap_trims(ranges)):
+            if end_ms <= start_ms + trim:
+                continue
+            f.write(f"file '{escaped}'\n")
+            f.write(f"inpoint {(start_ms + trim) / 1000:.3f}\n")
+            f.write(f"outpoint {end_ms / 1000:.3f}\n")
+
+    copy = mode == "copy" and mp3_stream_format(input_file) is not None
+    try:
+        subprocess.run(
+            [AudioSegment.converter, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+             "-i", list_file, *(["-c", "copy"] if copy else ["-f", "mp3"]), output_file],
+            check=True
+        )
+    finally:
+        os.remove(list_file)
+    print(f"Merged {len(ranges)} ranges from source{' without re-encoding' if copy else ''}: {output_file}\n")
+
+def process_in_memory(bucket, input_file, result_dir, work_dir, silence_thresh=-40, min_silence_len=700, model_size="tiny"):
+    audio = decode_audio(input_file)
+
+    ranges = split_ranges(audio, min_silence_len=min_silence_len, silence_thresh=silence_thresh)
+    print(f"Created {len(ranges)} chunks", flush=True)
+
+    output_dir = os.path.join(work_dir, "chunks")
+    output_srt = os.path.join(work_dir, "tts.txt")
+    output_file = os.path.join(work_dir, "merged.mp3")
+
+    if UPLOAD_CHUNKS:
+        os.makedirs(output_dir, exist_ok=True)
+        uploads = []
+        for idx, (start_ms, end_ms) in enumerate(ranges, start=1):
+            chunk_file = os.path.join(output_dir, f"chunk_{idx}.mp3")
+            with timed("chunk_export"):
+                audio[start_ms:end_ms].export(chunk_file, format="mp3")
+            uploads.append((f"{result_dir}chunks/{os.path.basename(chunk_file)}", chunk_file))
+
+        for remote_path, elapsed in upload_objects(bucket, uploads).items():
+            print(f"Chunk uploaded: {remote_path} ({elapsed * 1000:.0f} ms)", flush=True)
+
+    chunks = pcm_chunks(whisper_pcm(audio), ranges)
+    transcribe_chunks(chunks, output_srt=output_srt, model_size=model_size)
+    if ANALYSIS_SAMPLE_RATE:
+        merge_source_ranges(input_file, ranges, output_file)
+    else:
+        merge_ranges(audio, ranges, output_file)
+
+    upload_objects(bucket, [(f"{result_dir}merged.mp3", output_file), (f"{result_dir}tts.txt", output_srt)])
+
+class PcmChunkStore:
+    def __init__(self, path, dtype=np.float32, channels=1):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.channels = channels
+        self.offsets = []
+        self.frames = 0
+        self._file = open(path, "wb")
+        self._map = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, frames):
+        data = np.ascontiguousarray(frames, dtype=self.dtype).reshape(-1, self.channels)
+        data.tofile(self._file)
+        self.offsets.append((self.frames, len(data)))
+        self.frames += len(data)
+        return len(self.offsets) - 1
+
+    def view(self, idx):
+        offset, length = self.offsets[idx]
+        if length == 0:
+            view = np.zeros((0, self.channels), dtype=self.dtype)
+        else:
+            if self._map is None or offset + length > len(self._map):
+                self._file.flush()
+                self._map = np.memmap(self.path, dtype=self.dtype, mode="c", shape=(self.frames, self.channels))
+            view = self._map[offset:offset + length]
+        return view[:, 0] if self.channels == 1 else view
+
+    def close(self):
+        self._file.close()
+        self._map = None
+
+def process_streaming(bucket, input_file, result_dir, work_dir, silence_thresh=-40, min_silence_len=700, model_size="tiny", window_ms=STREAM_WINDOW_MS, batch_size=WHISPER_BATCH_SIZE, pack_ms=WHISPER_PACK_MS, chunk_store=CHUNK_STORE):
+    # Transcription runs once a pack window of audio (or batch_size Whisper
+    # windows when not packing) has accumulated, not per chunk count.
+    flush_ms = pack_ms if pack_ms > 0 else max(1, batch_size) * whisper.audio.CHUNK_LENGTH * 1000
+    if ANALYSIS_SAMPLE_RATE:
+        frame_rate, channels = ANALYSIS_SAMPLE_RATE, 1
+    else:
+        info = mediainfo(input_file)
+        frame_rate = int(info["sample_rate"])
+        channels = int(info["channels"])
+    with timed("loudness"):
+        loudness_db = pcm_dbfs(stream_pcm(input_file, frame_rate, channels, block_ms=window_ms))
+    splitter = StreamingSilenceSplitter(frame_rate, channels, loudness_db, min_silence_len=min_silence_len, silence_thresh=silence_thresh)
+
+    output_dir = os.path.join(work_dir, "chunks")
+    output_srt = os.path.join(work_dir, "tts.txt")
+    output_file = os.path.join(work_dir, "merged.mp3")
+    os.makedirs(output_dir, exist_ok=True)
+
+    use_store = chunk_store == "mmap"
+    source_store = None
+    if use_store:
+        if not ANALYSIS_SAMPLE_RATE:
+            source_store = PcmChunkStore(os.path.join(work_dir, "source.pcm"), np.int16, channels)
+        whisper_store = PcmChunkStore(os.path.join(work_dir, "whisper.pcm"), np.float32)
+
+    files = []
+    ranges = []
+    pending = []
+    audios = []
+    previous = [None]
+
+    try:
+        with open(output_srt, "w", encoding="utf-8") as srt:
+            def flush():
+                if UPLOAD_CHUNKS:
+                    uploads = [(f"{result_dir}chunks/{os.path.basename(chunk_file)}", chunk_file) for chunk_file, _, _ in pending]
+                    for remote_path, elapsed in upload_objects(bucket, uploads).items():
+                        print(f"Chunk uploaded: {remote_path} ({elapsed * 1000:.0f} ms)", flush=True)
+
+                batch = [whisper_store.view(idx) for idx in audios] if use_store else audios
+                texts = transcribe_texts(batch, model_size=model_size, batch_size=batch_size, pack_ms=pack_ms)
+                previous[0] = write_srt_entries(srt, pending, texts, first_index=len(files) - len(pending) + 1, previous=previous[0])
+                pending.clear()
+                audios.clear()
+
+            def emit(chunks):
+                for start_ms, end_ms, frames in chunks:
+                    segment = AudioSegment(data=frames.tobytes(), sample_width=2, frame_rate=frame_rate, channels=channels)
+                    chunk_file = os.path.join(output_dir, f"chunk_{len(files) + 1}.mp3")
+                    if UPLOAD_CHUNKS or not use_store:
+                        with timed("chunk_export"):
+                            segment.export(chunk_file, format="mp3")
+                    files.append(chunk_file)
+                    ranges.append((start_ms, end_ms))
+                    pending.append((chunk_file, start_ms, end_ms))
+                    if use_store:
+                        if source_store is not None:
+                            source_store.append(frames)
+                        audios.append(whisper_store.append(whisper_pcm(segment)))
+                    else:
+                        audios.append(whisper_pcm(segment))
+                    if sum(end - start for _, start, end in pending) >= flush_ms:
+                        flush()
+
+            for frames in stream_pcm(input_file, frame_rate, channels, block_ms=window_ms):
+                with timed("silence_detection"):
+                    chunks = splitter.feed(frames)
+                emit(chunks)
+            emit(splitter.finish())
+            if pending:
+                flush()
+
+        print(f"Created {len(files)} chunks", flush=True)
+        if not files:
+            raise ValueError("No input files!")
+
+        trims = overlap_trims(ranges)
+        if ANALYSIS_SAMPLE_RATE:
+            merge_source_ranges(input_file, ranges, output_file)
+        elif use_store:
+            with timed("merge"):
+                parts = (source_store.view(idx)[int(trim * frame_rate / 1000):] for idx, trim in enumerate(trims))
+                encode_pcm_parts(parts, frame_rate, channels, 2, output_file)
+            print(f"Merged file saved as: {output_file}\n")
+        else:
+            merge_audios(files, output_file, mode="copy", trims=trims)
+    finally:
+        if use_store:
+            if source_store is not None:
+                source_store.close()
+            whisper_store.close()
+
+    upload_objects(bucket, [(f"{result_dir}merged.mp3", output_file), (f"{result_dir}tts.txt", output_srt)])
+
+def manifest_object(result_dir):
+    return f"{result_dir}manifest.json"
+
+def completed_etag(bucket, result_dir):
+    try:
+        stat = minio_client.stat_object(bucket, manifest_object(result_dir))
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject"):
+            return None
+        raise
+    return stat.metadata.get("x-amz-meta-source-etag")
+
+def already_processed(bucket, result_dir, etag):
+    return bool(etag) and completed_etag(bucket, result_dir) == etag
+
+def write_manifest(bucket, result_dir, key, etag, version_id="", outputs=()):
+    manifest = {
+        "source": key,
+        "etag": etag,
+        "version_id": version_id,
+        "outputs": list(outputs),
+        "completed_at": time.time()
+    }
+    data = json.dumps(manifest).encode("utf-8")
+    minio_client.put_object(
+        bucket, manifest_object(result_dir), io.BytesIO(data), len(data),
+        content_type="application/json", metadata={"source-etag": etag, "source-version": version_id}
+    )
+    print(f"Manifest written: {manifest_object(result_dir)} ({etag})", flush=True)
+
 def numeric_sort(file_list):
     return sorted(file_list, key=lambda x: int(re.search(r"chunk_(\d+)\.mp3", x).group(1)))
 
+def process_record(bucket, key, work_dir, etag="", version_id=""):
+    started = time.perf_counter()
+    temp_path = os.path.join(work_dir, os.path.basename(key))
+    print(f"Temp path: {temp_path}", flush=True)
+
+    with timed("download"):
+        minio_client.fget_object(bucket, key, temp_path)
+    print(f"File downloaded: {temp_path}", flush=True)
+
+    result_dir = f"results/{os.path.splitext(os.path.basename(key))[0]}/"
+
+    if PIPELINE_MODE == "stream":
+        process_streaming(bucket, temp_path, result_dir, work_dir, silence_thresh=-40, min_silence_len=700, model_size="tiny")
+        write_manifest(bucket, result_dir, key, etag, version_id, outputs=["merged.mp3", "tts.txt"])
+        record_audio(float(mediainfo(temp_path).get("duration", 0)), time.perf_counter() - started)
+        print(f"Results uploaded: {result_dir}", flush=True)
+        return
+
+    if PIPELINE_MODE == "memory":
+        process_in_memory(bucket, temp_path, result_dir, work_dir, silence_thresh=-40, min_silence_len=700, model_size="tiny")
+        write_manifest(bucket, result_dir, key, etag, version_id, outputs=["merged.mp3", "tts.txt"])
+        record_audio(float(mediainfo(temp_path).get("duration", 0)), time.perf_counter() - started)
+        print(f"Results uploaded: {result_dir}", flush=True)
+        return
+
+    chunks = split_audio(temp_path, output_dir=os.path.join(work_dir, "chunks"), silence_thresh=-40, min_silence_len=700)
+    print(f"Created {len(chunks)} chunks", flush=True)
+
+    uploads = [(f"{result_dir}chunks/{os.path.basename(chunk_file)}", chunk_file) for chunk_file, _, _ in chunks]
+    for remote_path, elapsed in upload_objects(bucket, uploads).items():
+        print(f"Chunk uploaded: {remote_path} ({elapsed * 1000:.0f} ms)", flush=True)
+
+    output_srt = os.path.join(work_dir, "tts.txt")
+    output_file = os.path.join(work_dir, "merged.mp3")
+    transcribe_chunks(chunks, output_srt=output_srt, model_size="tiny")
+    if ANALYSIS_SAMPLE_RATE:
+        merge_source_ranges(temp_path, [(start_ms, end_ms) for _, start_ms, end_ms in chunks], output_file)
+    else:
+        files = [c[0] for c in chunks]
+        files = numeric_sort(files)
+        merge_audios(files, output_file, trims=overlap_trims([(start_ms, end_ms) for _, start_ms, end_ms in chunks]))
+
+    upload_objects(bucket, [(f"{result_dir}merged.mp3", output_file), (f"{result_dir}tts.txt", output_srt)])
+    write_manifest(bucket, result_dir, key, etag, version_id, outputs=["merged.mp3", "tts.txt"])
+    record_audio(float(mediainfo(temp_path).get("duration", 0)), time.perf_counter() - started)
+
+    print(f"Results uploaded: {result_dir}", flush=True)
+
 @app.route('/')
 def home():
     return "Audio processor Knative service is running\n"
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        **worker_pool.stats(),
+        "transcript_cache": transcript_cache.stats() if transcript_cache is not None else None
+    })
+
 @app.route('/process', methods=['POST'])
 def process_audio():
     input_file = request.args.get("input", "tts.mp3")
-    chunk_dir = "chunks"
+    return run_in_pool(process_local_file, input_file)
 
+def process_local_file(input_file):
+    started = time.perf_counter()
     try:
-        chunks = split_audio(input_file, output_dir=chunk_dir, silence_thresh=-40, min_silence_len=700)
-        transcribe_chunks(chunks, output_srt="tts.txt", model_size="small")
+        # Concurrent requests each get their own scratch and output directory.
+        os.makedirs(PROCESS_OUTPUT_ROOT, exist_ok=True)
+        output_dir = tempfile.mkdtemp(prefix=f"{os.path.splitext(os.path.basename(input_file))[0]}-", dir=PROCESS_OUTPUT_ROOT)
+        output_srt = os.path.join(output_dir, "tts.txt")
+        output_file = os.path.join(output_dir, "merged.mp3")
 
-        files = [c[0] for c in chunks]
-        files = numeric_sort(files)
-        merge_audios(files, "merged.mp3")
+        with work_directory() as work_dir:
+            chunks = split_audio(input_file, output_dir=os.path.join(work_dir, "chunks"), silence_thresh=-40, min_silence_len=700)
+            transcribe_chunks(chunks, output_srt=output_srt, model_size="small")
+
+            if ANALYSIS_SAMPLE_RATE:
+                merge_source_ranges(input_file, [(start_ms, end_ms) for _, start_ms, end_ms in chunks], output_file)
+            else:
+                files = [c[0] for c in chunks]
+                files = numeric_sort(files)
+                merge_audios(files, output_file, trims=overlap_trims([(start_ms, end_ms) for _, start_ms, end_ms in chunks]))
+        record_audio(float(mediainfo(input_file).get("duration", 0)), time.perf_counter() - started)
 
-        return jsonify({
+        return {
             "message": "Processing complete",
             "chunks": len(chunks),
             "output_files": {
-                "transcript": "tts.txt",
-                "merged": "merged.mp3"
+                "transcript": output_srt,
+                "merged": output_file
             }
-        })
+        }, 200
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return {"error": str(e)}, 500
 
 
 @app.route('/minio-event', methods=['POST'])
@@ -125,6 +1546,9 @@ def handle_minio_event():
     data = request.get_json()
     print("MinIO event received:", data, flush=True)
 
+    return run_in_pool(process_minio_event, data)
+
+def process_minio_event(data):
     try:
         records = data.get("Records", [])
         for record in records:
@@ -133,46 +1557,35 @@ def handle_minio_event():
 
             key = unquote(raw_key)
 
-            if key.startswith(("results/", "locks/", "chunks/")) or key.endswith(("_merged.mp3", "_tts.txt")):
+            if key.startswith(("results/", "locks/", "chunks/", "cache/")) or key.endswith(("_merged.mp3", "_tts.txt")):
                 print(f"Ignored (own file or result): {key}", flush=True)
                 continue
 
             print(f"Bucket: {bucket}, Key: {key}", flush=True)
 
-            temp_path = os.path.join(tempfile.gettempdir(), os.path.basename(key))
-            print(f"Temp path: {temp_path}", flush=True)
-
-            minio_client.fget_object(bucket, key, temp_path)
-            print(f"File downloaded: {temp_path}", flush=True)
-
-            chunks = split_audio(temp_path, output_dir="chunks", silence_thresh=-40, min_silence_len=700)
-            print(f"Created {len(chunks)} chunks", flush=True)
-
+            etag = record["s3"]["object"].get("eTag") or minio_client.stat_object(bucket, key).etag
+            version_id = record["s3"]["object"].get("versionId", "")
             result_dir = f"results/{os.path.splitext(os.path.basename(key))[0]}/"
-            for chunk_file, start_ms, end_ms in chunks:
-                remote_path = f"{result_dir}chunks/{os.path.basename(chunk_file)}"
-                minio_client.fput_object(bucket, remote_path, chunk_file)
-                print(f"Chunk uploaded: {remote_path}", flush=True)
-
-            transcribe_chunks(chunks, output_srt="tts.txt", model_size="tiny")
-            files = [c[0] for c in chunks]
-            files = numeric_sort(files)
-            merge_audios(files, "merged.mp3")
-
-            minio_client.fput_object(bucket, f"{result_dir}merged.mp3", "merged.mp3")
-            minio_client.fput_object(bucket, f"{result_dir}tts.txt", "tts.txt")
+            if already_processed(bucket, result_dir, etag):
+                print(f"Already processed: {key} ({etag})", flush=True)
+                continue
 
-            print(f"Results uploaded: {result_dir}", flush=True)
+            with work_directory() as work_dir:
+                process_record(bucket, key, work_dir, etag=etag, version_id=version_id)
 
-        return jsonify({"message": "Processing complete"}), 200
+        return {"message": "Processing complete"}, 200
 
     except Exception as e:
         import traceback
         traceback.print_exc()
         print("Error:", e, flush=True)
-        return jsonify({"error": str(e)}), 500
+        return {"error": str(e)}, 500
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
-    app.run(debug=False, host="0.0.0.0", port=port)
+    if SERVER == "waitress":
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=port, threads=WORKER_THREADS + WORKER_QUEUE_SIZE + 2)
+    else:
+        app.run(debug=False, host="0.0.0.0", port=port, threaded=True)
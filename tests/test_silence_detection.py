@@ -0,0 +1,129 @@
+import os
+import ast
+import glob
+import shutil
+
+import numpy as np
+import pytest
+from pydub import AudioSegment, silence
+from pydub.utils import db_to_float, ratio_to_db
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = [
+    os.path.join(ROOT, "Monolithic", "Service", "app.py"),
+    os.path.join(ROOT, "Microservices", "Cloud", "Services", "audio-splitter", "app.py"),
+    os.path.join(ROOT, "Microservices", "Local", "Services", "audio-splitter", "app.py"),
+]
+SAMPLES = sorted(glob.glob(os.path.join(ROOT, "MP3-files", "*.mp3")))
+
+
+DETECTOR = {"SAMPLE_DTYPES", "pcm_frames", "nonsilent_ranges"}
+STREAMING = DETECTOR | {
+    "SPLIT_MAX_CHUNK_MS", "SPLIT_OVERLAP_MS", "quietest_ms", "cut_long_range", "pcm_dbfs", "StreamingSilenceSplitter"
+}
+
+
+def load_detector(path, wanted=DETECTOR):
+    # The services import flask, whisper and minio at module level; only the
+    # pure detector definitions are compiled here so the test runs anywhere.
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    nodes = [
+        node for node in tree.body
+        if getattr(node, "name", None) in wanted
+        or (isinstance(node, ast.Assign) and any(getattr(t, "id", None) in wanted for t in node.targets))
+    ]
+    namespace = {"os": os, "np": np, "db_to_float": db_to_float, "ratio_to_db": ratio_to_db}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), path, "exec"), namespace)
+    return namespace
+
+
+def detect(detector, audio, **kwargs):
+    return detector["nonsilent_ranges"](
+        detector["pcm_frames"](audio), audio.frame_rate, audio.max_possible_amplitude, len(audio), **kwargs
+    )
+
+
+def synthetic(pattern, frame_rate=8000, channels=1, sample_width=2, seed=0):
+    rng = np.random.default_rng(seed)
+    peak = float(1 << (8 * sample_width - 1)) - 1
+    parts = []
+    for duration_ms, level in pattern:
+        count = frame_rate * duration_ms // 1000
+        t = np.arange(count) / frame_rate
+        tone = level * np.sin(2 * np.pi * 330 * t) + level * 0.1 * rng.standard_normal(count)
+        parts.append(np.repeat(tone[:, None], channels, axis=1))
+    samples = np.clip(np.concatenate(parts) * peak, -peak, peak).astype({1: np.int8, 2: np.int16, 4: np.int32}[sample_width])
+    return AudioSegment(data=samples.tobytes(), sample_width=sample_width, frame_rate=frame_rate, channels=channels)
+
+
+PATTERNS = {
+    "speech_with_pauses": [(400, 0.5), (900, 0.0), (1200, 0.4), (300, 0.001), (700, 0.6), (1500, 0.0), (500, 0.3)],
+    "leading_and_trailing_silence": [(1200, 0.0), (800, 0.5), (1000, 0.0)],
+    "no_silence": [(3000, 0.5)],
+    "all_silence": [(2500, 0.0)],
+    "shorter_than_min_silence": [(300, 0.5)],
+    "leading_room_noise": [(2500, 0.001), (1500, 0.5), (800, 0.0), (1200, 0.4), (3000, 0.001)],
+}
+
+
+def blocks(frames, frame_rate, window_ms):
+    step = frame_rate * window_ms // 1000
+    return [frames[start:start + step] for start in range(0, len(frames), step)]
+
+
+@pytest.mark.parametrize("service", SERVICES, ids=lambda path: os.path.relpath(path, ROOT))
+@pytest.mark.parametrize("name", sorted(PATTERNS))
+@pytest.mark.parametrize("channels,sample_width", [(1, 2), (2, 2), (1, 1)])
+@pytest.mark.parametrize("min_silence_len,silence_thresh,seek_step", [(700, -40, 1), (500, -30, 10), (1000, -16, 1)])
+def test_matches_pydub_on_synthetic_pcm(service, name, channels, sample_width, min_silence_len, silence_thresh, seek_step):
+    detector = load_detector(service)
+    audio = synthetic(PATTERNS[name], channels=channels, sample_width=sample_width)
+    kwargs = {"min_silence_len": min_silence_len, "silence_thresh": silence_thresh, "seek_step": seek_step}
+    assert detect(detector, audio, **kwargs) == silence.detect_nonsilent(audio, **kwargs)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is required to decode MP3-files")
+@pytest.mark.parametrize("service", SERVICES, ids=lambda path: os.path.relpath(path, ROOT))
+@pytest.mark.parametrize("sample", SAMPLES, ids=os.path.basename)
+@pytest.mark.parametrize("min_silence_len,silence_thresh", [(700, -40), (500, -40)])
+def test_matches_pydub_on_mp3_files(service, sample, min_silence_len, silence_thresh):
+    detector = load_detector(service)
+    audio = AudioSegment.from_file(sample, format="mp3")
+    kwargs = {"min_silence_len": min_silence_len, "silence_thresh": silence_thresh}
+    assert detect(detector, audio, **kwargs) == silence.detect_nonsilent(audio, **kwargs)
+
+
+@pytest.mark.parametrize("service", SERVICES, ids=lambda path: os.path.relpath(path, ROOT))
+@pytest.mark.parametrize("name", sorted(PATTERNS))
+@pytest.mark.parametrize("frame_rate", [16000, 22050, 44100])
+@pytest.mark.parametrize("window_ms", [100, 1000, 2500, 10000])
+def test_pcm_dbfs_matches_pydub(service, name, frame_rate, window_ms):
+    detector = load_detector(service, STREAMING)
+    audio = synthetic(PATTERNS[name], frame_rate=frame_rate, channels=2)
+    assert detector["pcm_dbfs"](blocks(detector["pcm_frames"](audio), frame_rate, window_ms)) == audio.dBFS
+
+
+@pytest.mark.parametrize("service", SERVICES, ids=lambda path: os.path.relpath(path, ROOT))
+@pytest.mark.parametrize("name", sorted(PATTERNS))
+@pytest.mark.parametrize("frame_rate,channels", [(16000, 1), (22050, 2), (44100, 1)])
+@pytest.mark.parametrize("window_ms", [100, 1000, 2500, 10000])
+@pytest.mark.parametrize("min_silence_len,silence_thresh", [(700, -16), (500, -30)])
+def test_streaming_matches_nonsilent_ranges(service, name, frame_rate, channels, window_ms, min_silence_len, silence_thresh):
+    detector = load_detector(service, STREAMING)
+    audio = synthetic(PATTERNS[name], frame_rate=frame_rate, channels=channels)
+    frames = detector["pcm_frames"](audio)
+    splitter = detector["StreamingSilenceSplitter"](
+        frame_rate, channels, detector["pcm_dbfs"](blocks(frames, frame_rate, window_ms)),
+        min_silence_len=min_silence_len, silence_thresh=silence_thresh, max_ms=0
+    )
+    streamed = []
+    for block in blocks(frames, frame_rate, window_ms):
+        streamed.extend(splitter.feed(block))
+    streamed.extend(splitter.finish())
+
+    expected = detector["nonsilent_ranges"](
+        frames, frame_rate, audio.max_possible_amplitude, len(audio),
+        min_silence_len=min_silence_len, silence_thresh=audio.dBFS + silence_thresh
+    )
+    assert [[start, end] for start, end, _ in streamed] == expected